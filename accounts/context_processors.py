@@ -1,4 +1,5 @@
-from .models import MODULE_CHOICES, RolePermission
+from .models import MODULE_CHOICES
+from .services import ModulePermissionService
 
 def module_permissions(request):
     """
@@ -11,17 +12,8 @@ def module_permissions(request):
     if not request.user.is_authenticated:
         return {}
 
-    user = request.user
-
-    # Build a dict like {'patients': True, 'pharmacy': False, ...}
-    perms = {}
-    for code, label in MODULE_CHOICES:
-        if user.is_superuser or user.role == 'administrator':
-            perms[code] = True
-        else:
-            perms[code] = RolePermission.objects.filter(
-                role=user.role, module=code, can_view=True
-            ).exists()
+    # Build a dict like {'patients': True, 'pharmacy': False, ...} (cached per role)
+    perms = ModulePermissionService.get_user_permissions(request.user)
 
     return {
         'user_module_perms': perms,
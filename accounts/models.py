@@ -33,9 +33,8 @@ class User(AbstractUser):
 
     def has_module_permission(self, module):
         """Check if this user can access a given module (for sidebar + feature gating)."""
-        if getattr(self, 'is_superuser', False) or self.role == 'administrator':
-            return True
-        return RolePermission.objects.filter(role=self.role, module=module, can_view=True).exists()
+        from accounts.services import ModulePermissionService
+        return ModulePermissionService.get_user_permissions(self).get(module, False)
     
     # def get_role_profile(self):
     #     """Get the role-specific profile based on current role"""
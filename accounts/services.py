@@ -1,4 +1,5 @@
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 
 User = get_user_model()
 
@@ -104,4 +105,50 @@ class UserService:
             'user': user,
             'role_profile': profile,
             'role_type': user.role
-        }
\ No newline at end of file
+        }
+
+
+class ModulePermissionService:
+    """Role -> module permission map shared by the sidebar context processor and User.has_module_permission.
+
+    Each role's map is built with a single query and kept in the shared cache (see
+    CACHES) until RolePermission rows for that role change (see accounts.signals), or for
+    CACHE_TIMEOUT seconds at most. The resolved map is also memoized on the user instance
+    so repeated checks within a request are free.
+    """
+
+    CACHE_KEY = 'accounts:module_perms:{role}'
+    CACHE_TIMEOUT = 300
+
+    @classmethod
+    def get_role_permissions(cls, role):
+        """Return {'patients': True, 'pharmacy': False, ...} for a role."""
+        from .models import MODULE_CHOICES, RolePermission
+        key = cls.CACHE_KEY.format(role=role)
+        perms = cache.get(key)
+        if perms is None:
+            allowed = set(
+                RolePermission.objects.filter(role=role, can_view=True).values_list('module', flat=True)
+            )
+            perms = {code: code in allowed for code, _ in MODULE_CHOICES}
+            cache.set(key, perms, cls.CACHE_TIMEOUT)
+        return perms
+
+    @classmethod
+    def get_user_permissions(cls, user):
+        """Module map for a user; superusers and administrators can see everything."""
+        perms = getattr(user, '_module_perms', None)
+        if perms is None:
+            from .models import MODULE_CHOICES
+            if getattr(user, 'is_superuser', False) or user.role == 'administrator':
+                perms = {code: True for code, _ in MODULE_CHOICES}
+            else:
+                perms = dict(cls.get_role_permissions(user.role))
+            user._module_perms = perms
+        return perms
+
+    @classmethod
+    def invalidate(cls, role=None):
+        """Drop the cached map for one role, or for every role when none is given."""
+        roles = [role] if role else [code for code, _ in User.USER_ROLES]
+        cache.delete_many([cls.CACHE_KEY.format(role=r) for r in roles])
@@ -1,8 +1,9 @@
 # signals.py
 
-from django.db.models.signals import post_save, pre_save
+from django.db.models.signals import post_save, pre_save, post_delete
 from django.dispatch import receiver
-from .models import User
+from .models import User, RolePermission
+from .services import ModulePermissionService
 from patients.models import Patient
 
 # NOTE: Doctor and BillingStaff/Pharmacist are created via admin/staff flows or PatientCreationForm.
@@ -50,3 +51,10 @@ def create_role_specific_model(sender, instance, **kwargs):
             'emergency_contact_relationship': 'N/A',
         })
     # Pharmacist profile (if role used) can be created manually or extend here.
+
+
+@receiver(post_save, sender=RolePermission)
+@receiver(post_delete, sender=RolePermission)
+def invalidate_module_permissions(sender, instance, **kwargs):
+    # Keep the cached role -> module map in step with admin edits and ensure_defaults()
+    ModulePermissionService.invalidate(instance.role)
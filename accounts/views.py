@@ -4,6 +4,7 @@ from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from .forms import RegisterForm, LoginForm
 from .models import RolePermission, MODULE_CHOICES
+from .services import ModulePermissionService
 
 
 def auth_view(request):
@@ -144,6 +145,7 @@ def role_permissions_view(request):
                     role=role, module=module,
                     defaults={'can_view': key in request.POST}
                 )
+        ModulePermissionService.invalidate()
         messages.success(request, "Permissions updated.")
         return redirect('accounts:role_permissions')
 
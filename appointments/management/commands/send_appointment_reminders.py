@@ -0,0 +1,37 @@
+import logging
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from appointments.services import AppointmentNotifications
+from notifications.models import Notification
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Queue reminders for upcoming appointments (idempotent; safe to run every minute from cron)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--hours',
+            type=float,
+            default=settings.APPOINTMENT_REMINDER_HOURS,
+            help=f'Remind appointments starting within this many hours (default: {settings.APPOINTMENT_REMINDER_HOURS})'
+        )
+        parser.add_argument(
+            '--delivery-method',
+            choices=[value for value, _ in Notification.DELIVERY_METHODS],
+            default='in_app',
+            help='Delivery method of the reminders (default: in_app)'
+        )
+
+    def handle(self, *args, **options):
+        stats = AppointmentNotifications.send_reminders(
+            hours=options['hours'], delivery_method=options['delivery_method']
+        )
+        logger.info('appointment reminders %s', ' '.join(f'{key}={value}' for key, value in stats.items()))
+        self.stdout.write(self.style.SUCCESS(
+            f"Queued {stats['queued']} reminders for {stats['appointments']} upcoming appointments "
+            f"in {stats['total_ms']}ms (scan {stats['scan_ms']}ms, queue {stats['queue_ms']}ms)"
+        ))
@@ -62,6 +62,20 @@ class Appointment(models.Model):
     
     class Meta:
         ordering = ['appointment_date', 'appointment_time']
+        indexes = [
+            # Doctor day views, slot lookups and conflict checks
+            models.Index(fields=['doctor', 'appointment_date', 'status'], name='appt_doctor_date_status_idx'),
+            # Patient upcoming/history lists
+            models.Index(fields=['patient', 'appointment_date'], name='appt_patient_date_idx'),
+            # Hospital-wide "today" counters
+            models.Index(fields=['appointment_date', 'status'], name='appt_date_status_idx'),
+        ]
+    
+    def save(self, *args, **kwargs):
+        if not self.id:
+            from dashboard.sequences import IdAllocator
+            self.id = IdAllocator.generate('APT', separator='-')
+        super().save(*args, **kwargs)
     
     def __str__(self):
         return f"{self.pk} - {self.patient.user.get_full_name()} with Dr. {self.doctor.user.get_full_name()}"
\ No newline at end of file
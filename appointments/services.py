@@ -0,0 +1,343 @@
+import time as clock
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from django.template import Context, Engine
+from django.utils import timezone
+
+from dashboard import cache_versions
+from notifications.models import Notification, NotificationTemplate
+from notifications.services import UnreadCounter
+from .models import Appointment, DoctorSchedule
+
+BOOKED_STATUSES = ('scheduled', 'confirmed')
+
+
+class AvailabilityService:
+    """
+    Answers "which slots are free" from each doctor's DoctorSchedule.
+
+    A doctor's day is divided into APPOINTMENT_SLOT_MINUTES slots. Working hours come
+    from the weekly schedule (cached per doctor), and booked slots are kept as one
+    integer bitmap per doctor-day (bit n = slot n of the day). Both are cached and
+    retired by appointments.signals whenever a schedule or appointment changes, so
+    multi-doctor, multi-day lookups cost at most one query for schedules and one for
+    bookings, and nothing once warm.
+
+    Cache keys carry a version that is bumped after the writing transaction commits.
+    Readers look the version up before querying, so a fill that raced a write is
+    stored under the retired version and never served.
+    """
+
+    SCHEDULE_KEY = 'appointments:schedule:{doctor_id}'
+    BOOKED_KEY = 'appointments:booked:{doctor_id}:{day}'
+    VERSION_KEY = '{key}:version'
+    CACHE_TIMEOUT = 300
+    # Doctors with no DoctorSchedule rows keep the clinic's standard hours every day
+    DEFAULT_HOURS = [(time(8, 0), time(17, 0))]
+
+    @staticmethod
+    def slot_minutes():
+        return settings.APPOINTMENT_SLOT_MINUTES
+
+    @classmethod
+    def slot_index(cls, value):
+        return (value.hour * 60 + value.minute) // cls.slot_minutes()
+
+    @classmethod
+    def slot_time(cls, index):
+        minutes = index * cls.slot_minutes()
+        return time(minutes // 60, minutes % 60)
+
+    @classmethod
+    def versioned(cls, keys):
+        """{key + current version: value} for a {key: value} mapping."""
+        versions = cache_versions.stamps(cls.VERSION_KEY.format(key=key) for key in keys)
+        return {
+            f"{key}:v{versions[cls.VERSION_KEY.format(key=key)]}": value
+            for key, value in keys.items()
+        }
+
+    @classmethod
+    def schedules(cls, doctor_ids):
+        """{doctor_id: {'monday': [(start, end), ...], ...} or None when the doctor has no schedule}"""
+        keys = cls.versioned({cls.SCHEDULE_KEY.format(doctor_id=doctor_id): doctor_id for doctor_id in doctor_ids})
+        cached = cache.get_many(keys)
+        result = {keys[key]: value for key, value in cached.items()}
+
+        missing = [doctor_id for key, doctor_id in keys.items() if key not in cached]
+        if missing:
+            loaded = {doctor_id: {} for doctor_id in missing}
+            rows = DoctorSchedule.objects.filter(doctor_id__in=missing).values_list(
+                'doctor_id', 'day_of_week', 'start_time', 'end_time', 'is_active'
+            )
+            for doctor_id, day_of_week, start_time, end_time, is_active in rows:
+                week = loaded[doctor_id]
+                week.setdefault(day_of_week, [])
+                if is_active:
+                    week[day_of_week].append((start_time, end_time))
+            loaded = {doctor_id: week or None for doctor_id, week in loaded.items()}
+            cache.set_many(
+                {key: loaded[doctor_id] for key, doctor_id in keys.items() if doctor_id in loaded},
+                cls.CACHE_TIMEOUT,
+            )
+            result.update(loaded)
+        return result
+
+    @classmethod
+    def grid(cls, week, day):
+        """Bitmap of the slots a doctor works on `day`, given their weekly schedule."""
+        if week is None:
+            hours = cls.DEFAULT_HOURS
+        else:
+            hours = week.get(day.strftime('%A').lower(), [])
+
+        bits = 0
+        for start, end in hours:
+            first = -(-(start.hour * 60 + start.minute) // cls.slot_minutes())
+            last = (end.hour * 60 + end.minute) // cls.slot_minutes()
+            for index in range(first, last):
+                bits |= 1 << index
+        return bits
+
+    @classmethod
+    def booked(cls, doctor_ids, days):
+        """{(doctor_id, day): bitmap of booked slots}"""
+        keys = cls.versioned({
+            cls.BOOKED_KEY.format(doctor_id=doctor_id, day=day.isoformat()): (doctor_id, day)
+            for doctor_id in doctor_ids for day in days
+        })
+        cached = cache.get_many(keys)
+        result = {keys[key]: value for key, value in cached.items()}
+
+        missing = [pair for key, pair in keys.items() if key not in cached]
+        if missing:
+            loaded = dict.fromkeys(missing, 0)
+            rows = Appointment.objects.filter(
+                doctor_id__in={doctor_id for doctor_id, _ in missing},
+                appointment_date__in={day for _, day in missing},
+                status__in=BOOKED_STATUSES,
+            ).values_list('doctor_id', 'appointment_date', 'appointment_time')
+            for doctor_id, day, booked_time in rows:
+                if (doctor_id, day) in loaded:
+                    loaded[(doctor_id, day)] |= 1 << cls.slot_index(booked_time)
+            cache.set_many(
+                {key: loaded[pair] for key, pair in keys.items() if pair in loaded},
+                cls.CACHE_TIMEOUT,
+            )
+            result.update(loaded)
+        return result
+
+    @classmethod
+    def free_slots(cls, doctor_ids, date_from, date_to=None, exclude=None, after=None):
+        """
+        {(doctor_id, day): [time, ...]} of open slots for every doctor and day in the range.
+
+        `exclude` is an appointment being edited, whose own slot counts as free; `after`
+        is a datetime before which slots are not offered (e.g. now).
+        """
+        date_to = date_to or date_from
+        days = [date_from + timedelta(days=offset) for offset in range((date_to - date_from).days + 1)]
+        schedules = cls.schedules(doctor_ids)
+        booked = cls.booked(doctor_ids, days)
+
+        if exclude is not None and exclude.status in BOOKED_STATUSES:
+            key = (exclude.doctor_id, exclude.appointment_date)
+            if key in booked:
+                booked[key] &= ~(1 << cls.slot_index(exclude.appointment_time))
+
+        if after is not None:
+            after = timezone.localtime(after) if timezone.is_aware(after) else after
+
+        result = {}
+        for doctor_id in doctor_ids:
+            for day in days:
+                bits = cls.grid(schedules[doctor_id], day) & ~booked[(doctor_id, day)]
+                if after is not None and day <= after.date():
+                    if day < after.date():
+                        bits = 0
+                    else:
+                        bits &= ~((1 << (cls.slot_index(after.time()) + 1)) - 1)
+                result[(doctor_id, day)] = [
+                    cls.slot_time(index) for index in range(bits.bit_length()) if bits >> index & 1
+                ]
+        return result
+
+    @classmethod
+    def next_free_slot(cls, doctor_ids, date_from=None, days=14, after=None):
+        """Earliest open (doctor_id, day, time) across all doctors within `days` days, or None."""
+        after = after or timezone.localtime()
+        date_from = date_from or after.date()
+        if not doctor_ids:
+            return None
+        slots = cls.free_slots(doctor_ids, date_from, date_from + timedelta(days=days - 1), after=after)
+        candidates = [
+            (day, times[0], doctor_id)
+            for (doctor_id, day), times in slots.items() if times
+        ]
+        if not candidates:
+            return None
+        day, slot, doctor_id = min(candidates)
+        return doctor_id, day, slot
+
+    @classmethod
+    def is_scheduled(cls, doctor_id, day, value):
+        """Whether `value` falls inside the doctor's working hours on `day`."""
+        week = cls.schedules([doctor_id])[doctor_id]
+        return bool(cls.grid(week, day) >> cls.slot_index(value) & 1)
+
+    @classmethod
+    def invalidate(cls, doctor_id, day=None):
+        """
+        Retire a doctor's cached bookings for `day`, or their weekly schedule when no day
+        is given, once the current transaction commits (immediately outside one).
+        """
+        if day is None:
+            key = cls.SCHEDULE_KEY.format(doctor_id=doctor_id)
+        else:
+            key = cls.BOOKED_KEY.format(doctor_id=doctor_id, day=day.isoformat())
+        key = cls.VERSION_KEY.format(key=key)
+        transaction.on_commit(lambda: cache_versions.bump(key))
+
+
+class AppointmentNotifications:
+    """
+    Generates appointment_reminder and appointment_confirmation notifications.
+
+    Each notification carries a dedupe_key of type, appointment and slot, so generating
+    twice is a no-op while a rescheduled appointment gets a fresh one. Text comes from
+    the active NotificationTemplate of that type (DEFAULTS when there is none), rendered
+    with the patient's names and the appointment's date, time and doctor. Rows are
+    queued 'pending' for the delivery worker.
+    """
+
+    DEFAULTS = {
+        'appointment_reminder': (
+            'Appointment reminder',
+            'Dear {{ full_name }}, this is a reminder of your appointment with {{ doctor }} '
+            'on {{ appointment_date|date:"D j M Y" }} at {{ appointment_time|time:"H:i" }}.',
+        ),
+        'appointment_confirmation': (
+            'Appointment confirmed',
+            'Dear {{ full_name }}, your appointment with {{ doctor }} on '
+            '{{ appointment_date|date:"D j M Y" }} at {{ appointment_time|time:"H:i" }} is confirmed.',
+        ),
+    }
+    FIELDS = (
+        'id', 'appointment_date', 'appointment_time', 'reason', 'patient__user_id',
+        'patient__user__first_name', 'patient__user__last_name', 'patient__user__email',
+        'doctor__user__first_name', 'doctor__user__last_name',
+    )
+
+    @staticmethod
+    def dedupe_key(kind, row):
+        return f"{kind}:{row['id']}:{row['appointment_date']:%Y%m%d}{row['appointment_time']:%H%M}"
+
+    @classmethod
+    def _templates(cls, kind):
+        template = NotificationTemplate.objects.filter(type=kind, is_active=True).order_by('id').first()
+        subject, message = (template.subject, template.message_template) if template else cls.DEFAULTS[kind]
+        engine = Engine.get_default()
+        return template, engine.from_string(subject), engine.from_string(message)
+
+    @staticmethod
+    def _existing(keys):
+        """The subset of ``keys`` that already have a notification."""
+        keys = list(keys)
+        existing = set()
+        for start in range(0, len(keys), 1000):
+            existing.update(Notification.objects.filter(
+                dedupe_key__in=keys[start:start + 1000]
+            ).values_list('dedupe_key', flat=True))
+        return existing
+
+    @classmethod
+    def queue(cls, kind, rows, delivery_method='in_app'):
+        """Queue one ``kind`` notification per appointment row (see FIELDS) that lacks one; returns the count."""
+        keys = {cls.dedupe_key(kind, row): row for row in rows}
+        existing = cls._existing(keys)
+        pending = [(key, row) for key, row in keys.items() if key not in existing]
+        if not pending:
+            return 0
+
+        template, subject_template, message_template = cls._templates(kind)
+        notifications = []
+        for key, row in pending:
+            first_name, last_name = row['patient__user__first_name'], row['patient__user__last_name']
+            context = Context({
+                'first_name': first_name,
+                'last_name': last_name,
+                'full_name': f'{first_name} {last_name}'.strip(),
+                'email': row['patient__user__email'],
+                'doctor': f"Dr. {row['doctor__user__first_name']} {row['doctor__user__last_name']}".strip(),
+                'appointment_id': row['id'],
+                'appointment_date': row['appointment_date'],
+                'appointment_time': row['appointment_time'],
+                'reason': row['reason'],
+            }, autoescape=False)
+            notifications.append(Notification(
+                recipient_id=row['patient__user_id'],
+                template=template,
+                subject=subject_template.render(context)[:200],
+                message=message_template.render(context),
+                delivery_method=delivery_method,
+                status='pending',
+                dedupe_key=key,
+            ))
+        with transaction.atomic():
+            # A concurrent run may have inserted some of these since the lookup; the unique
+            # dedupe_key makes the database drop those. ignore_conflicts returns every
+            # object either way, so count the keys that appeared (the write lock the
+            # IMMEDIATE transaction takes up front keeps other runs out in between)
+            before = cls._existing(key for key, _ in pending)
+            Notification.objects.bulk_create(notifications, batch_size=1000, ignore_conflicts=True)
+            inserted = cls._existing(key for key, _ in pending) - before
+            recipients = {keys[key]['patient__user_id'] for key in inserted}
+            # bulk_create skips the signals that keep the unread badges current
+            transaction.on_commit(lambda: UnreadCounter.invalidate_many(recipients))
+        return len(inserted)
+
+    @classmethod
+    def confirm(cls, appointment, delivery_method='in_app'):
+        rows = Appointment.objects.filter(pk=appointment.pk).values(*cls.FIELDS)
+        return cls.queue('appointment_confirmation', rows, delivery_method)
+
+    @classmethod
+    def send_reminders(cls, now=None, hours=None, delivery_method='in_app'):
+        """
+        Queue reminders for booked appointments starting within the next ``hours``
+        (APPOINTMENT_REMINDER_HOURS). Returns a dict of counts and per-phase timings in ms.
+        """
+        now = timezone.localtime(now)
+        until = now + timedelta(hours=hours or settings.APPOINTMENT_REMINDER_HOURS)
+        started = clock.perf_counter()
+        # Bounded by appointment_date so the (appointment_date, status) index does the work
+        window = Q(appointment_date__gt=now.date()) | Q(appointment_date=now.date(), appointment_time__gt=now.time())
+        window &= Q(appointment_date__lt=until.date()) | Q(appointment_date=until.date(), appointment_time__lte=until.time())
+        rows = list(Appointment.objects.filter(
+            window,
+            appointment_date__range=(now.date(), until.date()),
+            status__in=BOOKED_STATUSES,
+        ).order_by().values(*cls.FIELDS))
+        scanned = clock.perf_counter()
+        queued = cls.queue('appointment_reminder', rows, delivery_method)
+        finished = clock.perf_counter()
+        return {
+            'appointments': len(rows),
+            'queued': queued,
+            'scan_ms': round((scanned - started) * 1000, 1),
+            'queue_ms': round((finished - scanned) * 1000, 1),
+            'total_ms': round((finished - started) * 1000, 1),
+        }
+
+
+def parse_slot(day, value):
+    """Parse 'YYYY-MM-DD' and 'HH:MM' strings from the booking forms; returns (date, time) or None."""
+    try:
+        parsed = datetime.strptime(f"{day} {value[:5]}", '%Y-%m-%d %H:%M')
+    except (TypeError, ValueError):
+        return None
+    return parsed.date(), parsed.time()
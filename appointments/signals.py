@@ -0,0 +1,37 @@
+from datetime import date
+
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Appointment, DoctorSchedule
+from .services import AvailabilityService
+
+
+def _booked_day(doctor_id, day):
+    """(doctor_id, date) for a slot bitmap; tolerates dates still held as ISO strings."""
+    if isinstance(day, str):
+        day = date.fromisoformat(day)
+    return doctor_id, day
+
+
+@receiver(post_init, sender=Appointment)
+def remember_booked_day(sender, instance, **kwargs):
+    # Read through __dict__ so deferred fields don't trigger a query per instance
+    values = instance.__dict__
+    instance._loaded_booking = (values.get('doctor_id'), values.get('appointment_date'))
+
+
+@receiver(post_save, sender=Appointment)
+@receiver(post_delete, sender=Appointment)
+def refresh_booked_slots(sender, instance, **kwargs):
+    """Creating, moving, cancelling or deleting an appointment retires the affected day bitmaps."""
+    for doctor_id, day in {instance._loaded_booking, (instance.doctor_id, instance.appointment_date)}:
+        if doctor_id and day:
+            AvailabilityService.invalidate(*_booked_day(doctor_id, day))
+    instance._loaded_booking = (instance.doctor_id, instance.appointment_date)
+
+
+@receiver(post_save, sender=DoctorSchedule)
+@receiver(post_delete, sender=DoctorSchedule)
+def refresh_doctor_schedule(sender, instance, **kwargs):
+    AvailabilityService.invalidate(instance.doctor_id)
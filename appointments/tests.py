@@ -1,3 +1,118 @@
+from datetime import date, datetime, time, timedelta
+
+from django.core.cache import cache
+from django.db import transaction
 from django.test import TestCase
+from django.utils import timezone
+
+from accounts.models import User
+from notifications.models import Notification
+from notifications.services import UnreadCounter
+from patients.models import Patient
+from .models import Appointment, Doctor
+from .services import AppointmentNotifications, AvailabilityService
+
+
+class AvailabilityCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.doctor = Doctor.objects.get(user=User.objects.create_user(email='doctor@example.com', role='doctor'))
+        self.patient = Patient.objects.get(user=User.objects.create_user(email='patient@example.com', role='patient'))
+        self.day = date.today() + timedelta(days=1)
+        self.slot = AvailabilityService.slot_index(time(9, 0))
+
+    def booked(self):
+        return AvailabilityService.booked([self.doctor.pk], [self.day])[(self.doctor.pk, self.day)]
+
+    def book(self):
+        return Appointment.objects.create(
+            patient=self.patient, doctor=self.doctor, appointment_date=self.day,
+            appointment_time=time(9, 0), reason='Checkup',
+        )
+
+    def test_bitmap_is_retired_only_on_commit(self):
+        self.assertEqual(self.booked(), 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.book()
+            # Not committed yet: the cached bitmap is still the one other requests see
+            self.assertEqual(self.booked(), 0)
+        self.assertEqual(self.booked() >> self.slot & 1, 1)
+
+    def test_rolled_back_booking_keeps_the_cache(self):
+        self.assertEqual(self.booked(), 0)
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            try:
+                with transaction.atomic():
+                    self.book()
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+        self.assertEqual(callbacks, [])
+        self.assertEqual(self.booked(), 0)
+
+    def test_fill_that_raced_a_write_is_not_served(self):
+        key = AvailabilityService.BOOKED_KEY.format(doctor_id=self.doctor.pk, day=self.day.isoformat())
+        # A reader picks its key, then the booking commits before the reader stores
+        # the bitmap it read beforehand
+        stale_key, = AvailabilityService.versioned({key: None})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.book()
+        cache.set(stale_key, 0)
+        self.assertEqual(self.booked() >> self.slot & 1, 1)
+
+
+class AppointmentNotificationsTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.doctor = Doctor.objects.get(user=User.objects.create_user(email='doctor@example.com', role='doctor'))
+        self.patient = Patient.objects.get(user=User.objects.create_user(email='patient@example.com', role='patient'))
+        self.now = timezone.make_aware(datetime.combine(date.today(), time(10, 0)))
+
+    def book(self, starts_in, status='scheduled'):
+        start = timezone.localtime(self.now + starts_in)
+        return Appointment.objects.create(
+            patient=self.patient, doctor=self.doctor, appointment_date=start.date(),
+            appointment_time=start.time(), reason='Checkup', status=status,
+        )
+
+    def send(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            return AppointmentNotifications.send_reminders(now=self.now, hours=24)
+
+    def test_reminder_window(self):
+        due = [self.book(timedelta(hours=1)), self.book(timedelta(hours=14)), self.book(timedelta(hours=24))]
+        self.book(timedelta(hours=-1))
+        self.book(timedelta(hours=0))
+        self.book(timedelta(hours=24, minutes=1))
+        self.book(timedelta(hours=2), status='cancelled')
+
+        stats = self.send()
+        self.assertEqual((stats['appointments'], stats['queued']), (3, 3))
+        reminded = Notification.objects.values_list('dedupe_key', flat=True)
+        self.assertEqual({key.split(':')[1] for key in reminded}, {appointment.pk for appointment in due})
+
+    def test_rerun_queues_nothing_new(self):
+        self.book(timedelta(hours=1))
+        self.assertEqual(UnreadCounter.get(self.patient.user), 0)
+        self.assertEqual(self.send()['queued'], 1)
+        self.assertEqual(UnreadCounter.get(self.patient.user), 1)
+        self.assertEqual(self.send()['queued'], 0)
+        self.assertEqual(Notification.objects.count(), 1)
+
+        # Rescheduling is a new slot and gets a fresh reminder
+        appointment = Appointment.objects.get()
+        appointment.appointment_time = time(12, 30)
+        appointment.save()
+        self.assertEqual(self.send()['queued'], 1)
+        self.assertEqual(UnreadCounter.get(self.patient.user), 2)
 
-# Create your tests here.
+    def test_confirmation_is_sent_once(self):
+        appointment = self.book(timedelta(days=3))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(AppointmentNotifications.confirm(appointment), 1)
+            self.assertEqual(AppointmentNotifications.confirm(appointment), 0)
+        notification = Notification.objects.get()
+        self.assertEqual(notification.dedupe_key.split(':')[0], 'appointment_confirmation')
+        self.assertIn('is confirmed', notification.message)
@@ -7,10 +7,12 @@ urlpatterns = [
     path('', views.appointment_list, name='appointments'),
     path('doctors/', views.doctor_list, name='doctor-list'),
     path('book/', views.book_appointment_view, name='book_appointment'),
+    path('export/', views.appointment_export, name='appointment_export'),
     path('my-appointments/', views.my_appointments_view, name='my_appointments'),
     path('create/', views.create_appointment_view, name='appointment_create'),
     path('check-conflicts/', views.check_appointment_conflicts, name='check_conflicts'),
     path('available-slots/', views.get_available_slots, name='available_slots'),
+    path('next-available/', views.next_available_slot, name='next_available_slot'),
     path('update-status/<str:appointment_id>/<str:new_status>/', views.update_appointment_status, name='update_status'),
     path('edit/<str:appointment_id>/', views.edit_appointment_view, name='appointment_edit'),
     path('<str:appointment_id>/', views.appointment_detail_view, name='detail'),
@@ -7,12 +7,14 @@ from django.http import JsonResponse
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_GET
-import uuid
 from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib import messages
 from .models import Appointment
 from .forms import AppointmentForm
+from .services import AppointmentNotifications, AvailabilityService, BOOKED_STATUSES, parse_slot
 from patients.models import Patient
+from dashboard.exports import Column, choice_label, streaming_export
+from dashboard.pagination import paginate_json
 from .models import Appointment, Doctor
 
 
@@ -155,39 +157,47 @@ def doctor_list(request):
     return render(request, 'doctor_list.html', context)
 
 
+def visible_appointments(user):
+    """(appointments, title) the user may see, or (None, None) when they may see none"""
+    if hasattr(user, 'doctor'):
+        return Appointment.objects.filter(doctor__user=user), "My Appointments (Doctor)"
+    if hasattr(user, 'patient'):
+        return Appointment.objects.filter(patient__user=user), "My Appointments"
+    if user.is_staff:
+        return Appointment.objects.all(), "All Appointments"
+    return None, None
+
+
+def filter_appointments(appointments, params):
+    """Apply the appointment list filters (status, date_from, date_to) from a QueryDict"""
+    status_filter = params.get('status')
+    if status_filter:
+        appointments = appointments.filter(status=status_filter)
+
+    date_from = params.get('date_from')
+    date_to = params.get('date_to')
+    if date_from:
+        appointments = appointments.filter(appointment_date__gte=date_from)
+    if date_to:
+        appointments = appointments.filter(appointment_date__lte=date_to)
+    return appointments
+
+
 @login_required
 def appointment_list(request):
     user_is_doctor = hasattr(request.user, 'doctor')
     user_is_patient = hasattr(request.user, 'patient')
 
-    if user_is_doctor:
-        appointments = Appointment.objects.filter(
-            doctor__user=request.user
-        )
-        title = "My Appointments (Doctor)"
-    elif user_is_patient:
-        appointments = Appointment.objects.filter(
-            patient__user=request.user
-        )
-        title = "My Appointments"
-    elif request.user.is_staff:
-        appointments = Appointment.objects.all()
-        title = "All Appointments"
-    else:
+    appointments, title = visible_appointments(request.user)
+    if appointments is None:
         messages.error(request, 'You do not have permission to view appointments.')
         return redirect('dashboard:dashboard')
 
     # Filters
+    appointments = filter_appointments(appointments, request.GET)
     status_filter = request.GET.get('status')
-    if status_filter:
-        appointments = appointments.filter(status=status_filter)
-
     date_from = request.GET.get('date_from')
     date_to = request.GET.get('date_to')
-    if date_from:
-        appointments = appointments.filter(appointment_date__gte=date_from)
-    if date_to:
-        appointments = appointments.filter(appointment_date__lte=date_to)
 
     today = date.today()
     start_of_week = today - timedelta(days=today.weekday())
@@ -211,6 +221,32 @@ def appointment_list(request):
 
     return render(request, 'appointments.html', context)
 
+
+@login_required
+def appointment_export(request):
+    """Stream the filtered appointment list as CSV, NDJSON or XLSX (?format=)"""
+    appointments, _ = visible_appointments(request.user)
+    if appointments is None:
+        messages.error(request, 'You do not have permission to view appointments.')
+        return redirect('dashboard:dashboard')
+
+    columns = [
+        Column('Appointment ID', 'id'),
+        Column('Date', 'appointment_date'),
+        Column('Time', 'appointment_time', lambda value: value.strftime('%H:%M')),
+        Column('Patient ID', 'patient__patient_id'),
+        Column('Patient First Name', 'patient__user__first_name'),
+        Column('Patient Last Name', 'patient__user__last_name'),
+        Column('Doctor First Name', 'doctor__user__first_name'),
+        Column('Doctor Last Name', 'doctor__user__last_name'),
+        Column('Status', 'status', choice_label(Appointment.STATUS_CHOICES)),
+        Column('Reason', 'reason'),
+    ]
+    appointments = filter_appointments(appointments, request.GET).order_by(
+        '-appointment_date', '-appointment_time'
+    )
+    return streaming_export(appointments, columns, 'appointments_export', request.GET.get('format', 'csv'))
+
 @login_required
 def confirm_appointment_view(request, appointment_id):
     """Confirm an appointment"""
@@ -224,11 +260,9 @@ def confirm_appointment_view(request, appointment_id):
     if request.method == 'POST':
         appointment.status = 'confirmed'
         appointment.save()
+        AppointmentNotifications.confirm(appointment)
         messages.success(request, 'Appointment confirmed successfully.')
         
-        # You could add email notification here
-        # send_appointment_confirmation_email(appointment)
-        
     return redirect('appointments:detail', appointment_id=appointment_id)
 
 @login_required
@@ -295,11 +329,6 @@ def delete_appointment_view(request, appointment_id):
     
     return render(request, 'appointment_delete.html', context)
 
-def generate_appointment_id():
-    timestamp = datetime.now().strftime('%Y%m%d')
-    unique_id = str(uuid.uuid4())[:8].upper()
-    return f"APT-{timestamp}-{unique_id}"
-
 @login_required
 def create_appointment_view(request):
     # Determine user role
@@ -336,8 +365,6 @@ def create_appointment_view(request):
         if form.is_valid():
             appointment = form.save(commit=False)
             appointment.status = 'scheduled'
-            appointment.id = generate_appointment_id()
-
             
             # Auto-assign based on user role
             if user_is_doctor:
@@ -456,83 +483,95 @@ def check_appointment_conflicts(request):
     if request.method == 'POST':
         doctor_id = request.POST.get('doctor')
         patient_id = request.POST.get('patient')
-        appointment_date = request.POST.get('appointment_date')
-        appointment_time = request.POST.get('appointment_time')
         appointment_id = request.POST.get('appointment_id')
-        
+        slot = parse_slot(request.POST.get('appointment_date'), request.POST.get('appointment_time'))
+
         conflicts = []
-        
-        if doctor_id and appointment_date and appointment_time:
-            # Check doctor availability
-            doctor_conflicts = Appointment.objects.filter(
-                doctor_id=doctor_id,
-                appointment_date=appointment_date,
-                appointment_time=appointment_time,
-                status__in=['scheduled', 'confirmed']
-            )
-            
-            # Exclude current appointment if editing
-            if appointment_id:
-                doctor_conflicts = doctor_conflicts.exclude(id=appointment_id)
-                
-            if doctor_conflicts.exists():
-                conflicts.append(f"Doctor already has an appointment at this time")
-        
-        if patient_id and appointment_date and appointment_time:
-            # Check patient availability
-            patient_conflicts = Appointment.objects.filter(
-                patient_id=patient_id,
+
+        if slot and (doctor_id or patient_id):
+            appointment_date, appointment_time = slot
+            # One query covers both the doctor's and the patient's bookings at this time
+            participants = Q()
+            if doctor_id:
+                participants |= Q(doctor_id=doctor_id)
+            if patient_id:
+                participants |= Q(patient_id=patient_id)
+            clashes = Appointment.objects.filter(
+                participants,
                 appointment_date=appointment_date,
                 appointment_time=appointment_time,
-                status__in=['scheduled', 'confirmed']
+                status__in=BOOKED_STATUSES
             )
-            
+
             # Exclude current appointment if editing
             if appointment_id:
-                patient_conflicts = patient_conflicts.exclude(id=appointment_id)
-                
-            if patient_conflicts.exists():
-                conflicts.append(f"Patient already has an appointment at this time")
-        
+                clashes = clashes.exclude(id=appointment_id)
+
+            clashing_doctors, clashing_patients = set(), set()
+            for clash_doctor, clash_patient in clashes.values_list('doctor_id', 'patient_id'):
+                clashing_doctors.add(str(clash_doctor))
+                clashing_patients.add(str(clash_patient))
+
+            if doctor_id in clashing_doctors:
+                conflicts.append("Doctor already has an appointment at this time")
+            if patient_id in clashing_patients:
+                conflicts.append("Patient already has an appointment at this time")
+            if doctor_id and doctor_id.isdigit() and not AvailabilityService.is_scheduled(
+                int(doctor_id), appointment_date, appointment_time
+            ):
+                conflicts.append("Doctor is not scheduled to work at this time")
+
         return JsonResponse({'conflicts': conflicts})
-    
+
     return JsonResponse({'error': 'Invalid request'}, status=400)
 
 @login_required
 def get_available_slots(request):
     """AJAX endpoint to get available time slots for a doctor on a specific date"""
     doctor_id = request.GET.get('doctor')
-    date = request.GET.get('date')
     appointment_id = request.GET.get('appointment_id')  # For editing
-    
-    if not doctor_id or not date:
+    slot_date = parse_slot(request.GET.get('date'), '00:00')
+
+    if not doctor_id or not doctor_id.isdigit() or not slot_date:
         return JsonResponse({'slots': []})
-    
-    # Get all possible time slots
-    all_slots = [
-        '08:00', '08:30', '09:00', '09:30', '10:00', '10:30', 
-        '11:00', '11:30', '12:00', '12:30', '13:00', '13:30', 
-        '14:00', '14:30', '15:00', '15:30', '16:00', '16:30'
-    ]
-    
-    # Get booked slots for this doctor on this date
-    booked_appointments = Appointment.objects.filter(
-        doctor_id=doctor_id,
-        appointment_date=date,
-        status__in=['scheduled', 'confirmed']
-    )
-    
-    # Exclude current appointment if editing
-    if appointment_id:
-        booked_appointments = booked_appointments.exclude(id=appointment_id)
-    
-    booked_slots = list(booked_appointments.values_list('appointment_time', flat=True))
-    booked_slots = [slot.strftime('%H:%M') if hasattr(slot, 'strftime') else str(slot) for slot in booked_slots]
-    
-    # Return available slots
-    available_slots = [slot for slot in all_slots if slot not in booked_slots]
-    
-    return JsonResponse({'slots': available_slots})
+    doctor_id, day = int(doctor_id), slot_date[0]
+
+    # The slot being edited stays selectable
+    editing = Appointment.objects.filter(id=appointment_id).first() if appointment_id else None
+
+    slots = AvailabilityService.free_slots([doctor_id], day, exclude=editing)[(doctor_id, day)]
+    return JsonResponse({'slots': [slot.strftime('%H:%M') for slot in slots]})
+
+
+@login_required
+def next_available_slot(request):
+    """
+    AJAX endpoint for the earliest open slot across several doctors, e.g.
+    ?specialization=Cardiology or ?doctor=3&doctor=7, optionally with &days=30
+    """
+    doctors = Doctor.objects.select_related('user').filter(is_available=True)
+    specialization = request.GET.get('specialization')
+    doctor_ids = [value for value in request.GET.getlist('doctor') if value.isdigit()]
+    if specialization:
+        doctors = doctors.filter(specialization__iexact=specialization)
+    if doctor_ids:
+        doctors = doctors.filter(pk__in=doctor_ids)
+    days = request.GET.get('days', '14')
+    days = min(int(days), 90) if days.isdigit() and int(days) > 0 else 14
+
+    doctors = {doctor.pk: doctor for doctor in doctors}
+    found = AvailabilityService.next_free_slot(list(doctors), days=days)
+    if found is None:
+        return JsonResponse({'slot': None})
+
+    doctor_id, day, slot = found
+    return JsonResponse({'slot': {
+        'doctor_id': doctor_id,
+        'doctor_name': doctors[doctor_id].user.get_full_name(),
+        'specialization': doctors[doctor_id].specialization,
+        'date': day.strftime('%Y-%m-%d'),
+        'time': slot.strftime('%H:%M'),
+    }})
 
 
 @login_required
@@ -556,8 +595,12 @@ def update_appointment_status(request, appointment_id, new_status):
 
 @require_GET
 def patient_appointments_api(request, patient_id):
-    """Returns all appointments for a given patient ID as JSON"""
-    appointments = Appointment.objects.select_related('doctor__user').filter(patient__patient_id=patient_id)
+    """Returns a patient's appointments as JSON, newest first, one cursor page at a time"""
+    appointments = paginate_json(
+        request,
+        Appointment.objects.select_related('doctor__user').filter(patient__patient_id=patient_id),
+        ['-appointment_date', '-appointment_time'],
+    )
 
     data = {
         'appointments': [
@@ -569,7 +612,9 @@ def patient_appointments_api(request, patient_id):
                 'doctor_name': appt.doctor.user.get_full_name(),
             }
             for appt in appointments
-        ]
+        ],
+        'next_cursor': appointments.next_cursor,
+        'previous_cursor': appointments.previous_cursor,
     }
 
     return JsonResponse(data)
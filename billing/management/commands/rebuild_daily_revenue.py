@@ -0,0 +1,33 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from billing.services import RevenueService
+
+
+class Command(BaseCommand):
+    help = 'Backfill the DailyRevenue rollup from Payment rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--date-from',
+            help='First day to rebuild (YYYY-MM-DD); defaults to the earliest payment'
+        )
+        parser.add_argument(
+            '--date-to',
+            help='Last day to rebuild (YYYY-MM-DD); defaults to the latest payment'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            date_from = self.parse_date(options['date_from'])
+            date_to = self.parse_date(options['date_to'])
+        except ValueError as e:
+            raise CommandError(f'Invalid date: {e}')
+
+        count = RevenueService.rebuild(date_from, date_to)
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {count} daily revenue rows'))
+
+    @staticmethod
+    def parse_date(value):
+        return datetime.strptime(value, '%Y-%m-%d').date() if value else None
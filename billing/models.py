@@ -53,6 +53,21 @@ class Bill(models.Model):
     notes = models.TextField(blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'created_at'], name='bill_status_created_idx'),
+            models.Index(fields=['patient', 'status'], name='bill_patient_status_idx'),
+            # Patient timeline (medical_records.services.PatientTimeline)
+            models.Index(fields=['patient', '-created_at'], name='bill_patient_created_idx'),
+            models.Index(fields=['created_at'], name='bill_created_idx'),
+        ]
+    
+    def save(self, *args, **kwargs):
+        if not self.bill_id:
+            from dashboard.sequences import IdAllocator
+            self.bill_id = IdAllocator.generate('BILL')
+        super().save(*args, **kwargs)
+    
     @property
     def balance_due(self):
         return self.total_amount - self.amount_paid
@@ -90,6 +105,12 @@ class Payment(models.Model):
     processed_by = models.ForeignKey(BillingStaff, on_delete=models.CASCADE)
     notes = models.TextField(blank=True)
     
+    class Meta:
+        indexes = [
+            models.Index(fields=['payment_date'], name='payment_date_idx'),
+            models.Index(fields=['payment_method', 'payment_date'], name='payment_method_date_idx'),
+        ]
+    
     # def save(self, *args, **kwargs):
     #     if not self.payment_id:
     #         super().save(*args, **kwargs) 
@@ -100,8 +121,23 @@ class Payment(models.Model):
     
     def __str__(self):
         return f"Payment {self.payment_id} - KES {self.amount}"
+
+class DailyRevenue(models.Model):
+    """Per-day, per-payment-method rollup of Payment rows, maintained by billing.signals."""
+    day = models.DateField()
+    payment_method = models.CharField(max_length=15, choices=Payment.PAYMENT_METHODS)
+    total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    payment_count = models.PositiveIntegerField(default=0)
+    
+    class Meta:
+        unique_together = ('day', 'payment_method')
+        ordering = ['day', 'payment_method']
+        verbose_name_plural = 'Daily Revenue'
+    
+    def __str__(self):
+        return f"{self.day} {self.get_payment_method_display()} - KES {self.total}"
     
 model_admin = [
     ServiceType, Bill,
-    BillItem, Payment
+    BillItem, Payment, DailyRevenue
 ]
\ No newline at end of file
@@ -0,0 +1,305 @@
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import Bill, BillItem, DailyRevenue, Payment, ServiceType
+from .utils import generate_payment_id_uuid
+
+
+def parse_bill_items(data):
+    """
+    Read the parallel service[]/quantity[]/unit_price[]/description[] lists posted by the
+    create/edit bill forms into a list of line dicts, skipping incomplete rows.
+    """
+    services = data.getlist('service[]')
+    quantities = data.getlist('quantity[]')
+    unit_prices = data.getlist('unit_price[]')
+    descriptions = data.getlist('description[]')
+
+    lines = []
+    for i in range(len(services)):
+        quantity = quantities[i] if i < len(quantities) else ''
+        unit_price = unit_prices[i] if i < len(unit_prices) else ''
+        if services[i] and quantity and unit_price:
+            lines.append({
+                'service_id': int(services[i]),
+                'quantity': int(quantity),
+                'unit_price': Decimal(unit_price),
+                'description': descriptions[i] if i < len(descriptions) else '',
+            })
+    return lines
+
+
+class BillError(Exception):
+    """Raised when a bill cannot be edited."""
+
+
+class BillService:
+    """Writes a bill and its line items in a fixed number of queries, inside one transaction."""
+
+    EDITABLE_STATUSES = ('pending', 'partial', 'overdue')
+
+    @staticmethod
+    def build_items(lines):
+        """Turn parsed lines into unsaved BillItems, loading every ServiceType in one query."""
+        service_types = ServiceType.objects.in_bulk({line['service_id'] for line in lines})
+        items = []
+        for line in lines:
+            service = service_types.get(line['service_id'])
+            if service is None:
+                raise ValueError(f"Service type {line['service_id']} does not exist")
+            items.append(BillItem(
+                service_type=service,
+                description=line['description'] or service.name,
+                quantity=line['quantity'],
+                unit_price=line['unit_price'],
+                # bulk_create skips BillItem.save(), so compute the line total here
+                total_price=line['quantity'] * line['unit_price'],
+            ))
+        return items
+
+    @classmethod
+    def create_bill(cls, patient, created_by, due_date, lines, appointment=None, notes=''):
+        items = cls.build_items(lines)
+        with transaction.atomic():
+            bill = Bill.objects.create(
+                patient=patient,
+                appointment=appointment,
+                due_date=due_date,
+                created_by=created_by,
+                notes=notes,
+                total_amount=sum((item.total_price for item in items), Decimal('0')),
+            )
+            for item in items:
+                item.bill = bill
+            BillItem.objects.bulk_create(items)
+        return bill
+
+    @classmethod
+    def update_bill(cls, bill, due_date, notes, lines):
+        """
+        Replace a bill's lines by diffing against what is stored: unchanged lines are kept,
+        changed ones are rewritten in place and only the surplus is inserted or deleted.
+
+        The status and amount paid are checked on the locked row, so a payment or
+        cancellation that committed after the edit form was loaded is not overwritten.
+        A total below the amount already paid is rejected; one equal to it settles the bill.
+        """
+        items = cls.build_items(lines)
+        total_amount = sum((item.total_price for item in items), Decimal('0'))
+        with transaction.atomic():
+            bill = Bill.objects.select_for_update().get(pk=bill.pk)
+            if bill.status not in cls.EDITABLE_STATUSES:
+                raise BillError('Cannot edit a paid or cancelled bill.')
+            if total_amount < bill.amount_paid:
+                raise BillError(
+                    f'The bill total cannot be less than the KSh {bill.amount_paid:,.2f} already paid.'
+                )
+            existing = list(bill.items.all())
+
+            def signature(item):
+                return (item.service_type_id, item.description, item.quantity, item.unit_price)
+
+            unchanged = defaultdict(list)
+            for item in existing:
+                unchanged[signature(item)].append(item)
+            to_write = []
+            for item in items:
+                matches = unchanged.get(signature(item))
+                if matches:
+                    matches.pop()
+                else:
+                    to_write.append(item)
+            leftovers = [item for group in unchanged.values() for item in group]
+
+            # Reuse leftover rows for changed lines before creating or deleting anything
+            to_update = []
+            for old, new in zip(leftovers, to_write):
+                old.service_type = new.service_type
+                old.description = new.description
+                old.quantity = new.quantity
+                old.unit_price = new.unit_price
+                old.total_price = new.total_price
+                to_update.append(old)
+            if to_update:
+                BillItem.objects.bulk_update(
+                    to_update, ['service_type', 'description', 'quantity', 'unit_price', 'total_price']
+                )
+            to_create = to_write[len(to_update):]
+            for item in to_create:
+                item.bill = bill
+            if to_create:
+                BillItem.objects.bulk_create(to_create)
+            to_delete = leftovers[len(to_update):]
+            if to_delete:
+                BillItem.objects.filter(pk__in=[item.pk for item in to_delete]).delete()
+
+            bill.due_date = due_date
+            bill.notes = notes
+            bill.total_amount = total_amount
+            if bill.amount_paid and bill.amount_paid >= total_amount:
+                bill.status = 'paid'
+            bill.save(update_fields=['due_date', 'notes', 'total_amount', 'status'])
+        return bill
+
+
+class PaymentError(Exception):
+    """Raised when a payment cannot be posted against a bill."""
+
+
+class PaymentService:
+    """Single entry point for posting payments, shared by process_payment and quick_payment_api."""
+
+    PAYABLE_STATUSES = ('pending', 'partial', 'overdue')
+
+    @classmethod
+    def post_payment(cls, bill, amount, payment_method, processed_by, transaction_reference='', notes=''):
+        """
+        Record a payment and move amount_paid/status in the same transaction.
+
+        The bill is re-read with select_for_update and the balance check is done on
+        Decimals in Python (SQLite would compare the columns as floats and reject paying
+        off an exact balance like 0.30 - 0.10). The row lock, or on SQLite the write lock
+        the IMMEDIATE transaction takes up front, holds off a second cashier until this
+        payment commits, so concurrent payments never overpay or lose a write; the loser
+        gets a PaymentError. Returns (payment, bill).
+        """
+        amount = Decimal(str(amount))
+        if amount <= 0:
+            raise PaymentError('Payment amount must be greater than zero.')
+
+        with transaction.atomic():
+            bill = Bill.objects.select_for_update().get(pk=bill.pk)
+            if bill.status not in cls.PAYABLE_STATUSES or bill.balance_due <= 0:
+                raise PaymentError('This bill is already fully paid or closed.')
+            if amount > bill.balance_due:
+                raise PaymentError(
+                    f'Payment amount cannot exceed the outstanding balance of KSh {bill.balance_due:,.2f}.'
+                )
+            bill.amount_paid += amount
+            bill.status = 'paid' if bill.amount_paid >= bill.total_amount else 'partial'
+            bill.save(update_fields=['amount_paid', 'status'])
+
+            payment = Payment.objects.create(
+                payment_id=generate_payment_id_uuid(),
+                bill=bill,
+                amount=amount,
+                payment_method=payment_method,
+                transaction_reference=transaction_reference,
+                processed_by=processed_by,
+                notes=notes,
+            )
+        return payment, bill
+
+
+class RevenueService:
+    """
+    Reads and maintains the DailyRevenue rollup so revenue widgets scan O(days) rows
+    instead of every Payment in the range.
+    """
+
+    @staticmethod
+    def apply(day, payment_method, amount, count):
+        """
+        Add ``amount`` and ``count`` (negative to take payments out) to one day/method
+        bucket. The bucket is locked and summed as Decimals in Python: SQLite would
+        evaluate total + amount as a float and let the rollup drift by fractions of a cent.
+        """
+        amount = Decimal(str(amount))
+        buckets = DailyRevenue.objects.select_for_update().filter(day=day, payment_method=payment_method)
+        with transaction.atomic():
+            bucket = buckets.first()
+            if bucket is None:
+                if count < 0:
+                    return
+                try:
+                    with transaction.atomic():
+                        DailyRevenue.objects.create(
+                            day=day, payment_method=payment_method, total=amount, payment_count=count
+                        )
+                    return
+                except IntegrityError:
+                    # Another request opened the bucket first
+                    bucket = buckets.get()
+            bucket.total += amount
+            bucket.payment_count = max(0, bucket.payment_count + count)
+            bucket.save(update_fields=['total', 'payment_count'])
+
+    @classmethod
+    def record_payment(cls, payment, sign=1):
+        """Fold one payment into its day/method bucket (sign=-1 when a payment is deleted)."""
+        cls.apply(timezone.localdate(payment.payment_date), payment.payment_method, payment.amount * sign, sign)
+
+    @classmethod
+    def record_change(cls, before, after):
+        """Move an edited payment between buckets; each side is (payment_date, payment_method, amount)."""
+        if before == after:
+            return
+        with transaction.atomic():
+            cls.apply(timezone.localdate(before[0]), before[1], -Decimal(str(before[2])), -1)
+            cls.apply(timezone.localdate(after[0]), after[1], after[2], 1)
+
+    @staticmethod
+    def day_range(date_from, date_to):
+        """
+        Aware [start, end) datetimes covering the local days date_from..date_to, so
+        datetime columns are filtered by range on their index rather than by __date.
+        """
+        return (
+            timezone.make_aware(datetime.combine(date_from, time())),
+            timezone.make_aware(datetime.combine(date_to + timedelta(days=1), time())),
+        )
+
+    @classmethod
+    def payments(cls, date_from, date_to):
+        start, end = cls.day_range(date_from, date_to)
+        return Payment.objects.filter(payment_date__gte=start, payment_date__lt=end)
+
+    @staticmethod
+    def rollups(date_from, date_to):
+        return DailyRevenue.objects.filter(day__gte=date_from, day__lte=date_to)
+
+    @classmethod
+    def total(cls, date_from, date_to=None):
+        return cls.rollups(date_from, date_to or date_from).aggregate(
+            total=Sum('total')
+        )['total'] or 0
+
+    @classmethod
+    def by_method(cls, date_from, date_to):
+        labels = dict(Payment.PAYMENT_METHODS)
+        rows = cls.rollups(date_from, date_to).values('payment_method').annotate(
+            total=Sum('total'), count=Sum('payment_count')
+        ).order_by('-total')
+        return [dict(row, label=labels.get(row['payment_method'], row['payment_method'])) for row in rows]
+
+    @classmethod
+    def daily(cls, date_from, date_to):
+        """[{'day': 'YYYY-MM-DD', 'total': float}, ...] ready for the revenue charts."""
+        rows = cls.rollups(date_from, date_to).values('day').annotate(total=Sum('total')).order_by('day')
+        return [{'day': row['day'].isoformat(), 'total': float(row['total'])} for row in rows]
+
+    @classmethod
+    def rebuild(cls, date_from=None, date_to=None):
+        """Recompute the rollup from Payment rows, optionally limited to a date range."""
+        payments = Payment.objects.all()
+        rollups = DailyRevenue.objects.all()
+        if date_from:
+            payments = payments.filter(payment_date__gte=cls.day_range(date_from, date_from)[0])
+            rollups = rollups.filter(day__gte=date_from)
+        if date_to:
+            payments = payments.filter(payment_date__lt=cls.day_range(date_to, date_to)[1])
+            rollups = rollups.filter(day__lte=date_to)
+
+        rows = payments.annotate(day=TruncDate('payment_date')).values('day', 'payment_method').annotate(
+            total=Sum('amount'), payment_count=Count('pk')
+        ).order_by()
+        with transaction.atomic():
+            rollups.delete()
+            created = DailyRevenue.objects.bulk_create(DailyRevenue(**row) for row in rows)
+        return len(created)
@@ -0,0 +1,32 @@
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Payment
+from .services import RevenueService
+
+
+def _revenue_key(values):
+    """(payment_date, payment_method, amount) of a payment, or None while any is unset or deferred."""
+    key = (values.get('payment_date'), values.get('payment_method'), values.get('amount'))
+    return None if None in key else key
+
+
+@receiver(post_init, sender=Payment)
+def remember_loaded_revenue(sender, instance, **kwargs):
+    # Snapshot what the rollup was fed so an edit can be moved between buckets
+    # (read from __dict__ so deferred fields don't trigger a query)
+    instance._loaded_revenue = _revenue_key(instance.__dict__)
+
+
+@receiver(post_save, sender=Payment)
+def add_payment_to_daily_revenue(sender, instance, created, **kwargs):
+    if created:
+        RevenueService.record_payment(instance)
+    elif instance._loaded_revenue is not None:
+        RevenueService.record_change(instance._loaded_revenue, _revenue_key(instance.__dict__))
+    instance._loaded_revenue = _revenue_key(instance.__dict__)
+
+
+@receiver(post_delete, sender=Payment)
+def remove_payment_from_daily_revenue(sender, instance, **kwargs):
+    RevenueService.record_payment(instance, sign=-1)
@@ -1,3 +1,205 @@
-from django.test import TestCase
+import threading
+from datetime import date
+from decimal import Decimal
 
-# Create your tests here.
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+
+from accounts.models import User
+from patients.models import Patient
+from .models import Bill, BillingStaff, DailyRevenue, Payment, ServiceType
+from .services import BillError, BillService, PaymentError, PaymentService, RevenueService
+
+
+def make_bill(total_amount, amount_paid='0', status='pending'):
+    staff = BillingStaff.objects.get(user=User.objects.create_user(
+        email=f'billing{User.objects.count()}@example.com', role='billing_staff',
+    ))
+    patient = Patient.objects.get(user=User.objects.create_user(
+        email=f'patient{User.objects.count()}@example.com', role='patient',
+    ))
+    bill = Bill.objects.create(
+        patient=patient, created_by=staff, due_date=date.today(), status=status,
+        total_amount=Decimal(total_amount), amount_paid=Decimal(amount_paid),
+    )
+    return bill, staff
+
+
+class PaymentServiceTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_paying_the_exact_balance_settles_the_bill(self):
+        for total, paid, amount in [('0.30', '0.10', '0.20'), ('100.30', '50.10', '50.20')]:
+            bill, staff = make_bill(total, paid, status='partial')
+            payment, bill = PaymentService.post_payment(bill, Decimal(amount), 'cash', staff)
+            self.assertEqual(bill.amount_paid, Decimal(total))
+            self.assertEqual(bill.balance_due, Decimal('0'))
+            self.assertEqual(bill.status, 'paid')
+            self.assertEqual(payment.amount, Decimal(amount))
+
+    def test_partial_payment(self):
+        bill, staff = make_bill('100.00')
+        _, bill = PaymentService.post_payment(bill, Decimal('40.00'), 'cash', staff)
+        self.assertEqual(bill.status, 'partial')
+        self.assertEqual(Bill.objects.get(pk=bill.pk).amount_paid, Decimal('40.00'))
+
+    def test_overpayment_and_closed_bills_are_rejected(self):
+        bill, staff = make_bill('100.30', '50.10', status='partial')
+        with self.assertRaisesMessage(PaymentError, 'outstanding balance of KSh 50.20'):
+            PaymentService.post_payment(bill, Decimal('50.21'), 'cash', staff)
+        paid, staff = make_bill('10.00', '10.00', status='paid')
+        with self.assertRaises(PaymentError):
+            PaymentService.post_payment(paid, Decimal('1.00'), 'cash', staff)
+        with self.assertRaises(PaymentError):
+            PaymentService.post_payment(bill, Decimal('0'), 'cash', staff)
+        self.assertFalse(Payment.objects.exists())
+
+
+class BillServiceTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.service = ServiceType.objects.create(name='Consultation', base_price=Decimal('500.00'))
+
+    def lines(self, count, quantity=1, unit_price='10.00'):
+        return [
+            {'service_id': self.service.pk, 'quantity': quantity, 'unit_price': Decimal(unit_price),
+             'description': f'Line {i}'}
+            for i in range(count)
+        ]
+
+    def test_edit_rechecks_the_locked_status(self):
+        bill, _ = make_bill('100.00')
+        # Paid or cancelled after the edit form was loaded
+        Bill.objects.filter(pk=bill.pk).update(status='cancelled')
+        with self.assertRaisesMessage(BillError, 'paid or cancelled'):
+            BillService.update_bill(bill, date.today(), '', self.lines(1))
+        self.assertEqual(Bill.objects.get(pk=bill.pk).total_amount, Decimal('100.00'))
+
+    def test_total_below_the_amount_paid_is_rejected(self):
+        bill, _ = make_bill('100.00', '40.00', status='partial')
+        with self.assertRaisesMessage(BillError, 'KSh 40.00 already paid'):
+            BillService.update_bill(bill, date.today(), '', self.lines(3))
+        bill = BillService.update_bill(bill, date.today(), '', self.lines(4))
+        self.assertEqual((bill.total_amount, bill.status), (Decimal('40.00'), 'paid'))
+        self.assertEqual(Bill.objects.get(pk=bill.pk).status, 'paid')
+
+    def test_edit_query_count_does_not_grow_with_the_lines(self):
+        def edit_queries(count):
+            bill, staff = make_bill('0')
+            bill = BillService.create_bill(bill.patient, staff, date.today(), self.lines(count))
+            # Half the lines kept, half changed, plus one added
+            lines = self.lines(count)[:count // 2] + self.lines(count - count // 2 + 1, quantity=2)
+            for i, line in enumerate(lines):
+                line['description'] = f'Line {i}'
+            with CaptureQueriesContext(connection) as queries:
+                bill = BillService.update_bill(bill, date.today(), '', lines)
+            self.assertEqual(bill.items.count(), count + 1)
+            return len(queries)
+
+        self.assertEqual(edit_queries(60), edit_queries(4))
+
+
+class DailyRevenueRollupTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.bill, self.staff = make_bill('1000.00')
+
+    def pay(self, payment_id, amount, method='cash'):
+        return Payment.objects.create(
+            payment_id=payment_id, bill=self.bill, amount=Decimal(amount),
+            payment_method=method, processed_by=self.staff,
+        )
+
+    def buckets(self):
+        return {
+            row.payment_method: (row.total, row.payment_count)
+            for row in DailyRevenue.objects.all()
+        }
+
+    def test_cents_sum_exactly(self):
+        for i in range(100):
+            self.pay(f'PAY{i}', '0.10')
+        self.assertEqual(self.buckets(), {'cash': (Decimal('10.00'), 100)})
+
+    def test_edits_and_deletes_move_the_payment(self):
+        payment = self.pay('PAY1', '0.10')
+        self.pay('PAY2', '0.20')
+        payment = Payment.objects.get(pk=payment.pk)
+        payment.amount = Decimal('5.25')
+        payment.payment_method = 'card'
+        payment.save()
+        self.assertEqual(self.buckets(), {'cash': (Decimal('0.20'), 1), 'card': (Decimal('5.25'), 1)})
+        Payment.objects.get(pk='PAY2').delete()
+        self.assertEqual(self.buckets(), {'cash': (Decimal('0.00'), 0), 'card': (Decimal('5.25'), 1)})
+
+    def test_rebuild_matches_incremental_totals(self):
+        for i, method in enumerate(['cash', 'card', 'cash']):
+            self.pay(f'PAY{i}', '0.10', method)
+        before = self.buckets()
+        RevenueService.rebuild()
+        self.assertEqual(self.buckets(), before)
+        today = date.today()
+        self.assertEqual(RevenueService.total(today), Decimal('0.30'))
+        self.assertEqual(RevenueService.payments(today, today).count(), 3)
+
+
+class PaymentConcurrencyTests(TransactionTestCase):
+    """Many cashiers paying one bill at once never overpay it or lose a payment."""
+
+    THREADS = 20
+
+    def setUp(self):
+        cache.clear()
+
+    def _pay_concurrently(self, bill, staff, amount):
+        barrier = threading.Barrier(self.THREADS)
+        outcomes = []
+        lock = threading.Lock()
+
+        def pay():
+            try:
+                barrier.wait()
+                PaymentService.post_payment(bill, amount, 'cash', staff)
+                outcome = 'paid'
+            except PaymentError:
+                outcome = 'rejected'
+            except Exception as exc:
+                outcome = exc
+            finally:
+                connection.close()
+            with lock:
+                outcomes.append(outcome)
+
+        threads = [threading.Thread(target=pay) for _ in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return outcomes
+
+    def test_concurrent_payments_stop_at_the_total(self):
+        bill, staff = make_bill('11.00')
+        outcomes = self._pay_concurrently(bill, staff, Decimal('1.10'))
+
+        self.assertEqual(sorted(outcomes, key=str), ['paid'] * 10 + ['rejected'] * 10)
+        bill.refresh_from_db()
+        self.assertEqual(bill.amount_paid, Decimal('11.00'))
+        self.assertEqual(bill.status, 'paid')
+        self.assertEqual(Payment.objects.filter(bill=bill).count(), 10)
+
+    def test_only_one_of_many_full_balance_payments_succeeds(self):
+        bill, staff = make_bill('100.30', '50.10', status='partial')
+        outcomes = self._pay_concurrently(bill, staff, Decimal('50.20'))
+
+        self.assertEqual(outcomes.count('paid'), 1, outcomes)
+        self.assertEqual(outcomes.count('rejected'), self.THREADS - 1)
+        bill.refresh_from_db()
+        self.assertEqual(bill.amount_paid, Decimal('100.30'))
+        self.assertEqual(bill.status, 'paid')
+        self.assertEqual(Payment.objects.filter(bill=bill).count(), 1)
@@ -10,12 +10,14 @@ urlpatterns = [
     # Bills Management
     path('bills/', views.bill_list, name='bill_list'),
     path('bills/create/', views.create_bill, name='create_bill'),
+    path('bills/export/', views.bill_export, name='bill_export'),
     path('bills/<str:bill_id>/', views.bill_detail, name='bill_detail'),
     path('bills/<str:bill_id>/edit/', views.edit_bill, name='edit_bill'),
     path('bills/<str:bill_id>/print/', views.print_bill, name='print_bill'),
     
     # Payments
     path('payments/', views.payment_list, name='payment_list'),
+    path('payments/export/', views.payment_export, name='payment_export'),
     path('payments/process/<str:bill_id>/', views.process_payment, name='process_payment'),
     path('payments/<str:payment_id>/', views.payment_detail, name='payment_detail'),
     
@@ -4,26 +4,66 @@ from datetime import datetime, timedelta, date
 from django.contrib import messages
 from django.http import JsonResponse, HttpResponse
 from django.core.paginator import Paginator
-from django.db.models import Q, Sum, Count
+from django.db.models import Q, Sum
 from django.db import transaction
 from django.utils import timezone
+from django.utils.dateparse import parse_date
 from django.template.loader import render_to_string
 from decimal import Decimal
 import json
 from django.views.decorators.http import require_http_methods
 
-from .utils import generate_payment_id_uuid
+from .services import BillService, PaymentService, PaymentError, RevenueService, parse_bill_items
 from .models import Bill, BillItem, Payment, ServiceType, BillingStaff
 from patients.models import Patient
+from patients.services import PatientSearchIndex
 from appointments.models import Appointment
+from dashboard.exports import Column, choice_label, streaming_export
+from dashboard.pagination import CursorPaginator, paginate_json
+
+def filter_bills(bills, params):
+    """Apply the bill list filters (status, patient, date_from, date_to) from a QueryDict"""
+    status = params.get('status')
+    patient_search = params.get('patient')
+    date_from = params.get('date_from')
+    date_to = params.get('date_to')
+
+    if status:
+        bills = bills.filter(status=status)
+    if patient_search:
+        bills = bills.filter(patient__in=PatientSearchIndex.matching(patient_search))
+    if date_from:
+        bills = bills.filter(issue_date__gte=date_from)
+    if date_to:
+        bills = bills.filter(issue_date__lte=date_to)
+    return bills
+
+
+def filter_payments(payments, params):
+    """Apply the payment list filters (patient, payment_method, date_from, date_to) from a QueryDict"""
+    patient_search = params.get('patient')
+    payment_method = params.get('payment_method')
+    date_from = parse_date(params.get('date_from') or '')
+    date_to = parse_date(params.get('date_to') or '')
+
+    if patient_search:
+        payments = payments.filter(bill__patient__in=PatientSearchIndex.matching(patient_search))
+    if payment_method:
+        payments = payments.filter(payment_method=payment_method)
+    # Whole local days as datetime ranges, so payment_date_idx serves the filter
+    if date_from:
+        payments = payments.filter(payment_date__gte=RevenueService.day_range(date_from, date_from)[0])
+    if date_to:
+        payments = payments.filter(payment_date__lt=RevenueService.day_range(date_to, date_to)[1])
+    return payments
+
 
 @login_required
 def billing_dashboard(request):
     """Billing dashboard with key metrics"""
+    today = timezone.localdate()
     context = {
-        'total_revenue_today': Payment.objects.filter(
-            payment_date__date=timezone.now().date()
-        ).aggregate(total=Sum('amount'))['total'] or 0,
+        'total_revenue_today': RevenueService.total(today),
         
         'pending_bills_count': Bill.objects.filter(status='pending').count(),
         'overdue_bills_count': Bill.objects.filter(
@@ -38,40 +78,23 @@ def billing_dashboard(request):
                                 .filter(status='pending')
                                 .order_by('-created_at')[:10],
         
-        'revenue_this_month': Payment.objects.filter(
-            payment_date__month=timezone.now().month,
-            payment_date__year=timezone.now().year
-        ).aggregate(total=Sum('amount'))['total'] or 0,
+        'revenue_this_month': RevenueService.total(today.replace(day=1), today),
     }
     return render(request, 'billing/dashboard.html', context)
 
 @login_required
 def bill_list(request):
     """List all bills with filtering options"""
-    bills = Bill.objects.select_related('patient__user').order_by('-created_at')
-    
-    # Filtering
+    bills = filter_bills(
+        Bill.objects.select_related('patient__user').order_by('-created_at'), request.GET
+    )
     status = request.GET.get('status')
     patient_search = request.GET.get('patient')
     date_from = request.GET.get('date_from')
     date_to = request.GET.get('date_to')
     
-    if status:
-        bills = bills.filter(status=status)
-    if patient_search:
-        bills = bills.filter(
-            Q(patient__user__first_name__icontains=patient_search) |
-            Q(patient__user__last_name__icontains=patient_search) |
-            Q(patient__patient_id__icontains=patient_search)
-        )
-    if date_from:
-        bills = bills.filter(issue_date__gte=date_from)
-    if date_to:
-        bills = bills.filter(issue_date__lte=date_to)
-    
-    paginator = Paginator(bills, 20)
-    page_number = request.GET.get('page')
-    bills = paginator.get_page(page_number)
+    paginator = CursorPaginator(bills, 20, ['-created_at'], estimate_count=True)
+    bills = paginator.get_page(request.GET.get('cursor'))
     
     context = {
         'bills': bills,
@@ -101,50 +124,19 @@ def create_bill(request):
             if appointment_id:
                 appointment = get_object_or_404(Appointment, id=appointment_id)
             
-            # Generate bill ID
-            bill_id = f"BILL{timezone.now().strftime('%Y%m%d')}{Bill.objects.count() + 1:04d}"
-            
             # Get billing staff
             billing_staff = BillingStaff.objects.get(user=request.user)
             
-            # Create bill
-            bill = Bill.objects.create(
-                bill_id=bill_id,
+            # Create bill and its items in one transaction
+            bill = BillService.create_bill(
                 patient=patient,
-                appointment=appointment,
-                due_date=due_date,
                 created_by=billing_staff,
-                notes=notes
+                due_date=due_date,
+                lines=parse_bill_items(request.POST),
+                appointment=appointment,
+                notes=notes,
             )
             
-            # Process bill items
-            services = request.POST.getlist('service[]')
-            quantities = request.POST.getlist('quantity[]')
-            unit_prices = request.POST.getlist('unit_price[]')
-            descriptions = request.POST.getlist('description[]')
-            
-            total_amount = Decimal('0')
-            for i in range(len(services)):
-                if services[i] and quantities[i] and unit_prices[i]:
-                    service = get_object_or_404(ServiceType, id=services[i])
-                    quantity = int(quantities[i])
-                    unit_price = Decimal(unit_prices[i])
-                    description = descriptions[i] if i < len(descriptions) else ''
-                    
-                    bill_item = BillItem.objects.create(
-                        bill=bill,
-                        service_type=service,
-                        description=description or service.name,
-                        quantity=quantity,
-                        unit_price=unit_price,
-                        total_price=quantity * unit_price
-                    )
-                    total_amount += bill_item.total_price
-            
-            # Update bill total
-            bill.total_amount = total_amount
-            bill.save()
-            
             messages.success(request, f'Bill {bill.bill_id} created successfully!')
             return redirect('billing:bill_detail', bill_id=bill.bill_id)
             
@@ -190,41 +182,25 @@ def process_payment(request, bill_id):
             transaction_reference = request.POST.get('transaction_reference', '')
             notes = request.POST.get('notes', '')
             
-            if amount <= 0:
-                messages.error(request, 'Payment amount must be greater than zero.')
-                return redirect('billing:bill_detail', bill_id=bill_id)
-            
-            if amount > bill.balance_due:
-                messages.error(request, 'Payment amount cannot exceed the outstanding balance.')
-                return redirect('billing:bill_detail', bill_id=bill_id)
-            
-            # Generate payment ID
-            
             # Get billing staff
             billing_staff = BillingStaff.objects.get(user=request.user)
             
-            # Create payment
-            Payment.objects.create(
-                payment_id = generate_payment_id_uuid(),
-                bill=bill,
+            # Post payment; balance check, amount_paid and status move atomically
+            PaymentService.post_payment(
+                bill,
                 amount=amount,
                 payment_method=payment_method,
-                transaction_reference=transaction_reference,
                 processed_by=billing_staff,
-                notes=notes
+                transaction_reference=transaction_reference,
+                notes=notes,
             )
             
-            # Update bill status and amount paid
-            bill.amount_paid += amount
-            if bill.amount_paid >= bill.total_amount:
-                bill.status = 'paid'
-            elif bill.amount_paid > 0:
-                bill.status = 'partial'
-            bill.save()
-            
             messages.success(request, f'Payment of KSh {amount:,.2f} processed successfully!')
             return redirect('billing:bill_detail', bill_id=bill_id)
             
+        except PaymentError as e:
+            messages.error(request, str(e))
+            return redirect('billing:bill_detail', bill_id=bill_id)
         except Exception as e:
             messages.error(request, f'Error processing payment: {str(e)}')
     
@@ -238,7 +214,7 @@ def process_payment(request, bill_id):
 def get_patient_bills(request, patient_id):
     """API endpoint to get patient bills"""
     patient = get_object_or_404(Patient, patient_id=patient_id)
-    bills = Bill.objects.filter(patient=patient).order_by('-created_at')
+    bills = paginate_json(request, Bill.objects.filter(patient=patient), ['-created_at'])
     
     bills_data = []
     for bill in bills:
@@ -252,7 +228,11 @@ def get_patient_bills(request, patient_id):
             'due_date': bill.due_date.strftime('%Y-%m-%d'),
         })
     
-    return JsonResponse({'bills': bills_data})
+    return JsonResponse({
+        'bills': bills_data,
+        'next_cursor': bills.next_cursor,
+        'previous_cursor': bills.previous_cursor,
+    })
 
 @login_required
 def edit_bill(request, bill_id):
@@ -266,40 +246,13 @@ def edit_bill(request, bill_id):
     
     if request.method == 'POST':
         try:
-            # Update bill details
-            bill.due_date = request.POST.get('due_date')
-            bill.notes = request.POST.get('notes', '')
-            
-            # Clear existing bill items
-            BillItem.objects.filter(bill=bill).delete()
-            
-            # Process new bill items
-            services = request.POST.getlist('service[]')
-            quantities = request.POST.getlist('quantity[]')
-            unit_prices = request.POST.getlist('unit_price[]')
-            descriptions = request.POST.getlist('description[]')
-            
-            total_amount = Decimal('0')
-            for i in range(len(services)):
-                if services[i] and quantities[i] and unit_prices[i]:
-                    service = get_object_or_404(ServiceType, id=services[i])
-                    quantity = int(quantities[i])
-                    unit_price = Decimal(unit_prices[i])
-                    description = descriptions[i] if i < len(descriptions) else ''
-                    
-                    bill_item = BillItem.objects.create(
-                        bill=bill,
-                        service_type=service,
-                        description=description or service.name,
-                        quantity=quantity,
-                        unit_price=unit_price,
-                        total_price=quantity * unit_price
-                    )
-                    total_amount += bill_item.total_price
-            
-            # Update bill total
-            bill.total_amount = total_amount
-            bill.save()
+            # Diff the posted lines against the stored items and update the total atomically
+            bill = BillService.update_bill(
+                bill,
+                due_date=request.POST.get('due_date'),
+                notes=request.POST.get('notes', ''),
+                lines=parse_bill_items(request.POST),
+            )
             
             messages.success(request, f'Bill {bill.bill_id} updated successfully!')
             return redirect('billing:bill_detail', bill_id=bill.bill_id)
@@ -336,34 +289,19 @@ def print_bill(request, bill_id):
 @login_required
 def payment_list(request):
     """List all payments with filtering"""
-    payments = Payment.objects.select_related(
-        'bill__patient__user', 'processed_by__user'
-    ).order_by('-payment_date')
-    
-    # Filtering
+    payments = filter_payments(
+        Payment.objects.select_related(
+            'bill__patient__user', 'processed_by__user'
+        ).order_by('-payment_date'),
+        request.GET
+    )
     patient_search = request.GET.get('patient')
     payment_method = request.GET.get('payment_method')
     date_from = request.GET.get('date_from')
     date_to = request.GET.get('date_to')
     
-    if patient_search:
-        payments = payments.filter(
-            Q(bill__patient__user__first_name__icontains=patient_search) |
-            Q(bill__patient__user__last_name__icontains=patient_search) |
-            Q(bill__patient__patient_id__icontains=patient_search)
-        )
-    
-    if payment_method:
-        payments = payments.filter(payment_method=payment_method)
-    
-    if date_from:
-        payments = payments.filter(payment_date__date__gte=date_from)
-    if date_to:
-        payments = payments.filter(payment_date__date__lte=date_to)
-    
-    paginator = Paginator(payments, 25)
-    page_number = request.GET.get('page')
-    payments = paginator.get_page(page_number)
+    paginator = CursorPaginator(payments, 25, ['-payment_date'], estimate_count=True)
+    payments = paginator.get_page(request.GET.get('cursor'))
     
     context = {
         'payments': payments,
@@ -377,6 +315,51 @@ def payment_list(request):
     }
     return render(request, 'billing/payment_list.html', context)
 
+
+@login_required
+def bill_export(request):
+    """Stream the filtered bill list as CSV, NDJSON or XLSX (?format=)"""
+    if not request.user.has_module_permission('billing'):
+        messages.error(request, "You don't have permission to export billing data.")
+        return redirect('dashboard:dashboard')
+
+    columns = [
+        Column('Bill ID', 'bill_id'),
+        Column('Patient ID', 'patient__patient_id'),
+        Column('First Name', 'patient__user__first_name'),
+        Column('Last Name', 'patient__user__last_name'),
+        Column('Total Amount', 'total_amount'),
+        Column('Amount Paid', 'amount_paid'),
+        Column('Status', 'status', choice_label(Bill.BILL_STATUS)),
+        Column('Issue Date', 'issue_date'),
+        Column('Due Date', 'due_date'),
+        Column('Created At', 'created_at'),
+    ]
+    bills = filter_bills(Bill.objects.order_by('-created_at'), request.GET)
+    return streaming_export(bills, columns, 'bills_export', request.GET.get('format', 'csv'))
+
+
+@login_required
+def payment_export(request):
+    """Stream the filtered payment list as CSV, NDJSON or XLSX (?format=)"""
+    if not request.user.has_module_permission('billing'):
+        messages.error(request, "You don't have permission to export billing data.")
+        return redirect('dashboard:dashboard')
+
+    columns = [
+        Column('Payment ID', 'payment_id'),
+        Column('Bill ID', 'bill_id'),
+        Column('Patient ID', 'bill__patient__patient_id'),
+        Column('First Name', 'bill__patient__user__first_name'),
+        Column('Last Name', 'bill__patient__user__last_name'),
+        Column('Amount', 'amount'),
+        Column('Payment Method', 'payment_method', choice_label(Payment.PAYMENT_METHODS)),
+        Column('Transaction Reference', 'transaction_reference'),
+        Column('Payment Date', 'payment_date'),
+    ]
+    payments = filter_payments(Payment.objects.order_by('-payment_date'), request.GET)
+    return streaming_export(payments, columns, 'payments_export', request.GET.get('format', 'csv'))
+
 @login_required
 def payment_detail(request, payment_id):
     """Display payment details"""
@@ -482,28 +465,14 @@ def billing_reports(request):
     else:
         date_to = datetime.strptime(date_to, '%Y-%m-%d').date()
     
-    # Revenue statistics
-    payments_in_range = Payment.objects.filter(
-        payment_date__date__gte=date_from,
-        payment_date__date__lte=date_to
-    )
-    
-    total_revenue = payments_in_range.aggregate(
-        total=Sum('amount')
-    )['total'] or 0
+    # Revenue statistics (read from the DailyRevenue rollup)
+    total_revenue = RevenueService.total(date_from, date_to)
     
     # Payment method breakdown
-    payment_methods = payments_in_range.values('payment_method').annotate(
-        total=Sum('amount'),
-        count=Count('bill_id')
-    ).order_by('-total')
+    payment_methods = RevenueService.by_method(date_from, date_to)
     
     # Daily revenue for chart
-    daily_revenue = payments_in_range.extra(
-        select={'day': 'date(payment_date)'}
-    ).values('day').annotate(
-        total=Sum('amount')
-    ).order_by('day')
+    daily_revenue = RevenueService.daily(date_from, date_to)
     
     # Outstanding bills
     outstanding_bills = Bill.objects.exclude(status__in=['paid', 'cancelled'])
@@ -516,7 +485,7 @@ def billing_reports(request):
         'date_to': date_to,
         'total_revenue': total_revenue,
         'payment_methods': payment_methods,
-        'daily_revenue': list(daily_revenue),
+        'daily_revenue': daily_revenue,
         'total_outstanding': total_outstanding,
         'outstanding_bills_count': outstanding_bills.count(),
     }
@@ -539,16 +508,17 @@ def revenue_report(request):
     else:
         date_to = datetime.strptime(date_to, '%Y-%m-%d').date()
     
-    # Detailed revenue breakdown
-    payments = Payment.objects.filter(
-        payment_date__date__gte=date_from,
-        payment_date__date__lte=date_to
-    ).select_related('bill__patient__user', 'processed_by__user')
+    # Totals come from the DailyRevenue rollup; the payment list reads the
+    # payment_date index by range
+    payments = RevenueService.payments(date_from, date_to).select_related(
+        'bill__patient__user', 'processed_by__user'
+    ).order_by('-payment_date')
     
     # Service-wise revenue
+    start, end = RevenueService.day_range(date_from, date_to)
     service_revenue = BillItem.objects.filter(
-        bill__created_at__date__gte=date_from,
-        bill__created_at__date__lte=date_to
+        bill__created_at__gte=start,
+        bill__created_at__lt=end
     ).values('service_type__name').annotate(
         total_revenue=Sum('total_price'),
         quantity_sold=Sum('quantity')
@@ -557,6 +527,8 @@ def revenue_report(request):
     context = {
         'date_from': date_from,
         'date_to': date_to,
+        'total_revenue': RevenueService.total(date_from, date_to),
+        'payment_methods': RevenueService.by_method(date_from, date_to),
         'payments': payments,
         'service_revenue': service_revenue,
     }
@@ -682,24 +654,6 @@ def quick_payment_api(request):
                 'error': 'Patient or Bill not found'
             }, status=404)
         
-        # Calculate current balance
-        paid_amount = bill.payments.aggregate(total=Sum('amount'))['total'] or Decimal('0')
-        current_balance = bill.total_amount - paid_amount
-        
-        # Validate payment amount against balance
-        if amount > current_balance:
-            return JsonResponse({
-                'success': False,
-                'error': f'Payment amount cannot exceed balance of KSh {current_balance:,.2f}'
-            }, status=400)
-        
-        # Check if bill is already fully paid
-        if current_balance <= 0:
-            return JsonResponse({
-                'success': False,
-                'error': 'This bill is already fully paid'
-            }, status=400)
-        
         # Get billing staff
         try:
             billing_staff = get_object_or_404(BillingStaff, user=request.user)
@@ -709,41 +663,30 @@ def quick_payment_api(request):
                 'error': 'User is not authorized to process payments'
             }, status=403)
         
-        
-        # Create payment record
-        payment = Payment.objects.create(
-            payment_id = generate_payment_id_uuid(),
-            bill=bill,
-            amount=amount,
-            payment_method=payment_method,
-            transaction_reference=transaction_ref,
-            processed_by=billing_staff,
-            payment_date=timezone.now().date()
-        )
-        
-        # Calculate new totals
-        new_paid_amount = paid_amount + amount
-        new_balance = bill.total_amount - new_paid_amount
-        
-        # Update bill status
-        if new_balance <= 0:
-            bill.status = 'paid'
-        elif paid_amount == 0:
-            bill.status = 'partial'
-        else:
-            bill.status = 'partial' 
-        
-        bill.save()
+        # Post payment; balance check, amount_paid and status move atomically
+        try:
+            payment, bill = PaymentService.post_payment(
+                bill,
+                amount=amount,
+                payment_method=payment_method,
+                processed_by=billing_staff,
+                transaction_reference=transaction_ref,
+            )
+        except PaymentError as e:
+            return JsonResponse({
+                'success': False,
+                'error': str(e)
+            }, status=400)
         
         return JsonResponse({
             'success': True,
             'message': 'Payment processed successfully',
             'payment_id': payment.payment_id,
             'payment_pk': payment.pk,
-            'new_balance': str(new_balance),
+            'new_balance': str(bill.balance_due),
             'payment_amount': str(amount),
             'bill_status': bill.status,
-            'total_paid': str(new_paid_amount)
+            'total_paid': str(bill.amount_paid)
         })
         
     except Exception as e:
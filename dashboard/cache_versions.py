@@ -0,0 +1,33 @@
+"""
+Version stamps for cache entries that several processes must retire together.
+
+A stamp is a random token kept in the shared cache. Bumping it is a plain set of a
+new token and a stamp lost to culling comes back as a new token, so no backend needs
+an atomic incr and a retired version is never handed out again: at worst an entry is
+rebuilt once more than necessary.
+"""
+import uuid
+
+from django.core.cache import cache
+
+
+def new_stamp():
+    return uuid.uuid4().hex[:12]
+
+
+def stamps(keys):
+    """{key: stamp} for the given version keys, creating any that are missing."""
+    keys = list(keys)
+    found = cache.get_many(keys)
+    missing = [key for key in keys if key not in found]
+    if missing:
+        for key in missing:
+            cache.add(key, new_stamp(), None)
+        found.update(cache.get_many(missing))
+    # A stamp culled again in between still gets a fresh (uncached) token
+    return {key: found.get(key) or new_stamp() for key in keys}
+
+
+def bump(key):
+    """Retire every entry built under ``key``'s current stamp."""
+    cache.set(key, new_stamp(), None)
@@ -1,3 +1,14 @@
 from django.db import models
 
-# Create your models here.
+
+class IdSequence(models.Model):
+    """Per-prefix, per-day counter backing the human-readable keys (BILL…, MR…, APT-…)."""
+    prefix = models.CharField(max_length=10)
+    day = models.DateField()
+    last_value = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('prefix', 'day')
+
+    def __str__(self):
+        return f"{self.prefix} {self.day} → {self.last_value}"
@@ -0,0 +1,273 @@
+import base64
+import json
+import math
+
+from django.core.exceptions import ValidationError
+from django.db.models import F, Q
+
+# Estimated-count mode stops counting here and reports "N+" instead
+COUNT_CAP = 10000
+
+
+def _json_default(value):
+    # Full-precision ISO strings (DjangoJSONEncoder would round datetimes to milliseconds)
+    return value.isoformat() if hasattr(value, 'isoformat') else str(value)
+
+
+def _encode(payload):
+    raw = json.dumps(payload, default=_json_default, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def _decode(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        payload = json.loads(raw)
+        direction, number, values = payload
+    except (ValueError, TypeError):
+        return None
+    if direction not in ('next', 'prev') or not isinstance(number, int) or not isinstance(values, list):
+        return None
+    return direction, max(number, 1), values
+
+
+def _value(obj, lookup):
+    if isinstance(obj, dict):
+        # values() rows: the projection must include every sort column
+        return obj[lookup]
+    for attr in lookup.split('__'):
+        obj = getattr(obj, attr, None) if obj is not None else None
+    return obj
+
+
+class CursorPage:
+    """
+    One page of a CursorPaginator. Exposes the parts of Django's Page API the
+    templates use (iteration, has_next/has_previous, number, start_index, paginator)
+    plus next_cursor/previous_cursor for building links.
+    """
+
+    def __init__(self, object_list, number, paginator, has_next, has_previous):
+        self.object_list = object_list
+        self.number = number
+        self.paginator = paginator
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self._has_next or self._has_previous
+
+    @property
+    def next_cursor(self):
+        if not self._has_next:
+            return None
+        return self.paginator.cursor_for(self.object_list[-1], 'next', self.number + 1)
+
+    @property
+    def previous_cursor(self):
+        if not self._has_previous:
+            return None
+        if self.number == 2:
+            return ''  # the first page needs no cursor
+        return self.paginator.cursor_for(self.object_list[0], 'prev', self.number - 1)
+
+    def start_index(self):
+        return (self.number - 1) * self.paginator.per_page + 1 if self.object_list else 0
+
+    def end_index(self):
+        return (self.number - 1) * self.paginator.per_page + len(self.object_list)
+
+
+class CursorPaginator:
+    """
+    Keyset ("seek") pagination: each page is fetched with WHERE (sort keys) < (last
+    row's keys) ORDER BY ... LIMIT n, so page 5,000 costs the same as page 1 instead
+    of scanning and discarding OFFSET rows.
+
+    ``ordering`` lists the sort columns ('-created_at', 'user__last_name', ...) and
+    must end in a unique column (the primary key is appended if missing). NULLs sort
+    last. Cursors are opaque strings carried in ?cursor=; one that cannot be read or
+    does not fit the sort columns gives the first page.
+
+    ``count`` is exact by default; with ``estimate_count=True`` it stops at COUNT_CAP
+    and sets ``count_is_estimate`` so large tables never pay for a full COUNT(*).
+    """
+
+    def __init__(self, queryset, per_page, ordering, estimate_count=False):
+        ordering = list(ordering)
+        pk_name = queryset.model._meta.pk.name
+        if not {pk_name, 'pk'} & {field.lstrip('-') for field in ordering}:
+            ordering.append(f'-{pk_name}' if ordering and ordering[0].startswith('-') else pk_name)
+        self.queryset = queryset
+        self.per_page = per_page
+        self.keys = [(field.lstrip('-'), field.startswith('-')) for field in ordering]
+        self.estimate_count = estimate_count
+        self.count_is_estimate = False
+        self._count = None
+
+    def _order_by(self, reverse):
+        # NULLs go last; walking backwards flips every key, NULL placement included
+        nulls = {'nulls_first': True} if reverse else {'nulls_last': True}
+        return [
+            F(field).desc(**nulls) if descending != reverse else F(field).asc(**nulls)
+            for field, descending in self.keys
+        ]
+
+    def _after(self, values, reverse):
+        """Rows strictly after ``values`` in the (possibly reversed) ordering."""
+        condition = None
+        for (field, descending), value in reversed(list(zip(self.keys, values))):
+            descending = descending != reverse
+            nulls_last = not reverse
+            if value is None:
+                equal = Q(**{f'{field}__isnull': True})
+                beyond = Q() if nulls_last else Q(**{f'{field}__isnull': False})
+            else:
+                equal = Q(**{field: value})
+                beyond = Q(**{f'{field}__{"lt" if descending else "gt"}': value})
+                if nulls_last:
+                    beyond |= Q(**{f'{field}__isnull': True})
+            tail = equal & condition if condition is not None else None
+            if beyond and tail is not None:
+                condition = beyond | tail
+            else:
+                condition = beyond or tail or Q(pk__in=[])
+        return condition
+
+    def _seek(self, values, reverse):
+        queryset = self.queryset.order_by(*self._order_by(reverse))
+        if values is None:
+            return queryset
+        return queryset.filter(self._after(values, reverse))
+
+    def cursor_for(self, obj, direction, number):
+        return _encode([direction, number, [_value(obj, field) for field, _ in self.keys]])
+
+    def get_page(self, cursor=None):
+        decoded = _decode(cursor) if cursor else None
+        if decoded is None or len(decoded[2]) != len(self.keys):
+            direction, number, values = 'next', 1, None
+        else:
+            direction, number, values = decoded
+
+        reverse = direction == 'prev'
+        try:
+            queryset = self._seek(values, reverse)
+        except (ValidationError, ValueError, TypeError):
+            # A well-formed cursor whose values do not fit the sort columns: start over
+            direction, number, values, reverse = 'next', 1, None, False
+            queryset = self._seek(None, reverse)
+        rows = list(queryset[:self.per_page + 1])
+        more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+
+        if reverse:
+            rows.reverse()
+            return CursorPage(rows, number, self, has_next=True, has_previous=more)
+        return CursorPage(rows, number, self, has_next=more, has_previous=values is not None)
+
+    @property
+    def count(self):
+        if self._count is None:
+            if self.estimate_count:
+                self._count = self.queryset.order_by()[:COUNT_CAP + 1].count()
+                self.count_is_estimate = self._count > COUNT_CAP
+                self._count = min(self._count, COUNT_CAP)
+            else:
+                self._count = self.queryset.count()
+        return self._count
+
+    @property
+    def num_pages(self):
+        return max(1, math.ceil(self.count / self.per_page))
+
+
+def page_limit(request, default_limit=50, max_limit=200):
+    """Page size from ?limit=, clamped to 1..max_limit."""
+    limit = request.GET.get('limit', '')
+    return min(int(limit), max_limit) if limit.isdigit() and int(limit) > 0 else default_limit
+
+
+def paginate_json(request, queryset, ordering, default_limit=50, max_limit=200):
+    """
+    Cursor-paginate a JSON API from ?cursor= and ?limit=. Returns the page; callers
+    add ``page.next_cursor`` / ``page.previous_cursor`` to their payload.
+    """
+    limit = page_limit(request, default_limit, max_limit)
+    return CursorPaginator(queryset, limit, ordering).get_page(request.GET.get('cursor'))
+
+
+class MergedCursorPaginator:
+    """
+    Keyset pagination over several querysets merged into one newest-first stream
+    (e.g. a patient's records, lab tests and bills on one timeline).
+
+    ``sources`` maps a name to (queryset, ordering); each ordering must be descending
+    and agree with ``key(name, obj)``, which returns the value the streams are merged
+    on. A page fetches at most ``per_page`` rows from every source (one query each,
+    however deep the page), merges them and keeps the newest ``per_page``. The cursor
+    records each source's own position, so nothing is skipped or repeated at ties.
+    """
+
+    def __init__(self, sources, per_page, key):
+        self.sources = sources
+        self.per_page = per_page
+        self.key = key
+
+    def get_page(self, cursor=None):
+        """Returns ([(name, obj), ...], next_cursor or None)."""
+        positions = dict.fromkeys(self.sources)
+        if cursor:
+            try:
+                raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+                decoded = json.loads(raw)
+            except (ValueError, TypeError):
+                decoded = None
+            # Anything but a {name: position} mapping starts from the top (None is a
+            # source that has not been read from yet)
+            if isinstance(decoded, dict) and all(
+                position is None or isinstance(position, str) for position in decoded.values()
+            ):
+                # Sources missing from the cursor were exhausted on an earlier page
+                positions = {name: decoded[name] for name in self.sources if name in decoded}
+
+        paginators = {}
+        pages = {}
+        candidates = []
+        for name, position in positions.items():
+            queryset, ordering = self.sources[name]
+            paginators[name] = CursorPaginator(queryset, self.per_page, ordering)
+            pages[name] = paginators[name].get_page(position)
+            candidates += [(name, obj) for obj in pages[name]]
+        # Stable sort: rows of one source keep their order at equal keys
+        candidates.sort(key=lambda item: self.key(*item), reverse=True)
+        items = candidates[:self.per_page]
+
+        taken = {}
+        for name, obj in items:
+            taken.setdefault(name, []).append(obj)
+        following = {}
+        for name, position in positions.items():
+            if name in taken:
+                if len(taken[name]) < len(pages[name]) or pages[name].has_next():
+                    following[name] = paginators[name].cursor_for(taken[name][-1], 'next', 2)
+            elif len(pages[name]):
+                following[name] = position
+        if len(candidates) <= self.per_page and not any(page.has_next() for page in pages.values()):
+            following = {}
+        return items, _encode(following) if following else None
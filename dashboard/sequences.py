@@ -0,0 +1,114 @@
+import threading
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import IdSequence
+
+
+class IdAllocator:
+    """
+    Race-free generator for dated sequential keys such as BILL202610180001.
+
+    Values come from an IdSequence row per (prefix, day) that is bumped with a single
+    UPDATE ... SET last_value = last_value + n, so concurrent workers never hand out the
+    same number. Each process reserves blocks of ID_ALLOCATOR_BLOCK_SIZE values and
+    serves keys from memory. Blocks are only reserved in autocommit: inside the caller's
+    transaction the UPDATE's row lock would be held until that transaction commits, and
+    a rollback would undo a block already handed out. So a caller inside a transaction
+    takes a value from the pool and, when the pool runs low, schedules the refill for
+    after its commit. Only a cold, empty pool makes it claim a single value in its own
+    transaction. Keys skipped by a rollback are gaps, never duplicates.
+    """
+
+    _lock = threading.Lock()
+    _blocks = {}  # (prefix, day) -> reserved ranges, each [next_value, last_value]
+
+    @classmethod
+    def generate(cls, prefix, separator='', width=4, day=None):
+        """Return e.g. 'BILL202610180001' or, with separator='-', 'APT-20261018-0001'."""
+        day = day or timezone.localdate()
+        value = cls.next_value(prefix, day)
+        return f"{prefix}{separator}{day:%Y%m%d}{separator}{value:0{width}d}"
+
+    @staticmethod
+    def block_size():
+        return max(1, getattr(settings, 'ID_ALLOCATOR_BLOCK_SIZE', 10))
+
+    @classmethod
+    def next_value(cls, prefix, day):
+        key = (prefix, day)
+        if not connection.in_atomic_block:
+            while True:
+                with cls._lock:
+                    value = cls._take(key)
+                if value is not None:
+                    return value
+                cls._refill(prefix, day)
+
+        with cls._lock:
+            value = cls._take(key)
+            running_low = cls._available(key) <= cls.block_size() // 2
+        if running_low:
+            transaction.on_commit(lambda: cls.refill(prefix, day))
+        if value is None:
+            value = cls._reserve(prefix, day, 1)
+        return value
+
+    @classmethod
+    def refill(cls, prefix, day):
+        """Top the pool up to a full block unless another refill already did."""
+        if connection.in_atomic_block:
+            # Only reached when on_commit callbacks run inside an outer atomic block
+            # (e.g. captureOnCommitCallbacks in tests): a block reserved there could be
+            # rolled back while the pool still hands its values out
+            return
+        with cls._lock:
+            running_low = cls._available((prefix, day)) <= cls.block_size() // 2
+        if running_low:
+            cls._refill(prefix, day)
+
+    @classmethod
+    def _available(cls, key):
+        return sum(last - first + 1 for first, last in cls._blocks.get(key, ()))
+
+    @classmethod
+    def _take(cls, key):
+        ranges = cls._blocks.get(key)
+        while ranges:
+            block = ranges[0]
+            if block[0] <= block[1]:
+                block[0] += 1
+                return block[0] - 1
+            ranges.pop(0)
+        return None
+
+    @classmethod
+    def _refill(cls, prefix, day):
+        """Reserve a block in autocommit and add it to the pool."""
+        # cls._lock is not held across the UPDATE: a thread inside a transaction holds
+        # the database lock while it waits for cls._lock, so holding both would deadlock
+        size = cls.block_size()
+        last = cls._reserve(prefix, day, size)
+        with cls._lock:
+            # Forget yesterday's blocks for this prefix before adding today's
+            for stale in [k for k in cls._blocks if k[0] == prefix and k != (prefix, day)]:
+                del cls._blocks[stale]
+            cls._blocks.setdefault((prefix, day), []).append([last - size + 1, last])
+
+    @staticmethod
+    def _reserve(prefix, day, size):
+        """Atomically claim ``size`` values and return the last one claimed."""
+        sequence = IdSequence.objects.filter(prefix=prefix, day=day)
+        with transaction.atomic():
+            if not sequence.update(last_value=F('last_value') + size):
+                try:
+                    with transaction.atomic():
+                        IdSequence.objects.create(prefix=prefix, day=day, last_value=size)
+                    return size
+                except IntegrityError:
+                    # Another worker created today's row first; fall back to bumping it
+                    sequence.update(last_value=F('last_value') + size)
+            return sequence.values_list('last_value', flat=True).get()
@@ -0,0 +1,50 @@
+import logging
+
+from django.core.cache import cache
+
+from . import cache_versions
+
+logger = logging.getLogger(__name__)
+
+
+class DashboardMetrics:
+    """
+    Short-lived cache for dashboard widgets with event-driven invalidation.
+
+    Each widget group is built by a callable and tagged with the data domains it reads
+    ('appointments', 'billing', ...). Writes to those domains bump a version number (see
+    dashboard.signals), which retires every cached entry built from older data. If a
+    builder fails, the last successfully built snapshot is served instead.
+    """
+
+    TTL = 60
+    KEY = 'dashboard:metrics:{name}:{scope}:{versions}'
+    SNAPSHOT_KEY = 'dashboard:metrics:{name}:{scope}:last_good'
+    VERSION_KEY = 'dashboard:metrics:version:{domain}'
+
+    @classmethod
+    def get(cls, name, builder, domains, scope='all', ttl=None):
+        version_keys = [cls.VERSION_KEY.format(domain=domain) for domain in domains]
+        stored = cache_versions.stamps(version_keys)
+        versions = '.'.join(stored[key] for key in version_keys)
+        key = cls.KEY.format(name=name, scope=scope, versions=versions)
+
+        data = cache.get(key)
+        if data is not None:
+            return data
+
+        snapshot_key = cls.SNAPSHOT_KEY.format(name=name, scope=scope)
+        try:
+            data = builder()
+        except Exception:
+            logger.exception("Failed to build dashboard metrics %r (%s)", name, scope)
+            return cache.get(snapshot_key, {})
+
+        cache.set(key, data, cls.TTL if ttl is None else ttl)
+        cache.set(snapshot_key, data, None)
+        return data
+
+    @classmethod
+    def invalidate(cls, *domains):
+        for domain in domains:
+            cache_versions.bump(cls.VERSION_KEY.format(domain=domain))
@@ -0,0 +1,40 @@
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+
+from appointments.models import Appointment, Doctor
+from billing.models import Bill, Payment
+from medical_records.models import MedicalRecord, Prescription, LabTest
+from patients.models import Patient
+from pharmacy.models import Inventory, MedicineDispensing
+from .services import DashboardMetrics
+
+# Which dashboard data domain each model feeds
+MODEL_DOMAINS = {
+    get_user_model(): 'staff',
+    Doctor: 'staff',
+    Patient: 'patients',
+    Appointment: 'appointments',
+    Bill: 'billing',
+    Payment: 'billing',
+    MedicalRecord: 'clinical',
+    LabTest: 'clinical',
+    Prescription: 'pharmacy',
+    Inventory: 'pharmacy',
+    MedicineDispensing: 'pharmacy',
+}
+
+
+def invalidate_dashboard_metrics(sender, update_fields=None, **kwargs):
+    # Every login saves last_login, which no dashboard figure reads
+    if update_fields is not None and set(update_fields) <= {'last_login'}:
+        return
+    # After commit, so a rebuild racing the write cannot re-cache the old figures under
+    # the new version, and a rolled-back write keeps the cache
+    domain = MODEL_DOMAINS[sender]
+    transaction.on_commit(lambda: DashboardMetrics.invalidate(domain))
+
+
+for model in MODEL_DOMAINS:
+    post_save.connect(invalidate_dashboard_metrics, sender=model, dispatch_uid=f'dashboard_metrics_save_{model.__name__}')
+    post_delete.connect(invalidate_dashboard_metrics, sender=model, dispatch_uid=f'dashboard_metrics_delete_{model.__name__}')
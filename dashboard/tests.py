@@ -1,3 +1,437 @@
-from django.test import TestCase
+import threading
+import tracemalloc
+from datetime import date, timedelta
+from decimal import Decimal
 
-# Create your tests here.
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from accounts.models import User
+from appointments.models import Appointment, Doctor
+from billing.models import Bill, BillingStaff, Payment, ServiceType
+from billing.services import BillService
+from medical_records.models import LabTest, MedicalRecord, Prescription
+from notifications.models import Notification
+from patients.models import Patient
+from pharmacy.models import Inventory, Medicine
+from . import cache_versions
+from .exports import Column, streaming_export
+from .pagination import CursorPaginator, MergedCursorPaginator, _encode
+from .models import IdSequence
+from .sequences import IdAllocator
+from .services import DashboardMetrics
+
+
+@override_settings(ID_ALLOCATOR_BLOCK_SIZE=10)
+class IdAllocatorParallelInsertTests(TransactionTestCase):
+    """Bills created from many threads at once get unique keys without a sequence round-trip each."""
+
+    THREADS = 8
+    BILLS_PER_THREAD = 25
+
+    def setUp(self):
+        cache.clear()
+        IdAllocator._blocks.clear()
+        staff_user = User.objects.create_user(email='billing@example.com', role='billing_staff')
+        patient_user = User.objects.create_user(email='patient@example.com', role='patient')
+        self.staff = BillingStaff.objects.get(user=staff_user)
+        self.patient = Patient.objects.get(user=patient_user)
+        self.service = ServiceType.objects.create(name='Consultation', base_price=Decimal('500'))
+
+        self.reservations = []
+        reserve = IdAllocator._reserve
+
+        def counting_reserve(prefix, day, size):
+            self.reservations.append(size)
+            return reserve(prefix, day, size)
+
+        IdAllocator._reserve = staticmethod(counting_reserve)
+        self.addCleanup(setattr, IdAllocator, '_reserve', staticmethod(reserve))
+
+    def _create_bills(self, errors):
+        try:
+            for _ in range(self.BILLS_PER_THREAD):
+                BillService.create_bill(self.patient, self.staff, date.today(), [{
+                    'service_id': self.service.pk, 'quantity': 1,
+                    'unit_price': Decimal('500'), 'description': '',
+                }])
+        except Exception as exc:
+            errors.append(exc)
+        finally:
+            connection.close()
+
+    def test_parallel_bill_inserts(self):
+        errors = []
+        threads = [threading.Thread(target=self._create_bills, args=(errors,)) for _ in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        total = self.THREADS * self.BILLS_PER_THREAD
+        bill_ids = list(Bill.objects.values_list('bill_id', flat=True))
+        self.assertEqual(len(bill_ids), total)
+        self.assertEqual(len(set(bill_ids)), total)
+        self.assertTrue(all(bill_id.startswith(f'BILL{date.today():%Y%m%d}') for bill_id in bill_ids))
+        # Most keys come from pre-reserved blocks: far fewer sequence UPDATEs than bills
+        self.assertLess(len(self.reservations), total // 2)
+        self.assertGreaterEqual(IdSequence.objects.get(prefix='BILL').last_value, total)
+
+    def test_rolled_back_transaction_does_not_reissue_keys(self):
+        class Rollback(Exception):
+            pass
+
+        with self.assertRaises(Rollback):
+            with transaction.atomic():
+                IdAllocator.generate('BILL')
+                raise Rollback
+        keys = [IdAllocator.generate('BILL') for _ in range(30)]
+        self.assertEqual(len(set(keys)), 30)
+        self.assertGreaterEqual(IdSequence.objects.get(prefix='BILL').last_value, 30)
+
+
+class QueryPlanTests(TestCase):
+    """The hot dashboard and list queries are answered from the declared indexes.
+
+    The tables are seeded and ANALYZEd first so the planner picks from real row
+    statistics rather than its empty-table defaults.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        today = date.today()
+        now = timezone.now()
+        patients = [
+            Patient.objects.get(user=User.objects.create_user(email=f'patient{i}@example.com', role='patient'))
+            for i in range(20)
+        ]
+        doctors = [
+            Doctor.objects.get(user=User.objects.create_user(email=f'doctor{i}@example.com', role='doctor'))
+            for i in range(5)
+        ]
+        staff = BillingStaff.objects.get(
+            user=User.objects.create_user(email='billing@example.com', role='billing_staff'),
+        )
+        cls.patient, cls.doctor = patients[0], doctors[0]
+
+        statuses = [status for status, _ in Appointment.STATUS_CHOICES]
+        Appointment.objects.bulk_create(
+            Appointment(
+                id=f'APT{i:05d}', patient=patients[i % 20], doctor=doctors[i % 5],
+                appointment_date=today + timedelta(days=i % 60 - 30), appointment_time='09:00',
+                status=statuses[i % len(statuses)], reason='Checkup',
+            )
+            for i in range(600)
+        )
+        records = MedicalRecord.objects.bulk_create(
+            MedicalRecord(
+                record_id=f'MR{i:05d}', patient=patients[i % 20], doctor=doctors[i % 5],
+                diagnosis='Flu', symptoms='Fever', treatment_plan='Rest',
+            )
+            for i in range(200)
+        )
+        # Most prescriptions have been dispensed, as on a live system
+        Prescription.objects.bulk_create(
+            Prescription(
+                medical_record=records[i % 200], medication_name='Paracetamol', dosage='500mg',
+                frequency='Daily', duration='5 days', is_dispensed=i % 10 != 0,
+                dispensed_at=now - timedelta(hours=i) if i % 10 else None,
+            )
+            for i in range(600)
+        )
+        test_statuses = [status for status, _ in LabTest.TEST_STATUS]
+        LabTest.objects.bulk_create(
+            LabTest(
+                medical_record=records[i % 200], test_name='FBC', test_description='Full blood count',
+                status=test_statuses[i % len(test_statuses)], test_date=now - timedelta(hours=i),
+            )
+            for i in range(400)
+        )
+        bill_statuses = [status for status, _ in Bill.BILL_STATUS]
+        bills = Bill.objects.bulk_create(
+            Bill(
+                bill_id=f'BILL{i:05d}', patient=patients[i % 20], created_by=staff, due_date=today,
+                status=bill_statuses[i % len(bill_statuses)], total_amount=Decimal('100.00'),
+            )
+            for i in range(400)
+        )
+        Payment.objects.bulk_create(
+            Payment(payment_id=f'PAY{i:05d}', bill=bills[i], amount=Decimal('50.00'),
+                    payment_method='cash', processed_by=staff)
+            for i in range(400)
+        )
+        notification_statuses = [status for status, _ in Notification.NOTIFICATION_STATUS]
+        Notification.objects.bulk_create(
+            Notification(
+                recipient=patients[i % 20].user, subject='Reminder', message='See you soon',
+                delivery_method='in_app', status=notification_statuses[i % len(notification_statuses)],
+            )
+            for i in range(800)
+        )
+        medicine = Medicine.objects.create(name='Paracetamol', manufacturer='KEMSA', unit_of_measurement='tablets')
+        Inventory.objects.bulk_create(
+            Inventory(
+                medicine=medicine, batch_number=f'B{i}', quantity_in_stock=100, unit_price=Decimal('5.00'),
+                expiry_date=today + timedelta(days=10 * i), supplier='KEMSA', date_received=today,
+            )
+            for i in range(200)
+        )
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return ' | '.join(row[-1] for row in cursor.fetchall())
+
+    def assertUsesIndex(self, queryset, index, sorted_by_index=False):
+        plan = self.plan(queryset)
+        self.assertIn(f'USING INDEX {index}', plan.replace('COVERING INDEX', 'INDEX'))
+        if sorted_by_index:
+            self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_appointment_indexes(self):
+        today = date.today()
+        self.assertUsesIndex(
+            Appointment.objects.filter(doctor=self.doctor, appointment_date=today, status='scheduled'),
+            'appt_doctor_date_status_idx',
+        )
+        self.assertUsesIndex(
+            Appointment.objects.filter(appointment_date=today, status='scheduled'), 'appt_date_status_idx'
+        )
+        self.assertUsesIndex(
+            Appointment.objects.filter(patient=self.patient, appointment_date__gte=today).order_by('appointment_date'),
+            'appt_patient_date_idx', sorted_by_index=True,
+        )
+
+    def test_billing_indexes(self):
+        self.assertUsesIndex(
+            Bill.objects.filter(status='pending').order_by('-created_at'),
+            'bill_status_created_idx', sorted_by_index=True,
+        )
+        self.assertUsesIndex(Bill.objects.filter(patient=self.patient, status='pending'), 'bill_patient_status_idx')
+        now = timezone.now()
+        self.assertUsesIndex(
+            Payment.objects.filter(payment_date__gte=now, payment_date__lt=now + timedelta(days=1)),
+            'payment_date_idx',
+        )
+
+    def test_notification_indexes(self):
+        self.assertUsesIndex(
+            Notification.objects.filter(recipient_id=self.patient.user_id, status='sent'), 'notif_recipient_status_idx'
+        )
+        self.assertUsesIndex(
+            Notification.objects.filter(recipient_id=self.patient.user_id).order_by('-created_at')[:10],
+            'notif_recipient_created_idx', sorted_by_index=True,
+        )
+
+    def test_clinical_indexes(self):
+        self.assertUsesIndex(
+            LabTest.objects.filter(status='pending').order_by('test_date'),
+            'labtest_status_date_idx', sorted_by_index=True,
+        )
+        self.assertUsesIndex(
+            MedicalRecord.objects.filter(patient=self.patient).order_by('-created_at'),
+            'record_patient_created_idx', sorted_by_index=True,
+        )
+        self.assertUsesIndex(Prescription.objects.filter(is_dispensed=False), 'rx_pending_idx')
+        self.assertUsesIndex(
+            Prescription.objects.filter(is_dispensed=True).order_by('-dispensed_at'),
+            'rx_dispensed_idx', sorted_by_index=True,
+        )
+
+    def test_inventory_indexes(self):
+        self.assertUsesIndex(
+            Inventory.objects.filter(expiry_date__lte=date.today() + timedelta(days=30)), 'inventory_expiry_idx'
+        )
+
+
+class DashboardMetricsInvalidationTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.doctor_user = User.objects.create_user(email='doctor@example.com', role='doctor')
+        self.doctor = Doctor.objects.get(user=self.doctor_user)
+        patient_user = User.objects.create_user(email='patient@example.com', role='patient')
+        self.patient_user = patient_user
+        self.patient = Patient.objects.get(user=patient_user)
+
+    def version(self, domain):
+        key = DashboardMetrics.VERSION_KEY.format(domain=domain)
+        return cache_versions.stamps([key])[key]
+
+    def test_login_does_not_invalidate_staff_metrics(self):
+        before = self.version('staff')
+        self.client.force_login(self.doctor_user)
+        self.assertEqual(self.version('staff'), before)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.doctor_user.first_name = 'Grace'
+            self.doctor_user.save()
+            self.assertEqual(self.version('staff'), before)
+        self.assertNotEqual(self.version('staff'), before)
+
+    def test_rolled_back_write_keeps_the_version(self):
+        before = self.version('staff')
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            try:
+                with transaction.atomic():
+                    self.doctor_user.first_name = 'Grace'
+                    self.doctor_user.save()
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+        self.assertEqual(callbacks, [])
+        self.assertEqual(self.version('staff'), before)
+
+    def test_doctor_widget_sees_new_prescriptions(self):
+        record = MedicalRecord.objects.create(
+            patient=self.patient, doctor=self.doctor, diagnosis='Flu', symptoms='Fever', treatment_plan='Rest',
+        )
+        self.client.force_login(self.doctor_user)
+        response = self.client.get(reverse('dashboard:dashboard'))
+        self.assertEqual(response.context['prescriptions_today'], 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            Prescription.objects.create(
+                medical_record=record, medication_name='Paracetamol', dosage='500mg',
+                frequency='Twice daily', duration='5 days',
+            )
+        response = self.client.get(reverse('dashboard:dashboard'))
+        self.assertEqual(response.context['prescriptions_today'], 1)
+
+    def test_patients_do_not_build_the_overview(self):
+        self.client.force_login(self.patient_user)
+        response = self.client.get(reverse('dashboard:dashboard'))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('total_staff', response.context)
+        self.client.force_login(User.objects.create_user(email='admin@example.com', role='administrator'))
+        response = self.client.get(reverse('dashboard:dashboard'))
+        self.assertIn('total_staff', response.context)
+
+
+class CursorPaginatorTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        doctor = Doctor.objects.get(user=User.objects.create_user(email='doctor@example.com', role='doctor'))
+        patient = Patient.objects.get(user=User.objects.create_user(email='patient@example.com', role='patient'))
+        self.record = MedicalRecord.objects.create(
+            patient=patient, doctor=doctor, diagnosis='Flu', symptoms='Fever', treatment_plan='Rest',
+        )
+        now = timezone.now()
+        # Repeated sort keys and NULLs, spread over page boundaries
+        self.dates = [now, now, now - timedelta(days=1), None, now, None, now - timedelta(days=1), now]
+        self.tests = [self.lab_test(test_date, 'pending') for test_date in self.dates]
+
+    def lab_test(self, test_date, status):
+        return LabTest.objects.create(
+            medical_record=self.record, test_name='FBC', test_description='Full blood count',
+            status=status, test_date=test_date,
+        )
+
+    def paginator(self):
+        return CursorPaginator(LabTest.objects.all(), 3, ['-test_date'])
+
+    def test_pages_forward_and_back_over_ties_and_nulls(self):
+        # Newest first, ties newest id first, NULLs last
+        expected = sorted(self.tests, key=lambda test: (test.test_date is not None, test.test_date, test.pk))[::-1]
+
+        pages = [self.paginator().get_page()]
+        while pages[-1].has_next():
+            pages.append(self.paginator().get_page(pages[-1].next_cursor))
+        self.assertEqual([test for page in pages for test in page], expected)
+        self.assertEqual([page.number for page in pages], [1, 2, 3])
+
+        page = pages[-1]
+        back = [page]
+        while page.has_previous():
+            page = self.paginator().get_page(page.previous_cursor)
+            back.append(page)
+        self.assertEqual([list(page) for page in reversed(back)], [list(page) for page in pages])
+        self.assertFalse(back[-1].has_previous())
+
+    def test_bad_cursor_gives_the_first_page(self):
+        first = list(self.paginator().get_page())
+        for cursor in (
+            'not base64 !', _encode(['sideways', 2, [None, 1]]), _encode(['next', 2, [None]]),
+            _encode(['next', 2, ['yesterday', 1]]), _encode(['next', 2, [None, 'one']]),
+            _encode(['prev', 2, [[1], {'id': 1}]]),
+        ):
+            with self.subTest(cursor=cursor):
+                page = self.paginator().get_page(cursor)
+                self.assertEqual((list(page), page.number, page.has_previous()), (first, 1, False))
+
+    def test_merged_pages_interleave_sources_at_ties(self):
+        for test_date in self.dates:
+            self.lab_test(test_date, 'completed')
+        dated = LabTest.objects.filter(test_date__isnull=False)
+        paginator = MergedCursorPaginator({
+            'pending': (dated.filter(status='pending'), ['-test_date']),
+            'completed': (dated.filter(status='completed'), ['-test_date']),
+        }, 4, key=lambda name, test: test.test_date)
+
+        seen = []
+        items, cursor = paginator.get_page()
+        seen += items
+        while cursor:
+            items, cursor = paginator.get_page(cursor)
+            seen += items
+        self.assertEqual(len(seen), dated.count())
+        self.assertEqual(len({test.pk for _, test in seen}), len(seen))
+        dates = [test.test_date for _, test in seen]
+        self.assertEqual(dates, sorted(dates, reverse=True))
+        self.assertEqual({name for name, _ in seen}, {'pending', 'completed'})
+
+        first, _ = paginator.get_page()
+        bad_position = _encode(['next', 2, ['yesterday', 'one']])
+        for cursor in (
+            'not base64 !', _encode({'pending': 5, 'completed': ['x']}), _encode({'pending': bad_position}),
+        ):
+            with self.subTest(cursor=cursor):
+                self.assertEqual(paginator.get_page(cursor)[0], first)
+
+
+@override_settings(EXPORT_CHUNK_SIZE=200)
+class StreamingExportMemoryTests(TestCase):
+    """Peak memory of an export is bounded by the chunk size, not the number of rows."""
+
+    ROWS = 8000
+    COLUMNS = [
+        Column('Service', 'name'),
+        Column('Description', 'description'),
+        Column('Price', 'base_price'),
+        Column('Active', 'is_active', lambda value: 'Yes' if value else 'No'),
+    ]
+
+    @classmethod
+    def setUpTestData(cls):
+        ServiceType.objects.bulk_create(
+            ServiceType(name=f'Service {i}', description='x' * 200, base_price=Decimal('150.00'))
+            for i in range(cls.ROWS)
+        )
+
+    def peak_memory(self, rows, export_format):
+        queryset = ServiceType.objects.order_by('pk')[:rows]
+        tracemalloc.start()
+        try:
+            size = sum(
+                len(chunk) for chunk in streaming_export(queryset, self.COLUMNS, 'export', export_format)
+            )
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        if export_format != 'xlsx':
+            self.assertGreater(size, rows * 200)
+        return peak
+
+    def test_peak_memory_does_not_grow_with_rows(self):
+        for export_format in ('csv', 'ndjson', 'xlsx'):
+            with self.subTest(export_format=export_format):
+                small = self.peak_memory(self.ROWS // 8, export_format)
+                large = self.peak_memory(self.ROWS, export_format)
+                # Eight times the rows (about 1.8MB of CSV) within 1.5x the peak
+                self.assertLess(large, small * 1.5, (small, large))
@@ -1,21 +1,28 @@
+import os
+
 from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required
 from django.db.models import Count, Sum, Q, F
 from django.utils import timezone
 from datetime import datetime, timedelta
 from django.contrib.humanize.templatetags.humanize import intcomma
-import random
 from patients.models import Patient
 from pharmacy.models import Medicine, Inventory
 from appointments.models import Appointment, Doctor
 from medical_records.models import Prescription, LabTest, MedicalRecord
 from django.contrib.auth import get_user_model
-from billing.models import Bill, Payment
-from notifications.models import Notification
+from billing.models import Bill
+from accounts.services import ModulePermissionService
+from billing.services import RevenueService
+from notifications.services import UnreadCounter
 from django.contrib import messages
 from django.conf import settings
+from .services import DashboardMetrics
 User = get_user_model()
 
+STAFF_ROLES = ['doctor', 'pharmacist', 'billing_staff', 'administrator']
+UPCOMING_STATUSES = ['scheduled', 'confirmed']
+
 
 @login_required
 def dashboard_view(request):
@@ -23,355 +30,267 @@ def dashboard_view(request):
     Render the dashboard view with role-specific data
     """
     user = request.user
-    today = timezone.now().date()
-    now = timezone.now()
-    current_month = now.replace(day=1)
+    today = timezone.localdate()
+    current_month = today.replace(day=1)
 
     context = {
         'title': 'Dashboard',
         'user': user,
         'today': today,
-        'unread_notifications': Notification.objects.filter(
-            recipient=user, status__in=['pending', 'sent']
-        ).count(),
+        'unread_notifications': UnreadCounter.get(user),
     }
 
-    context.update({
-        'todays_count': get_todays_appointments_count(),
-    })
+    # Hospital-wide headline cards, shared by every user who can see them (the
+    # template only draws them for the patients module; patients get their own cards)
+    if user.role != 'patient' and ModulePermissionService.get_user_permissions(user).get('patients'):
+        context.update(DashboardMetrics.get(
+            'overview', lambda: get_overview_data(today, current_month),
+            domains=['patients', 'staff', 'appointments', 'billing'], scope=today.isoformat(),
+        ))
 
     # Role-specific data
     if user.role == 'administrator':
-        context.update(get_administrator_data(today, current_month))
+        context.update(DashboardMetrics.get(
+            'administrator', get_administrator_data,
+            domains=['staff', 'pharmacy'],
+        ))
     elif user.role == 'doctor':
         doctor = Doctor.objects.filter(user=user).first()
-        context.update(get_doctor_data(doctor, today))
-        # Also provide recent appointments for the compact view
-        try:
-            todays_appointments = Appointment.objects.filter(appointment_date=today, doctor=doctor)
-            context['recent_appointments'] = todays_appointments.select_related(
-                'patient__user', 'doctor__user'
-            ).order_by('appointment_time')[:8]
-        except Exception:
-            context['recent_appointments'] = []
+        if doctor:
+            context.update(DashboardMetrics.get(
+                'doctor', lambda: get_doctor_data(doctor, today),
+                domains=['appointments', 'clinical', 'pharmacy'], scope=f'{doctor.pk}:{today.isoformat()}',
+            ))
     elif user.role == 'pharmacist':
-        context.update(get_pharmacist_data(today))
+        context.update(DashboardMetrics.get(
+            'pharmacist', lambda: get_pharmacist_data(today),
+            domains=['pharmacy', 'clinical'], scope=today.isoformat(),
+        ))
     elif user.role == 'billing_staff':
-        context.update(get_billing_staff_data(today, current_month))
-        context['pending_bills_amount'] = Bill.objects.filter(
-            status__in=['pending', 'partial']
-        ).aggregate(total=Sum('total_amount'))['total'] or 0
-        context['overdue_bills'] = Bill.objects.filter(status='overdue').count()
-        context['revenue_today'] = Payment.objects.filter(
-            payment_date__date=today
-        ).aggregate(total=Sum('amount'))['total'] or 0
-        context['revenue_month'] = Payment.objects.filter(
-            payment_date__month=now.month,
-            payment_date__year=now.year
-        ).aggregate(total=Sum('amount'))['total'] or 0
+        context.update(DashboardMetrics.get(
+            'billing_staff', lambda: get_billing_staff_data(today, current_month),
+            domains=['billing'], scope=today.isoformat(),
+        ))
     elif user.role == 'patient':
         patient = Patient.objects.filter(user=user).first()
-        context.update(get_patient_data(patient, today))
+        if patient:
+            context.update(DashboardMetrics.get(
+                'patient', lambda: get_patient_data(patient, today),
+                domains=['appointments', 'clinical', 'pharmacy', 'billing'],
+                scope=f'{patient.pk}:{today.isoformat()}',
+            ))
     else:
-        # Generic/admin fallback
-        todays_appointments = Appointment.objects.filter(appointment_date=today)
-        context['recent_appointments'] = todays_appointments.select_related(
-            'patient__user', 'doctor__user'
-        ).order_by('appointment_time')[:8]
-        context['total_patients'] = Patient.objects.count()
-        context['total_doctors'] = Doctor.objects.filter(is_available=True).count()
-        context['low_stock'] = Inventory.objects.filter(
-            quantity_in_stock__lte=F('minimum_stock_level')
-        ).count()
-        context['pending_rx'] = Prescription.objects.filter(is_dispensed=False).count()
-        context['pending_labs'] = LabTest.objects.filter(status='pending').count()
+        context.update(DashboardMetrics.get(
+            'general', lambda: get_general_data(today),
+            domains=['appointments', 'staff', 'pharmacy', 'clinical'], scope=today.isoformat(),
+        ))
 
     return render(request, 'dashboard.html', context)
 
 
-def get_todays_appointments_count():
-    """Get total appointments for today"""
+def get_overview_data(today, current_month):
+    """Headline counts shown on the top stat cards"""
+    return {
+        'total_patients': Patient.objects.filter(user__is_active=True).count(),
+        'total_staff': User.objects.filter(role__in=STAFF_ROLES, is_active=True).count(),
+        'todays_count': Appointment.objects.filter(
+            appointment_date=today, status__in=UPCOMING_STATUSES
+        ).count(),
+        'monthly_revenue': RevenueService.total(current_month, today),
+    }
+
+
+def get_database_size():
+    """Size in bytes of the SQLite database file, or None for server databases"""
+    database = settings.DATABASES['default']
+    if database['ENGINE'] != 'django.db.backends.sqlite3':
+        return None
     try:
-        return Appointment.objects.filter(
-            appointment_date=timezone.now().date(),
-            status__in=['scheduled', 'confirmed']
-        ).count()
-    except Exception:
-        return 23
+        return os.path.getsize(database['NAME'])
+    except (OSError, TypeError):
+        return None
 
 
-def get_administrator_data(today, current_month):
+def get_administrator_data():
     """Get data specific to administrators"""
-    try:
-        total_patients = Patient.objects.filter(user__is_active=True).count()
-        total_staff = User.objects.filter(
-            role__in=['doctor', 'pharmacist', 'billing_staff'],
-            is_active=True
-        ).count()
-        todays_appointments = Appointment.objects.filter(
-            appointment_date=today
-        ).count()
-        monthly_revenue = Bill.objects.filter(
-            issue_date__gte=current_month,
-            status='paid'
-        ).aggregate(total=Sum('total_amount'))['total'] or 0
-
-        recent_activities = [
-            {'time': '11:45 AM', 'activity': 'New staff member registered', 'user': 'Admin System', 'status': 'completed', 'status_class': 'success'},
-            {'time': '11:30 AM', 'activity': 'System backup completed', 'user': 'Auto System', 'status': 'completed', 'status_class': 'success'},
-            {'time': '10:15 AM', 'activity': 'Monthly report generated', 'user': 'Dr. Sarah Kimani', 'status': 'active', 'status_class': 'info'},
-            {'time': '09:45 AM', 'activity': 'User permissions updated', 'user': 'Admin Panel', 'status': 'completed', 'status_class': 'success'},
-        ]
-
-        return {
-            'total_patients': total_patients,
-            'total_staff': total_staff,
-            'todays_appointments': todays_appointments,
-            'monthly_revenue': monthly_revenue,
-            'recent_activities': recent_activities,
-            'system_uptime': '99.8%',
-            'database_size': '2.3GB',
-            'active_doctors': 15,
-            'active_nurses': 45,
-            'active_support_staff': 25,
-            'low_stock': Inventory.objects.filter(quantity_in_stock__lte=F('minimum_stock_level')).count(),
-            'total_doctors': Doctor.objects.filter(is_available=True).count(),
-        }
-    except Exception as e:
-        return {
-            'total_patients': random.randint(1100, 1300),
-            'total_staff': random.randint(80, 90),
-            'todays_appointments': random.randint(120, 180),
-            'monthly_revenue': random.randint(2200000, 2800000),
-            'recent_activities': [
-                {'time': '11:45 AM', 'activity': 'New staff member registered', 'user': 'Admin System', 'status': 'completed', 'status_class': 'success'},
-                {'time': '11:30 AM', 'activity': 'System backup completed', 'user': 'Auto System', 'status': 'completed', 'status_class': 'success'},
-                {'time': '10:15 AM', 'activity': 'Monthly report generated', 'user': 'Dr. Sarah Kimani', 'status': 'active', 'status_class': 'info'},
-            ],
-            'system_uptime': '99.8%',
-            'database_size': '2.3GB',
-            'active_doctors': random.randint(12, 18),
-            'active_nurses': random.randint(40, 50),
-            'active_support_staff': random.randint(20, 30),
-            'low_stock': 0,
-            'total_doctors': 0,
+    role_labels = dict(User.USER_ROLES)
+    role_counts = dict(
+        User.objects.filter(role__in=STAFF_ROLES, is_active=True)
+        .values_list('role').annotate(total=Count('pk'))
+    )
+    total_staff = sum(role_counts.values())
+    staff_breakdown = [
+        {
+            'label': role_labels[role],
+            'count': role_counts.get(role, 0),
+            'share': round(role_counts.get(role, 0) * 100 / total_staff) if total_staff else 0,
         }
+        for role in STAFF_ROLES
+    ]
+
+    return {
+        'staff_breakdown': staff_breakdown,
+        'active_doctors': Doctor.objects.filter(is_available=True, user__is_active=True).count(),
+        'database_size': get_database_size(),
+        'low_stock': Inventory.objects.filter(quantity_in_stock__lte=F('minimum_stock_level')).count(),
+    }
 
 
 def get_doctor_data(doctor, today):
     """Get data specific to doctors"""
-    try:
-        my_patients = Patient.objects.filter(user__is_active=True).count()
-        doctor_appointments = Appointment.objects.filter(
-            doctor=doctor, appointment_date=today
-        ).count()
-        pending_consultations = Appointment.objects.filter(
-            doctor=doctor, status='waiting', appointment_date=today
-        ).count()
-        prescriptions_today = Prescription.objects.filter(
-            medical_record__doctor=doctor,
-            medical_record__created_at__date=today
-        ).count()
-
-        todays_schedule = [
-            {'time': '9:00 AM', 'patient_name': 'John Doe', 'type': 'General Checkup', 'status': 'scheduled'},
-            {'time': '10:30 AM', 'patient_name': 'Mary Smith', 'type': 'Follow-up Visit', 'status': 'confirmed'},
-            {'time': '2:00 PM', 'patient_name': 'Peter Johnson', 'type': 'Consultation', 'status': 'scheduled'},
-        ]
-
-        recent_activities = [
-            {'time': '11:30 AM', 'activity': 'Patient consultation completed', 'user': doctor.user.get_full_name() if doctor else 'Doctor', 'status': 'completed', 'status_class': 'success'},
-            {'time': '10:45 AM', 'activity': 'Prescription written', 'user': doctor.user.get_full_name() if doctor else 'Doctor', 'status': 'completed', 'status_class': 'success'},
-            {'time': '10:15 AM', 'activity': 'Appointment scheduled', 'user': doctor.user.get_full_name() if doctor else 'Doctor', 'status': 'active', 'status_class': 'info'},
-            {'time': '09:30 AM', 'activity': 'Medical record updated', 'user': doctor.user.get_full_name() if doctor else 'Doctor', 'status': 'completed', 'status_class': 'success'},
-        ]
-
-        return {
-            'my_patients': my_patients,
-            'doctor_appointments': doctor_appointments,
-            'pending_consultations': pending_consultations,
-            'prescriptions_today': prescriptions_today,
-            'todays_schedule': todays_schedule,
-            'recent_activities': recent_activities,
-        }
-    except Exception as e:
-        return {
-            'my_patients': random.randint(100, 150),
-            'doctor_appointments': random.randint(8, 15),
-            'pending_consultations': random.randint(5, 12),
-            'prescriptions_today': random.randint(10, 20),
-            'todays_schedule': [
-                {'time': '9:00 AM', 'patient_name': 'John Doe', 'type': 'General Checkup', 'status': 'scheduled'},
-                {'time': '10:30 AM', 'patient_name': 'Mary Smith', 'type': 'Follow-up Visit', 'status': 'confirmed'},
-                {'time': '2:00 PM', 'patient_name': 'Peter Johnson', 'type': 'Consultation', 'status': 'scheduled'},
-            ],
-            'recent_activities': [
-                {'time': '11:30 AM', 'activity': 'Patient consultation completed', 'user': 'Doctor', 'status': 'completed', 'status_class': 'success'},
-                {'time': '10:45 AM', 'activity': 'Prescription written', 'user': 'Doctor', 'status': 'completed', 'status_class': 'success'},
-            ],
+    appointments = Appointment.objects.filter(doctor=doctor)
+    counts = appointments.aggregate(
+        my_patients=Count('patient', distinct=True),
+        doctor_appointments=Count('pk', filter=Q(appointment_date=today)),
+        pending_consultations=Count(
+            'pk', filter=Q(appointment_date=today, status__in=UPCOMING_STATUSES)
+        ),
+    )
+    prescriptions_today = Prescription.objects.filter(
+        medical_record__doctor=doctor,
+        medical_record__created_at__date=today
+    ).count()
+
+    todays_appointments = list(
+        appointments.filter(appointment_date=today)
+        .select_related('patient__user', 'doctor__user')
+        .order_by('appointment_time')[:8]
+    )
+    todays_schedule = [
+        {
+            'time': appointment.appointment_time.strftime('%I:%M %p').lstrip('0'),
+            'patient_name': appointment.patient.user.get_full_name(),
+            'type': appointment.reason,
+            'status': appointment.status,
         }
+        for appointment in todays_appointments
+        if appointment.status in UPCOMING_STATUSES
+    ]
+
+    return dict(
+        counts,
+        prescriptions_today=prescriptions_today,
+        todays_schedule=todays_schedule,
+        recent_appointments=todays_appointments,
+    )
 
 
 def get_pharmacist_data(today):
     """Get data specific to pharmacists"""
-    try:
-        total_medications = Inventory.objects.all().count()
-        low_stock_items = Inventory.objects.filter(
-            quantity_in_stock__lte=F('minimum_stock_level')
-        ).count()
-        dispensed_today = Prescription.objects.filter(
-            dispensed_at__date=today, is_dispensed=True
-        ).count()
-        expiry_date = today + timedelta(days=30)
-        expiring_soon = Inventory.objects.filter(
-            expiry_date__lte=expiry_date, expiry_date__gt=today
-        ).count()
-
-        critical_stock_alerts = [
-            {'medication': 'Paracetamol 500mg', 'current_stock': 25, 'minimum_required': 100, 'status': 'Critical', 'status_class': 'danger'},
-            {'medication': 'Amoxicillin 250mg', 'current_stock': 45, 'minimum_required': 50, 'status': 'Low', 'status_class': 'warning'},
-            {'medication': 'Metformin 500mg', 'current_stock': 15, 'minimum_required': 75, 'status': 'Critical', 'status_class': 'danger'},
-        ]
-
-        pending_prescriptions = [
-            {'patient_name': 'Jane Doe', 'doctor': 'Dr. Smith - Cardiology', 'status': 'Pending', 'status_class': 'warning'},
-            {'patient_name': 'John Mwangi', 'doctor': 'Dr. Kimani - General', 'status': 'Pending', 'status_class': 'warning'},
-            {'patient_name': 'Mary Wanjiku', 'doctor': 'Dr. Ochieng - Pediatrics', 'status': 'Pending', 'status_class': 'warning'},
-        ]
-
-        recent_activities = [
-            {'time': '11:45 AM', 'activity': 'Medication dispensed', 'user': 'Pharmacist Grace', 'status': 'completed', 'status_class': 'success'},
-            {'time': '11:15 AM', 'activity': 'Inventory updated', 'user': 'Pharmacist Grace', 'status': 'completed', 'status_class': 'success'},
-            {'time': '10:30 AM', 'activity': 'Low stock alert triggered', 'user': 'System Alert', 'status': 'attention required', 'status_class': 'warning'},
-            {'time': '09:45 AM', 'activity': 'Prescription verified', 'user': 'Pharmacist Grace', 'status': 'completed', 'status_class': 'success'},
-        ]
-
-        return {
-            'total_medications': total_medications,
-            'low_stock_items': low_stock_items,
-            'dispensed_today': dispensed_today,
-            'expiring_soon': expiring_soon,
-            'critical_stock_alerts': critical_stock_alerts,
-            'pending_prescriptions': pending_prescriptions,
-            'recent_activities': recent_activities,
-        }
-    except Exception as e:
-        print(f"Error fetching data: {e}")
-        return {
-            'total_medications': random.randint(800, 900),
-            'low_stock_items': random.randint(5, 10),
-            'dispensed_today': random.randint(35, 50),
-            'expiring_soon': random.randint(10, 20),
-            'critical_stock_alerts': [
-                {'medication': 'Paracetamol 500mg', 'current_stock': 25, 'minimum_required': 100, 'status': 'Critical', 'status_class': 'danger'},
-                {'medication': 'Amoxicillin 250mg', 'current_stock': 45, 'minimum_required': 50, 'status': 'Low', 'status_class': 'warning'},
-            ],
-            'pending_prescriptions': [
-                {'patient_name': 'Jane Doe', 'doctor': 'Dr. Smith - Cardiology', 'status': 'Pending', 'status_class': 'warning'},
-                {'patient_name': 'John Mwangi', 'doctor': 'Dr. Kimani - General', 'status': 'Pending', 'status_class': 'warning'},
-            ],
-            'recent_activities': [
-                {'time': '11:45 AM', 'activity': 'Medication dispensed', 'user': 'Pharmacist', 'status': 'completed', 'status_class': 'success'},
-                {'time': '10:30 AM', 'activity': 'Low stock alert triggered', 'user': 'System Alert', 'status': 'attention required', 'status_class': 'warning'},
-            ],
-        }
+    low_stock = Q(quantity_in_stock__lte=F('minimum_stock_level'))
+    counts = Inventory.objects.aggregate(
+        total_medications=Count('pk'),
+        low_stock_items=Count('pk', filter=low_stock),
+        expiring_soon=Count(
+            'pk', filter=Q(expiry_date__gt=today, expiry_date__lte=today + timedelta(days=30))
+        ),
+    )
+    dispensed_today = Prescription.objects.filter(
+        dispensed_at__date=today, is_dispensed=True
+    ).count()
+
+    critical_stock_alerts = []
+    for item in Inventory.objects.filter(low_stock).select_related('medicine').order_by('quantity_in_stock')[:5]:
+        critical = item.quantity_in_stock * 2 <= item.minimum_stock_level
+        critical_stock_alerts.append({
+            'medication': item.medicine.name,
+            'current_stock': item.quantity_in_stock,
+            'minimum_required': item.minimum_stock_level,
+            'status': 'Critical' if critical else 'Low',
+            'status_class': 'danger' if critical else 'warning',
+        })
+
+    pending_prescriptions = []
+    pending = Prescription.objects.filter(is_dispensed=False).select_related(
+        'medical_record__patient__user', 'medical_record__doctor__user'
+    ).order_by('medical_record__created_at')[:5]
+    for prescription in pending:
+        doctor = prescription.medical_record.doctor
+        pending_prescriptions.append({
+            'patient_name': prescription.medical_record.patient.user.get_full_name(),
+            'doctor': f"Dr. {doctor.user.last_name} - {doctor.specialization}",
+            'status': 'Pending',
+            'status_class': 'warning',
+        })
+
+    return dict(
+        counts,
+        dispensed_today=dispensed_today,
+        critical_stock_alerts=critical_stock_alerts,
+        pending_prescriptions=pending_prescriptions,
+    )
 
 
 def get_billing_staff_data(today, current_month):
     """Get data specific to billing staff"""
-    try:
-        daily_revenue = Bill.objects.filter(
-            created_at__date=today, status='paid'
-        ).aggregate(total=Sum('amount_paid'))['total'] or 0
-        pending_payments = Bill.objects.filter(
-            status='pending'
-        ).aggregate(total=Sum('total_amount'))['total'] or 0
-        invoices_generated = Bill.objects.filter(created_at__date=today).count()
-        insurance_claims = 23
-
-        outstanding_payments = [
-            {'patient_name': 'John Kamau', 'invoice_number': '#INV-2024-001', 'amount': 15000, 'due_date': '2024-12-15', 'status': 'due', 'status_class': 'warning'},
-            {'patient_name': 'Mary Njeri', 'invoice_number': '#INV-2024-002', 'amount': 8500, 'due_date': '2024-12-10', 'status': 'overdue', 'status_class': 'danger'},
-            {'patient_name': 'Peter Ochieng', 'invoice_number': '#INV-2024-003', 'amount': 22000, 'due_date': '2024-12-18', 'status': 'due', 'status_class': 'info'},
-        ]
-
-        recent_activities = [
-            {'time': '11:30 AM', 'activity': 'Invoice generated', 'user': 'Billing Staff', 'status': 'completed', 'status_class': 'success'},
-            {'time': '11:00 AM', 'activity': 'Payment processed', 'user': 'Billing Staff', 'status': 'completed', 'status_class': 'success'},
-            {'time': '10:15 AM', 'activity': 'Insurance claim submitted', 'user': 'Billing Staff', 'status': 'pending review', 'status_class': 'warning'},
-            {'time': '09:30 AM', 'activity': 'Payment reminder sent', 'user': 'Auto System', 'status': 'sent', 'status_class': 'info'},
-        ]
-
-        return {
-            'daily_revenue': daily_revenue,
-            'pending_payments': pending_payments,
-            'invoices_generated': invoices_generated,
-            'insurance_claims': insurance_claims,
-            'outstanding_payments': outstanding_payments,
-            'recent_activities': recent_activities,
-        }
-    except Exception as e:
-        print(f"Error fetching data: {e}")
-        return {
-            'daily_revenue': random.randint(100000, 150000),
-            'pending_payments': random.randint(80000, 120000),
-            'invoices_generated': random.randint(60, 80),
-            'insurance_claims': random.randint(20, 30),
-            'outstanding_payments': [
-                {'patient_name': 'John Kamau', 'invoice_number': '#INV-2024-001', 'amount': 15000, 'due_date': '2024-12-15', 'status': 'due', 'status_class': 'warning'},
-                {'patient_name': 'Mary Njeri', 'invoice_number': '#INV-2024-002', 'amount': 8500, 'due_date': '2024-12-10', 'status': 'overdue', 'status_class': 'danger'},
-                {'patient_name': 'Peter Ochieng', 'invoice_number': '#INV-2024-003', 'amount': 22000, 'due_date': '2024-12-18', 'status': 'upcoming', 'status_class': 'info'},
-            ],
-            'recent_activities': [
-                {'time': '11:30 AM', 'activity': 'Invoice generated', 'user': 'Billing Staff', 'status': 'completed', 'status_class': 'success'},
-                {'time': '11:00 AM', 'activity': 'Payment processed', 'user': 'Billing Staff', 'status': 'completed', 'status_class': 'success'},
-            ],
-        }
+    outstanding = Bill.objects.aggregate(
+        pending_bills_amount=Sum('total_amount', filter=Q(status__in=['pending', 'partial'])),
+        overdue_bills=Count('pk', filter=Q(status='overdue')),
+        invoices_generated=Count('pk', filter=Q(created_at__date=today)),
+    )
+    insurance_claims = RevenueService.rollups(current_month, today).filter(
+        payment_method='insurance'
+    ).aggregate(total=Sum('payment_count'))['total'] or 0
+
+    return {
+        'revenue_today': RevenueService.total(today),
+        'revenue_month': RevenueService.total(current_month, today),
+        'pending_bills_amount': outstanding['pending_bills_amount'] or 0,
+        'overdue_bills': outstanding['overdue_bills'],
+        'invoices_generated': outstanding['invoices_generated'],
+        'insurance_claims': insurance_claims,
+    }
 
 
 def get_patient_data(patient, today):
     """Get data specific to patients"""
-    try:
-        patient_appointments = Appointment.objects.filter(
-            patient=patient, appointment_date__gte=today,
-            status__in=['scheduled', 'confirmed']
-        ).count()
-        next_appointment = Appointment.objects.filter(
-            patient=patient, appointment_date__gte=today,
-            status__in=['scheduled', 'confirmed']
-        ).order_by('appointment_date', 'appointment_time').first()
-        active_prescriptions = Prescription.objects.filter(
-            medical_record__patient=patient
-        ).count()
-        outstanding_balance = Bill.objects.filter(
-            patient=patient, status='pending'
-        ).aggregate(total=Sum('total_amount'))['total'] or 0
-        upcoming_appointments = Appointment.objects.filter(
+    upcoming_appointments = list(
+        Appointment.objects.filter(
             patient=patient, appointment_date__gte=today,
-            status__in=['scheduled', 'confirmed']
-        ).order_by('appointment_date', 'appointment_time')[:5]
-        active_prescriptions_list = Prescription.objects.filter(
+            status__in=UPCOMING_STATUSES
+        ).select_related('patient__user', 'doctor__user').order_by('appointment_date', 'appointment_time')[:5]
+    )
+    patient_appointments = Appointment.objects.filter(
+        patient=patient, appointment_date__gte=today,
+        status__in=UPCOMING_STATUSES
+    ).count()
+    active_prescriptions_list = list(
+        Prescription.objects.filter(
             medical_record__patient=patient
         ).order_by('-dispensed_at')[:5]
+    )
+    active_prescriptions = Prescription.objects.filter(
+        medical_record__patient=patient
+    ).count()
+    outstanding_balance = Bill.objects.filter(
+        patient=patient, status='pending'
+    ).aggregate(total=Sum('total_amount'))['total'] or 0
+
+    return {
+        'patient_appointments': patient_appointments,
+        'next_appointment': upcoming_appointments[0] if upcoming_appointments else None,
+        'active_prescriptions': active_prescriptions,
+        'outstanding_balance': outstanding_balance,
+        'upcoming_appointments': upcoming_appointments,
+        'active_prescriptions_list': active_prescriptions_list,
+    }
 
-        return {
-            'patient_appointments': patient_appointments,
-            'next_appointment': next_appointment,
-            'active_prescriptions': active_prescriptions,
-            'outstanding_balance': outstanding_balance,
-            'upcoming_appointments': upcoming_appointments,
-            'active_prescriptions_list': active_prescriptions_list,
-        }
-    except Exception as e:
-        print(f"Error fetching patient data: {e}")
-        return {
-            'patient_appointments': random.randint(2, 5),
-            'next_appointment': "Dec 15, 2024",
-            'active_prescriptions': random.randint(1, 4),
-            'outstanding_balance': random.randint(3000, 8000),
-            'upcoming_appointments': [],
-            'active_prescriptions_list': [],
-        }
+
+def get_general_data(today):
+    """Fallback widgets for users without a dedicated dashboard"""
+    return {
+        'recent_appointments': list(
+            Appointment.objects.filter(appointment_date=today).select_related(
+                'patient__user', 'doctor__user'
+            ).order_by('appointment_time')[:8]
+        ),
+        'total_doctors': Doctor.objects.filter(is_available=True).count(),
+        'low_stock': Inventory.objects.filter(
+            quantity_in_stock__lte=F('minimum_stock_level')
+        ).count(),
+        'pending_rx': Prescription.objects.filter(is_dispensed=False).count(),
+        'pending_labs': LabTest.objects.filter(status='pending').count(),
+    }
 
 
 # Additional utility functions
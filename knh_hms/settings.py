@@ -86,6 +86,12 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # BEGIN IMMEDIATE takes SQLite's write lock when a transaction starts, standing in
+        # for the row locks select_for_update() would take on other databases
+        'OPTIONS': {'transaction_mode': 'IMMEDIATE', 'timeout': 20},
+        # A file rather than SQLite's in-memory test database, so each thread of the
+        # concurrency tests gets its own connection that waits on locks like a worker would
+        'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
     }
 }
 
@@ -133,7 +139,64 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Cache shared by every worker process on this host (the SQLite database already ties
+# the app to one host), so invalidations reach all of them. The file backend has no
+# atomic incr and culls at random, so nothing counts in it: invalidation uses random
+# version stamps (dashboard.cache_versions) and counters are deleted and recounted.
+# Deployments spread over several hosts point this at Redis or Memcached instead
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    }
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Number of dated IDs (BILL…, MR…, APT-…) each worker reserves per round-trip; see dashboard.sequences
+ID_ALLOCATOR_BLOCK_SIZE = 10
+
+# Length of one bookable appointment slot; see appointments.services.AvailabilityService
+APPOINTMENT_SLOT_MINUTES = 30
+
+# Rows fetched per database round-trip by the streaming exports in dashboard.exports
+EXPORT_CHUNK_SIZE = 2000
+
+# Pub/sub behind the pharmacy live-update stream; the in-process default only reaches
+# listeners in the publishing process, see pharmacy.events
+PHARMACY_EVENT_BROKER = 'pharmacy.events.InProcessBroker'
+
+# Email is printed to the console until real SMTP settings are configured
+EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+
+# Delivery backend per Notification.delivery_method, used by `manage.py deliver_notifications`;
+# SMS and push have no provider yet and go to the console stand-in (or FileBackend)
+NOTIFICATION_BACKENDS = {
+    'in_app': 'notifications.backends.InAppBackend',
+    'email': 'notifications.backends.EmailBackend',
+    'sms': 'notifications.backends.ConsoleBackend',
+    'push': 'notifications.backends.ConsoleBackend',
+}
+
+# File notifications.backends.FileBackend appends to
+NOTIFICATION_FILE_PATH = BASE_DIR / 'notifications.log'
+
+# Notifications claimed per channel on each pass of the delivery worker
+NOTIFICATION_BATCH_SIZE = 100
+
+# Hours ahead of an appointment that `manage.py send_appointment_reminders` queues its reminder
+APPOINTMENT_REMINDER_HOURS = 24
+
+# Readings that raise a CriticalVitalAlert: metric (see patients.services.VitalsSeries.METRIC_FIELDS)
+# -> 'above' and/or 'below' limits, exclusive
+CRITICAL_VITAL_THRESHOLDS = {
+    'systolic': {'above': 140},
+    'temperature': {'above': 38.0},
+}
+
+# Minutes a technician's claim on a lab test lasts before the test returns to the queue
+LAB_CLAIM_MINUTES = 30
@@ -18,13 +18,19 @@ class MedicalRecord(models.Model):
     def save(self, *args, **kwargs):
         
         if not self.record_id:
-            self.record_id = f"REC{self.patient.patient_id:06d}"
+            from dashboard.sequences import IdAllocator
+            self.record_id = IdAllocator.generate('MR')
         
         super().save(*args, **kwargs)
     
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['-created_at'], name='record_created_idx'),
+            models.Index(fields=['patient', '-created_at'], name='record_patient_created_idx'),
+            models.Index(fields=['doctor', 'created_at'], name='record_doctor_created_idx'),
+        ]
     
     def __str__(self):
         return f"Record {self.record_id} - {self.patient.user.get_full_name()}"
@@ -39,6 +45,17 @@ class Prescription(models.Model):
     is_dispensed = models.BooleanField(default=False)
     dispensed_at = models.DateTimeField(null=True, blank=True)
     dispensed_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        indexes = [
+            # Partial indexes: Django writes boolean filters as bare "col" / "NOT col" on
+            # SQLite, which can't seek an index keyed on is_dispensed but does match these
+            models.Index(fields=['medical_record'], condition=models.Q(is_dispensed=False), name='rx_pending_idx'),
+            models.Index(fields=['-dispensed_at'], condition=models.Q(is_dispensed=True), name='rx_dispensed_idx'),
+            # "Changed since" polling of the pharmacy prescription queue
+            models.Index(fields=['updated_at'], name='rx_updated_idx'),
+        ]
     
     def __str__(self):
         return f"{self.medication_name} - {self.medical_record.patient.user.get_full_name()}"
@@ -58,9 +75,84 @@ class LabTest(models.Model):
     results = models.TextField(blank=True)
     test_date = models.DateTimeField(null=True, blank=True)
     result_date = models.DateTimeField(null=True, blank=True)
+    # Work-queue lease (medical_records.services.LabWorkQueue)
+    claimed_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, related_name='claimed_lab_tests'
+    )
+    claim_expires_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'test_date'], name='labtest_status_date_idx'),
+            models.Index(fields=['-test_date'], name='labtest_date_idx'),
+            # Turnaround metrics over recent results
+            models.Index(fields=['status', 'result_date'], name='labtest_status_result_idx'),
+        ]
     
     def __str__(self):
         return f"{self.test_name} - {self.medical_record.patient.user.get_full_name()}"
+
+class PrescriptionTemplate(models.Model):
+    """A named set of prescription lines doctors can apply in one step (see PrescriptionTemplates)."""
+    key = models.SlugField(max_length=50, unique=True)
+    name = models.CharField(max_length=100)
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['name']
+
+    def __str__(self):
+        return self.name
+
+    @classmethod
+    def get_default_templates(cls):
+        """The templates every installation starts with: key -> (name, lines)."""
+        return {
+            'common_cold': ('Common Cold', [
+                {'medication_name': 'Paracetamol', 'dosage': '500mg', 'frequency': 'Three times daily',
+                 'duration': '5 days', 'instructions': 'Take with food'},
+                {'medication_name': 'Vitamin C', 'dosage': '1000mg', 'frequency': 'Once daily',
+                 'duration': '7 days', 'instructions': 'Take with water'},
+            ]),
+            'hypertension': ('Hypertension', [
+                {'medication_name': 'Amlodipine', 'dosage': '5mg', 'frequency': 'Once daily',
+                 'duration': '30 days', 'instructions': 'Take in the morning'},
+                {'medication_name': 'Hydrochlorothiazide', 'dosage': '25mg', 'frequency': 'Once daily',
+                 'duration': '30 days', 'instructions': 'Take with breakfast'},
+            ]),
+            'diabetes': ('Diabetes', [
+                {'medication_name': 'Metformin', 'dosage': '500mg', 'frequency': 'Twice daily',
+                 'duration': '30 days', 'instructions': 'Take with meals'},
+            ]),
+        }
+
+    @classmethod
+    def ensure_defaults(cls):
+        """Seed the default templates that don't exist yet."""
+        for key, (name, lines) in cls.get_default_templates().items():
+            template, created = cls.objects.get_or_create(key=key, defaults={'name': name})
+            if created:
+                PrescriptionTemplateItem.objects.bulk_create([
+                    PrescriptionTemplateItem(template=template, position=position, **line)
+                    for position, line in enumerate(lines)
+                ])
+
+class PrescriptionTemplateItem(models.Model):
+    template = models.ForeignKey(PrescriptionTemplate, on_delete=models.CASCADE, related_name='items')
+    position = models.PositiveIntegerField(default=0)
+    medication_name = models.CharField(max_length=100)
+    dosage = models.CharField(max_length=50, blank=True)
+    frequency = models.CharField(max_length=100, blank=True)
+    duration = models.CharField(max_length=50, blank=True)
+    instructions = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ['template', 'position']
+
+    def __str__(self):
+        return f"{self.medication_name} ({self.template.name})"
     
     
-admin_model = [MedicalRecord, Prescription, LabTest]
\ No newline at end of file
+admin_model = [MedicalRecord, Prescription, LabTest, PrescriptionTemplate, PrescriptionTemplateItem]
\ No newline at end of file
@@ -0,0 +1,428 @@
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, F, Q
+from django.db.models.functions import Coalesce
+from django.urls import reverse
+from django.utils import timezone
+
+from appointments.models import Appointment
+from billing.models import Bill
+from dashboard.pagination import CursorPaginator, MergedCursorPaginator
+from patients.models import PatientVitals
+from pharmacy.events import publish
+from pharmacy.services import Formulary
+from .models import MedicalRecord, Prescription, LabTest, PrescriptionTemplate, PrescriptionTemplateItem
+
+
+PRESCRIPTION_FIELDS = ['medication_name', 'dosage', 'frequency', 'duration', 'instructions']
+
+
+def parse_prescription_lines(data):
+    """
+    Read the parallel medication_name[]/dosage[]/frequency[]/duration[]/instructions[]
+    lists posted by the record and prescription forms into a list of line dicts,
+    skipping rows without a medication.
+    """
+    columns = {field: data.getlist(f'{field}[]') for field in PRESCRIPTION_FIELDS}
+    lines = []
+    for i in range(len(columns['medication_name'])):
+        line = {field: (values[i] if i < len(values) else '').strip() for field, values in columns.items()}
+        if line['medication_name']:
+            lines.append(line)
+    return lines
+
+
+def _appointment_at(appointment):
+    return timezone.make_aware(datetime.combine(appointment.appointment_date, appointment.appointment_time))
+
+
+class PatientTimeline:
+    """
+    A patient's history as one newest-first stream of events: medical records,
+    prescriptions, lab tests, vitals, appointments and bills.
+
+    Each event type is a keyset-paginated source with a fixed select_related plan
+    (SOURCES), merged by MergedCursorPaginator, so any page of any history costs one
+    query per event type and nothing per row. Prescriptions are dated by their medical
+    record, lab tests by test_date (falling back to their record), appointments by
+    their slot.
+    """
+
+    SOURCES = {
+        'record': (
+            lambda patient: MedicalRecord.objects.filter(patient=patient).select_related('doctor__user'),
+            ['-created_at'],
+            lambda record: record.created_at,
+        ),
+        'prescription': (
+            lambda patient: Prescription.objects.filter(medical_record__patient=patient).select_related(
+                'medical_record__doctor__user', 'dispensed_by'
+            ),
+            ['-medical_record__created_at'],
+            lambda prescription: prescription.medical_record.created_at,
+        ),
+        'lab_test': (
+            lambda patient: LabTest.objects.filter(medical_record__patient=patient).select_related(
+                'medical_record'
+            ).annotate(at=Coalesce('test_date', 'medical_record__created_at')),
+            ['-at'],
+            lambda test: test.at,
+        ),
+        'vitals': (
+            lambda patient: PatientVitals.objects.filter(patient=patient).select_related('recorded_by'),
+            ['-recorded_at'],
+            lambda vitals: vitals.recorded_at,
+        ),
+        'appointment': (
+            lambda patient: Appointment.objects.filter(patient=patient).select_related('doctor__user'),
+            ['-appointment_date', '-appointment_time'],
+            _appointment_at,
+        ),
+        'bill': (
+            lambda patient: Bill.objects.filter(patient=patient),
+            ['-created_at'],
+            lambda bill: bill.created_at,
+        ),
+    }
+
+    @classmethod
+    def page(cls, patient, limit, cursor=None, types=None):
+        """
+        Returns (events, next_cursor), events serialized for JSON. ``types`` limits the
+        timeline to some of the SOURCES names; a cursor is only valid with the same types.
+        """
+        names = [name for name in cls.SOURCES if not types or name in types]
+        paginator = MergedCursorPaginator(
+            {name: (cls.SOURCES[name][0](patient), cls.SOURCES[name][1]) for name in names},
+            limit,
+            key=lambda name, obj: cls.SOURCES[name][2](obj),
+        )
+        items, next_cursor = paginator.get_page(cursor)
+        return [cls.serialize(name, obj) for name, obj in items], next_cursor
+
+    @classmethod
+    def serialize(cls, name, obj):
+        event = {'type': name, 'at': cls.SOURCES[name][2](obj).isoformat()}
+        if name == 'record':
+            event.update({
+                'id': obj.record_id,
+                'title': obj.diagnosis,
+                'doctor': obj.doctor.user.get_full_name(),
+                'symptoms': obj.symptoms,
+                'treatment_plan': obj.treatment_plan,
+                'follow_up_date': obj.follow_up_date.isoformat() if obj.follow_up_date else None,
+                'url': reverse('medical_records:medical_record_detail', args=[obj.record_id]),
+            })
+        elif name == 'prescription':
+            event.update({
+                'id': obj.pk,
+                'title': obj.medication_name,
+                'record_id': obj.medical_record_id,
+                'doctor': obj.medical_record.doctor.user.get_full_name(),
+                'dosage': obj.dosage,
+                'frequency': obj.frequency,
+                'duration': obj.duration,
+                'is_dispensed': obj.is_dispensed,
+                'dispensed_at': obj.dispensed_at.isoformat() if obj.dispensed_at else None,
+                'dispensed_by': obj.dispensed_by.get_full_name() if obj.dispensed_by else None,
+                'url': reverse('medical_records:prescription_detail', args=[obj.pk]),
+            })
+        elif name == 'lab_test':
+            event.update({
+                'id': obj.pk,
+                'title': obj.test_name,
+                'record_id': obj.medical_record_id,
+                'status': obj.status,
+                'results': obj.results,
+                'result_date': obj.result_date.isoformat() if obj.result_date else None,
+                'url': reverse('medical_records:lab_test_detail', args=[obj.pk]),
+            })
+        elif name == 'vitals':
+            event.update({
+                'id': obj.pk,
+                'title': 'Vitals recorded',
+                'recorded_by': obj.recorded_by.get_full_name(),
+                'height': obj.height,
+                'weight': obj.weight,
+                'blood_pressure_systolic': obj.blood_pressure_systolic,
+                'blood_pressure_diastolic': obj.blood_pressure_diastolic,
+                'pulse_rate': obj.pulse_rate,
+                'temperature': obj.temperature,
+            })
+        elif name == 'appointment':
+            event.update({
+                'id': obj.id,
+                'title': obj.reason,
+                'doctor': obj.doctor.user.get_full_name(),
+                'status': obj.status,
+                'url': reverse('appointments:detail', args=[obj.id]),
+            })
+        elif name == 'bill':
+            event.update({
+                'id': obj.bill_id,
+                'title': f'Bill {obj.bill_id}',
+                'status': obj.status,
+                'total_amount': str(obj.total_amount),
+                'amount_paid': str(obj.amount_paid),
+                'balance_due': str(obj.balance_due),
+                'url': reverse('billing:bill_detail', args=[obj.bill_id]),
+            })
+        return event
+
+
+class LabQueueError(Exception):
+    """Raised when lab tests cannot be claimed or have results entered."""
+
+
+class LabWorkQueue:
+    """
+    The lab's work queue: open tests (pending, in_progress) oldest order first, claimed
+    by technicians for LAB_CLAIM_MINUTES at a time.
+
+    Each status is its own partition, read with keyset pagination over the
+    (status, test_date) index, so the queue never touches the completed history. Claims are conditional UPDATEs
+    that only take unclaimed or lapsed tests, so two technicians never get the same
+    test; a lapsed claim simply makes the test claimable again. Results are entered in
+    batches, one transaction per batch. Turnaround is result_date - test_date.
+    """
+
+    STATUSES = ('pending', 'in_progress')
+
+    @staticmethod
+    def lease():
+        return timedelta(minutes=settings.LAB_CLAIM_MINUTES)
+
+    @staticmethod
+    def claimable(user, now):
+        """Tests ``user`` may claim or result: unclaimed, lapsed, or already theirs."""
+        return Q(claimed_by__isnull=True) | Q(claim_expires_at__lte=now) | Q(claimed_by=user)
+
+    @classmethod
+    def page(cls, status, limit, cursor=None):
+        tests = LabTest.objects.filter(status=status).select_related('medical_record__patient__user', 'claimed_by')
+        return CursorPaginator(tests, limit, ['test_date', 'id']).get_page(cursor)
+
+    @classmethod
+    def counts(cls):
+        rows = LabTest.objects.filter(status__in=cls.STATUSES).values('status').annotate(total=Count('id'))
+        return dict({status: 0 for status in cls.STATUSES}, **{row['status']: row['total'] for row in rows})
+
+    @classmethod
+    def claim(cls, user, limit=10, test_ids=None, now=None):
+        """
+        Claim the oldest ``limit`` open tests, or the given ``test_ids`` (renewing claims
+        the user already holds). Claimed tests move to in_progress. Returns the tests won.
+        """
+        now = now or timezone.now()
+        expires = now + cls.lease()
+        open_tests = LabTest.objects.filter(status__in=cls.STATUSES).filter(cls.claimable(user, now))
+        if test_ids:
+            candidates = open_tests.filter(pk__in=test_ids)
+        else:
+            candidates = open_tests.exclude(claimed_by=user).order_by(F('test_date').asc(nulls_last=True), 'id')[:limit]
+        ids = list(candidates.values_list('id', flat=True))
+        # Re-checked in the UPDATE: a test another technician claimed meanwhile is skipped
+        open_tests.filter(pk__in=ids).update(claimed_by=user, claim_expires_at=expires, status='in_progress')
+        return list(
+            LabTest.objects.filter(pk__in=ids, claimed_by=user, claim_expires_at=expires)
+            .select_related('medical_record__patient__user', 'claimed_by').order_by('test_date', 'id')
+        )
+
+    @classmethod
+    def release(cls, user, test_ids):
+        """Hand claimed tests back to the pending queue; returns how many were released."""
+        return LabTest.objects.filter(pk__in=test_ids, claimed_by=user, status='in_progress').update(
+            claimed_by=None, claim_expires_at=None, status='pending',
+        )
+
+    @classmethod
+    def submit_results(cls, user, entries, now=None):
+        """
+        Record results for many tests in one transaction. ``entries`` is a list of
+        {'id', 'results', 'status'} with status 'completed' (the default) or 'cancelled'.
+        Every test must be open and not claimed by someone else, or nothing is saved.
+        """
+        now = now or timezone.now()
+        if not entries:
+            raise LabQueueError('No results to record.')
+        seen = set()
+        for entry in entries:
+            if entry['id'] in seen:
+                raise LabQueueError(f"Lab test {entry['id']} appears more than once.")
+            seen.add(entry['id'])
+            if entry.get('status', 'completed') not in ('completed', 'cancelled'):
+                raise LabQueueError(f"Invalid status for lab test {entry['id']}.")
+            if entry.get('status', 'completed') == 'completed' and not (entry.get('results') or '').strip():
+                raise LabQueueError(f"Results are required for lab test {entry['id']}.")
+
+        with transaction.atomic():
+            for entry in entries:
+                updated = LabTest.objects.filter(pk=entry['id'], status__in=cls.STATUSES).filter(
+                    cls.claimable(user, now)
+                ).update(
+                    results=(entry.get('results') or '').strip(),
+                    status=entry.get('status', 'completed'),
+                    result_date=now,
+                    claimed_by=None,
+                    claim_expires_at=None,
+                )
+                if not updated:
+                    raise LabQueueError(f"Lab test {entry['id']} is not open or is claimed by another technician.")
+        return len(entries)
+
+    @staticmethod
+    def turnaround(since, until=None):
+        """Turnaround (result_date - test_date) of tests completed in the window, in minutes."""
+        until = until or timezone.now()
+        durations = sorted(
+            (result_date - test_date).total_seconds() / 60
+            for test_date, result_date in LabTest.objects.filter(
+                status='completed', result_date__gte=since, result_date__lt=until, test_date__isnull=False,
+            ).values_list('test_date', 'result_date')
+        )
+        hours = max((until - since).total_seconds() / 3600, 1 / 60)
+        if not durations:
+            return {'completed': 0, 'per_hour': 0, 'average_minutes': None, 'median_minutes': None,
+                    'p90_minutes': None, 'max_minutes': None}
+        return {
+            'completed': len(durations),
+            'per_hour': round(len(durations) / hours, 1),
+            'average_minutes': round(sum(durations) / len(durations), 1),
+            'median_minutes': round(durations[len(durations) // 2], 1),
+            'p90_minutes': round(durations[min(len(durations) - 1, int(len(durations) * 0.9))], 1),
+            'max_minutes': round(durations[-1], 1),
+        }
+
+    @staticmethod
+    def serialize(test):
+        patient = test.medical_record.patient
+        return {
+            'id': test.pk,
+            'test_name': test.test_name,
+            'test_description': test.test_description,
+            'status': test.status,
+            'patient_id': patient.patient_id,
+            'patient_name': patient.user.get_full_name(),
+            'record_id': test.medical_record_id,
+            'test_date': test.test_date.isoformat() if test.test_date else None,
+            'claimed_by': test.claimed_by.get_full_name() if test.claimed_by else None,
+            'claim_expires_at': test.claim_expires_at.isoformat() if test.claim_expires_at else None,
+            'url': reverse('medical_records:lab_test_detail', args=[test.pk]),
+        }
+
+
+
+class PrescriptionService:
+    """Writes a record's prescription lines with a single INSERT."""
+
+    @staticmethod
+    def create_prescriptions(record, lines):
+        """
+        Create one Prescription per line dict (see parse_prescription_lines). Names that
+        match the formulary are stored in its spelling, which is what dispensing matches.
+        """
+        prescriptions = [
+            Prescription(
+                medical_record=record,
+                medication_name=Formulary.canonical_name(line['medication_name']) or line['medication_name'],
+                dosage=line.get('dosage', ''),
+                frequency=line.get('frequency', ''),
+                duration=line.get('duration', ''),
+                instructions=line.get('instructions', ''),
+            )
+            for line in lines
+        ]
+        with transaction.atomic():
+            Prescription.objects.bulk_create(prescriptions)
+            # bulk_create sends no post_save, so announce the lines as pharmacy.signals would
+            for prescription in prescriptions:
+                publish('prescription', {
+                    'id': prescription.pk,
+                    'record_id': prescription.medical_record_id,
+                    'medication_name': prescription.medication_name,
+                })
+        return prescriptions
+
+
+class PrescriptionTemplateError(Exception):
+    """Raised when a user may not change a prescription template."""
+
+
+class PrescriptionTemplates:
+    """
+    Prescription templates shared by the record and prescription forms.
+
+    Any doctor may add a template, but only its author or an administrator may replace
+    it; the built-in defaults (no author) are administrator-only.
+
+    All templates are cached as one {key: {'name', 'medications'}} map in the shared
+    cache (see CACHES), built with two queries on a miss and dropped once a change to a
+    template or one of its lines commits (see medical_records.signals), or after
+    CACHE_TIMEOUT seconds at most. An empty table is seeded with
+    PrescriptionTemplate.get_default_templates() on the first read.
+    """
+
+    CACHE_KEY = 'medical_records:prescription_templates'
+    CACHE_TIMEOUT = 300
+
+    @classmethod
+    def all(cls):
+        templates = cache.get(cls.CACHE_KEY)
+        if templates is None:
+            if not PrescriptionTemplate.objects.exists():
+                PrescriptionTemplate.ensure_defaults()
+            templates = {
+                template.key: {
+                    'name': template.name,
+                    'medications': [
+                        {field: getattr(item, field) for field in PRESCRIPTION_FIELDS}
+                        for item in template.items.all()
+                    ],
+                }
+                for template in PrescriptionTemplate.objects.prefetch_related('items')
+            }
+            cache.set(cls.CACHE_KEY, templates, cls.CACHE_TIMEOUT)
+        return templates
+
+    @classmethod
+    def get(cls, key):
+        return cls.all().get(key)
+
+    @staticmethod
+    def can_edit(template, user):
+        return user.role == 'administrator' or (
+            template.created_by_id is not None and template.created_by_id == user.pk
+        )
+
+    @classmethod
+    def save(cls, key, name, lines, user):
+        """Create or replace the template ``key`` with the given line dicts."""
+        with transaction.atomic():
+            template = PrescriptionTemplate.objects.select_for_update().filter(key=key).first()
+            if template is None:
+                template = PrescriptionTemplate.objects.create(key=key, name=name, created_by=user)
+            elif not cls.can_edit(template, user):
+                raise PrescriptionTemplateError(
+                    f'"{template.name}" can only be changed by its author or an administrator.'
+                )
+            else:
+                template.name = name
+                template.save(update_fields=['name', 'updated_at'])
+                template.items.all().delete()
+            PrescriptionTemplateItem.objects.bulk_create([
+                PrescriptionTemplateItem(
+                    template=template, position=position,
+                    **{field: line.get(field, '') for field in PRESCRIPTION_FIELDS},
+                )
+                for position, line in enumerate(lines)
+            ])
+            # Item rows written by bulk_create send no signals
+            transaction.on_commit(cls.invalidate)
+        return template
+
+    @classmethod
+    def invalidate(cls):
+        cache.delete(cls.CACHE_KEY)
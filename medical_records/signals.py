@@ -0,0 +1,15 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import PrescriptionTemplate, PrescriptionTemplateItem
+from .services import PrescriptionTemplates
+
+
+@receiver(post_save, sender=PrescriptionTemplate)
+@receiver(post_delete, sender=PrescriptionTemplate)
+@receiver(post_save, sender=PrescriptionTemplateItem)
+@receiver(post_delete, sender=PrescriptionTemplateItem)
+def invalidate_prescription_templates(sender, instance, **kwargs):
+    # Keep the cached template map in step with admin edits
+    transaction.on_commit(PrescriptionTemplates.invalidate)
@@ -277,29 +277,30 @@ class MedicalRecordsManager {
             return;
         }
 
-        // Mock medication database - in real app, use proper API
-        const medications = [
-            'Paracetamol', 'Ibuprofen', 'Aspirin', 'Amoxicillin', 'Ciprofloxacin',
-            'Metformin', 'Amlodipine', 'Lisinopril', 'Simvastatin', 'Omeprazole',
-            'Prednisolone', 'Dexamethasone', 'Insulin', 'Warfarin', 'Heparin'
-        ];
-
-        const matches = medications.filter(med =>
-            med.toLowerCase().includes(query.toLowerCase())
-        );
-
-        if (matches.length === 0) {
-            suggestionsElement.style.display = 'none';
-            return;
-        }
+        // Formulary lookup (pharmacy.services.Formulary)
+        fetch(`/medical-records/api/medications/?q=${encodeURIComponent(query)}`)
+            .then(response => response.json())
+            .then(data => {
+                if (!data.medications || data.medications.length === 0) {
+                    suggestionsElement.style.display = 'none';
+                    return;
+                }
 
-        suggestionsElement.innerHTML = matches.map(med =>
-            `<div class="suggestion-item" onclick="this.parentElement.previousElementSibling.value='${med}'; this.parentElement.style.display='none';">
-                ${med}
-            </div>`
-        ).join('');
+                suggestionsElement.innerHTML = '';
+                data.medications.forEach(med => {
+                    const item = document.createElement('div');
+                    item.className = 'suggestion-item';
+                    item.textContent = med.generic_name ? `${med.name} (${med.generic_name})` : med.name;
+                    item.addEventListener('click', () => {
+                        suggestionsElement.previousElementSibling.value = med.name;
+                        suggestionsElement.style.display = 'none';
+                    });
+                    suggestionsElement.appendChild(item);
+                });
 
-        suggestionsElement.style.display = 'block';
+                suggestionsElement.style.display = 'block';
+            })
+            .catch(error => console.error('Error loading medications:', error));
     }
 
     initAutoSave() {
@@ -470,22 +471,23 @@ class MedicalRecordsManager {
 
     // Vital signs chart
     initVitalsChart(patientId) {
-        fetch(`/medical-records/vitals/${patientId}/history/`)
+        fetch(`/medical-records/api/vitals-series/${patientId}/`)
             .then(response => response.json())
-            .then(data => this.renderVitalsChart(data))
+            .then(data => this.renderVitalsChart(data.metrics))
             .catch(error => console.error('Error loading vitals:', error));
     }
 
-    renderVitalsChart(vitalsData) {
+    renderVitalsChart(metrics) {
         const chartContainer = document.getElementById('vitalsChart');
-        if (!chartContainer || !vitalsData.length) return;
+        if (!chartContainer || !metrics.systolic.t.length) return;
 
-        // Prepare data for chart
-        const dates = vitalsData.map(v => this.formatDate(v.recorded_at));
-        const bpSystolic = vitalsData.map(v => v.blood_pressure_systolic);
-        const bpDiastolic = vitalsData.map(v => v.blood_pressure_diastolic);
-        const pulse = vitalsData.map(v => v.pulse_rate);
-        const temperature = vitalsData.map(v => v.temperature);
+        // Columns from VitalsSeries, oldest first; the summary shows the newest average
+        const latest = column => column.avg.slice().reverse();
+        const dates = metrics.systolic.t.map(t => this.formatDate(new Date(t * 1000))).reverse();
+        const bpSystolic = latest(metrics.systolic);
+        const bpDiastolic = latest(metrics.diastolic);
+        const pulse = latest(metrics.pulse);
+        const temperature = latest(metrics.temperature);
 
         // Simple canvas-based chart (you can replace with Chart.js or similar)
         this.drawVitalsChart(chartContainer, {
@@ -544,51 +546,18 @@ class PrescriptionTemplates {
     }
 
     loadTemplates() {
-        const saved = localStorage.getItem('prescription_templates');
-        return saved ? JSON.parse(saved) : this.getDefaultTemplates();
-    }
-
-    getDefaultTemplates() {
-        return {
-            'common_cold': {
-                name: 'Common Cold',
-                medications: [
-                    {
-                        name: 'Paracetamol',
-                        dosage: '500mg',
-                        frequency: 'Three times daily',
-                        duration: '5 days',
-                        instructions: 'Take with food'
-                    },
-                    {
-                        name: 'Vitamin C',
-                        dosage: '1000mg',
-                        frequency: 'Once daily',
-                        duration: '7 days',
-                        instructions: 'Take with water'
-                    }
-                ]
-            },
-            'hypertension': {
-                name: 'Hypertension Management',
-                medications: [
-                    {
-                        name: 'Amlodipine',
-                        dosage: '5mg',
-                        frequency: 'Once daily',
-                        duration: '30 days',
-                        instructions: 'Take in the morning'
-                    },
-                    {
-                        name: 'Hydrochlorothiazide',
-                        dosage: '25mg',
-                        frequency: 'Once daily',
-                        duration: '30 days',
-                        instructions: 'Take with breakfast'
-                    }
-                ]
-            }
-        };
+        // Shared templates (medical_records.services.PrescriptionTemplates)
+        fetch('/medical-records/api/prescription-template/')
+            .then(response => response.json())
+            .then(data => {
+                this.templates = {};
+                data.templates.forEach(template => {
+                    this.templates[template.key] = template;
+                });
+                this.updateTemplateSelect();
+            })
+            .catch(error => console.error('Error loading prescription templates:', error));
+        return {};
     }
 
     applyTemplate(templateId) {
@@ -607,7 +576,7 @@ class PrescriptionTemplates {
 
             const row = container.children[index];
             if (row) {
-                row.querySelector('input[name="medication_name[]"]').value = med.name;
+                row.querySelector('input[name="medication_name[]"]').value = med.medication_name;
                 row.querySelector('input[name="dosage[]"]').value = med.dosage;
                 row.querySelector('select[name="frequency[]"]').value = med.frequency;
                 row.querySelector('input[name="duration[]"]').value = med.duration;
@@ -626,16 +595,26 @@ class PrescriptionTemplates {
             return;
         }
 
-        const templateId = templateName.toLowerCase().replace(/\s+/g, '_');
-        this.templates[templateId] = {
-            name: templateName,
-            medications: medications
-        };
-
-        this.saveTemplates();
-        this.updateTemplateSelect();
-
-        alert('Template saved successfully!');
+        const csrfToken = document.querySelector('[name=csrfmiddlewaretoken]');
+        fetch('/medical-records/api/prescription-template/', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'X-CSRFToken': csrfToken ? csrfToken.value : ''
+            },
+            body: JSON.stringify({ name: templateName, medications: medications })
+        })
+            .then(response => response.json().then(data => ({ ok: response.ok, data })))
+            .then(({ ok, data }) => {
+                if (!ok) {
+                    alert(data.error || 'Could not save template');
+                    return;
+                }
+                this.templates[data.key] = data;
+                this.updateTemplateSelect();
+                alert('Template saved successfully!');
+            })
+            .catch(error => console.error('Error saving prescription template:', error));
     }
 
     getCurrentPrescriptions() {
@@ -646,7 +625,7 @@ class PrescriptionTemplates {
             const name = row.querySelector('input[name="medication_name[]"]').value.trim();
             if (name) {
                 medications.push({
-                    name: name,
+                    medication_name: name,
                     dosage: row.querySelector('input[name="dosage[]"]').value,
                     frequency: row.querySelector('select[name="frequency[]"]').value,
                     duration: row.querySelector('input[name="duration[]"]').value,
@@ -658,10 +637,6 @@ class PrescriptionTemplates {
         return medications;
     }
 
-    saveTemplates() {
-        localStorage.setItem('prescription_templates', JSON.stringify(this.templates));
-    }
-
     updateTemplateSelect() {
         const select = document.getElementById('prescriptionTemplate');
         if (!select) return;
@@ -1,3 +1,387 @@
-from django.test import TestCase
+import json
+import threading
+from collections import Counter
+from datetime import datetime, time, timedelta
+from decimal import Decimal
 
-# Create your tests here.
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.http import QueryDict
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from accounts.models import User
+from appointments.models import Appointment, Doctor
+from billing.models import Bill, BillingStaff
+from patients.models import Patient, PatientVitals
+from pharmacy.models import Medicine
+from .models import LabTest, MedicalRecord, Prescription, PrescriptionTemplate
+from .services import LabWorkQueue, PrescriptionService, PrescriptionTemplates, parse_prescription_lines
+
+
+class LabResultsBatchApiTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        doctor_user = User.objects.create_user(email='doctor@example.com', role='doctor')
+        doctor = Doctor.objects.get(user=doctor_user)
+        patient = Patient.objects.get(user=User.objects.create_user(email='patient@example.com', role='patient'))
+        record = MedicalRecord.objects.create(
+            patient=patient, doctor=doctor, diagnosis='Anaemia', symptoms='Fatigue', treatment_plan='Iron',
+        )
+        self.test = LabTest.objects.create(medical_record=record, test_name='FBC', test_description='Full blood count')
+        self.client.force_login(doctor_user)
+
+    def post(self, entries):
+        return self.client.post(
+            reverse('medical_records:lab_results_batch_api'),
+            json.dumps({'results': entries}), content_type='application/json',
+        )
+
+    def test_non_string_results_are_rejected(self):
+        for results in (12.5, ['Hb 9.1'], {'hb': 9.1}):
+            with self.subTest(results=results):
+                response = self.post([{'id': self.test.pk, 'results': results}])
+                self.assertEqual(response.status_code, 400)
+        response = self.post([{'id': self.test.pk, 'results': 'Hb 9.1', 'status': ['completed']}])
+        self.assertEqual(response.status_code, 400)
+        self.test.refresh_from_db()
+        self.assertEqual(self.test.status, 'pending')
+
+    def test_results_are_saved(self):
+        response = self.post([{'id': self.test.pk, 'results': ' Hb 9.1 g/dL '}])
+        self.assertEqual(response.status_code, 200)
+        self.test.refresh_from_db()
+        self.assertEqual((self.test.status, self.test.results), ('completed', 'Hb 9.1 g/dL'))
+
+
+class PatientTimelineApiTests(TestCase):
+    """Paging the merged timeline over every event type, with ties across types."""
+
+    def setUp(self):
+        cache.clear()
+        doctor_user = User.objects.create_user(email='doctor@example.com', role='doctor')
+        doctor = Doctor.objects.get(user=doctor_user)
+        self.patient = Patient.objects.get(user=User.objects.create_user(email='patient@example.com', role='patient'))
+        staff = BillingStaff.objects.get(
+            user=User.objects.create_user(email='billing@example.com', role='billing_staff'),
+        )
+        base = timezone.make_aware(datetime.combine(timezone.localdate() - timedelta(days=10), time(9, 0)))
+
+        def at(days):
+            return base + timedelta(days=days)
+
+        records = []
+        for days in (0, 1, 1, 3):
+            record = MedicalRecord.objects.create(
+                patient=self.patient, doctor=doctor, diagnosis='Review', symptoms='None', treatment_plan='None',
+            )
+            MedicalRecord.objects.filter(pk=record.pk).update(created_at=at(days))
+            records.append(record)
+        for record in (records[1], records[1], records[3]):
+            Prescription.objects.create(
+                medical_record=record, medication_name='Amoxicillin', dosage='500mg',
+                frequency='Three times daily', duration='5 days',
+            )
+        for record, test_date in ((records[2], at(1)), (records[0], None), (records[3], at(5))):
+            LabTest.objects.create(
+                medical_record=record, test_name='FBC', test_description='Full blood count', test_date=test_date,
+            )
+        for _ in range(2):
+            vitals = PatientVitals.objects.create(patient=self.patient, recorded_by=doctor_user, pulse_rate=70)
+            PatientVitals.objects.filter(pk=vitals.pk).update(recorded_at=at(2))
+        for days in (1, 3, 7):
+            moment = timezone.localtime(at(days))
+            Appointment.objects.create(
+                patient=self.patient, doctor=doctor, appointment_date=moment.date(),
+                appointment_time=moment.time(), reason='Review', status='completed',
+            )
+        for days in (3, 6):
+            bill = Bill.objects.create(
+                patient=self.patient, created_by=staff, due_date=timezone.localdate(), total_amount=Decimal('10'),
+            )
+            Bill.objects.filter(pk=bill.pk).update(created_at=at(days))
+        self.total = 4 + 3 + 3 + 2 + 3 + 2
+        self.client.force_login(doctor_user)
+
+    def fetch(self, limit, **params):
+        url = reverse('medical_records:patient_timeline_api', args=[self.patient.patient_id])
+        events = []
+        pages = 0
+        cursor = None
+        while True:
+            response = self.client.get(url, {'limit': limit, **params, **({'cursor': cursor} if cursor else {})})
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            self.assertLessEqual(len(data['events']), limit)
+            events += data['events']
+            pages += 1
+            cursor = data['next_cursor']
+            if not cursor:
+                return events, pages
+
+    def test_pages_match_one_big_page(self):
+        everything, pages = self.fetch(100)
+        self.assertEqual(pages, 1)
+        self.assertEqual(len(everything), self.total)
+        moments = [datetime.fromisoformat(event['at']) for event in everything]
+        self.assertEqual(moments, sorted(moments, reverse=True))
+        self.assertEqual(Counter(event['type'] for event in everything), {
+            'record': 4, 'prescription': 3, 'lab_test': 3, 'vitals': 2, 'appointment': 3, 'bill': 2,
+        })
+
+        for limit in (1, 2, 4, 5):
+            with self.subTest(limit=limit):
+                paged, pages = self.fetch(limit)
+                self.assertEqual(
+                    [(event['type'], event['id']) for event in paged],
+                    [(event['type'], event['id']) for event in everything],
+                )
+                self.assertEqual(pages, -(-self.total // limit))
+
+    def test_types_filter(self):
+        events, _ = self.fetch(2, types='bill,lab_test')
+        self.assertEqual(Counter(event['type'] for event in events), {'lab_test': 3, 'bill': 2})
+        # The lab test without a test_date is dated by its record, the oldest event
+        self.assertEqual(events[-1]['type'], 'lab_test')
+
+    def test_patients_see_only_their_own_timeline(self):
+        other = User.objects.create_user(email='other@example.com', role='patient')
+        self.client.force_login(other)
+        url = reverse('medical_records:patient_timeline_api', args=[self.patient.patient_id])
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+
+def make_lab_tests(count):
+    doctor = Doctor.objects.get(user=User.objects.create_user(email='doctor@example.com', role='doctor'))
+    patient = Patient.objects.get(user=User.objects.create_user(email='patient@example.com', role='patient'))
+    record = MedicalRecord.objects.create(
+        patient=patient, doctor=doctor, diagnosis='Anaemia', symptoms='Fatigue', treatment_plan='Iron',
+    )
+    now = timezone.now()
+    return [
+        LabTest.objects.create(
+            medical_record=record, test_name=f'Test {i}', test_description='Panel',
+            test_date=now - timedelta(hours=count - i),
+        )
+        for i in range(count)
+    ]
+
+
+class LabWorkQueueTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.tests = make_lab_tests(4)
+        self.first = User.objects.create_user(email='tech1@example.com', role='doctor')
+        self.second = User.objects.create_user(email='tech2@example.com', role='doctor')
+
+    def claim(self, user, payload):
+        self.client.force_login(user)
+        return self.client.post(
+            reverse('medical_records:lab_queue_claim_api'), json.dumps(payload), content_type='application/json',
+        )
+
+    def test_claims_take_the_oldest_open_tests(self):
+        response = self.claim(self.first, {'limit': 2})
+        self.assertEqual([test['id'] for test in response.json()['tests']], [test.pk for test in self.tests[:2]])
+        response = self.claim(self.second, {'limit': 5})
+        self.assertEqual([test['id'] for test in response.json()['tests']], [test.pk for test in self.tests[2:]])
+        # Someone else's claim cannot be taken by id
+        self.assertEqual(self.claim(self.second, {'ids': [self.tests[0].pk]}).json()['tests'], [])
+        self.assertEqual(LabWorkQueue.counts(), {'pending': 0, 'in_progress': 4})
+
+    def test_lapsed_claims_return_to_the_queue(self):
+        now = timezone.now()
+        claimed = LabWorkQueue.claim(self.first, limit=1, now=now)
+        self.assertEqual(claimed, self.tests[:1])
+        self.assertEqual(LabWorkQueue.claim(self.second, test_ids=[self.tests[0].pk], now=now), [])
+        lapsed = now + LabWorkQueue.lease()
+        self.assertEqual(LabWorkQueue.claim(self.second, test_ids=[self.tests[0].pk], now=lapsed), self.tests[:1])
+        self.tests[0].refresh_from_db()
+        self.assertEqual((self.tests[0].claimed_by, self.tests[0].status), (self.second, 'in_progress'))
+
+    def test_release_hands_tests_back(self):
+        LabWorkQueue.claim(self.first, limit=2)
+        self.assertEqual(LabWorkQueue.release(self.second, [test.pk for test in self.tests]), 0)
+        self.assertEqual(LabWorkQueue.release(self.first, [test.pk for test in self.tests]), 2)
+        self.assertEqual(LabWorkQueue.counts(), {'pending': 4, 'in_progress': 0})
+
+    def test_malformed_ids_and_limits_are_rejected(self):
+        for payload in (
+            {'ids': str(self.tests[0].pk)}, {'ids': [True]}, {'ids': [str(self.tests[0].pk)]},
+            {'ids': {'id': self.tests[0].pk}}, {'ids': [1.5]}, {'limit': True}, {'limit': '5'}, {'limit': 0},
+        ):
+            with self.subTest(payload=payload):
+                self.assertEqual(self.claim(self.first, payload).status_code, 400)
+        self.assertEqual(LabWorkQueue.counts(), {'pending': 4, 'in_progress': 0})
+        self.client.force_login(self.first)
+        response = self.client.post(
+            reverse('medical_records:lab_queue_release_api'), json.dumps({'ids': '12'}),
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+class LabQueueClaimConcurrencyTests(TransactionTestCase):
+    """Technicians claiming from the same queue at once never get the same test."""
+
+    WORKERS = 2
+
+    def setUp(self):
+        cache.clear()
+        self.tests = make_lab_tests(20)
+        self.users = [
+            User.objects.create_user(email=f'tech{i}@example.com', role='doctor') for i in range(self.WORKERS)
+        ]
+
+    def test_concurrent_claims_are_exclusive(self):
+        barrier = threading.Barrier(self.WORKERS)
+        claims = {}
+
+        def work(user):
+            claimed = []
+            try:
+                barrier.wait()
+                # A claim that lost its candidates to the other worker comes back short;
+                # keep claiming until the queue has nothing left to give
+                while True:
+                    batch = LabWorkQueue.claim(user, limit=3)
+                    claimed += [test.pk for test in batch]
+                    if not batch and not LabTest.objects.filter(claimed_by__isnull=True).exists():
+                        break
+            except Exception as exc:
+                claimed.append(exc)
+            finally:
+                connection.close()
+            claims[user.pk] = claimed
+
+        threads = [threading.Thread(target=work, args=(user,)) for user in self.users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        claimed = [pk for batch in claims.values() for pk in batch]
+        self.assertEqual(sorted(claimed), sorted(test.pk for test in self.tests), claims)
+        for user in self.users:
+            self.assertEqual(
+                set(LabTest.objects.filter(claimed_by=user).values_list('pk', flat=True)), set(claims[user.pk]),
+            )
+
+
+class PrescriptionEntryTests(TestCase):
+    """Several prescription lines entered at once from the record and prescription forms."""
+
+    def setUp(self):
+        cache.clear()
+        doctor_user = User.objects.create_user(email='doctor@example.com', role='doctor')
+        patient = Patient.objects.get(user=User.objects.create_user(email='patient@example.com', role='patient'))
+        self.record = MedicalRecord.objects.create(
+            patient=patient, doctor=Doctor.objects.get(user=doctor_user), diagnosis='Malaria', symptoms='Fever',
+            treatment_plan='ACT',
+        )
+        Medicine.objects.create(name='Artemether', manufacturer='KEMSA', unit_of_measurement='tablets')
+        self.client.force_login(doctor_user)
+
+    def test_lines_are_read_from_the_parallel_lists(self):
+        data = QueryDict(mutable=True)
+        data.setlist('medication_name[]', [' artemether ', '', 'Zinc'])
+        data.setlist('dosage[]', ['80mg', '1', '20mg'])
+        data.setlist('frequency[]', ['Twice daily'])
+        self.assertEqual(parse_prescription_lines(data), [
+            {'medication_name': 'artemether', 'dosage': '80mg', 'frequency': 'Twice daily', 'duration': '',
+             'instructions': ''},
+            {'medication_name': 'Zinc', 'dosage': '20mg', 'frequency': '', 'duration': '', 'instructions': ''},
+        ])
+
+    def test_lines_are_written_with_one_insert(self):
+        lines = [{'medication_name': f'Medicine {i}', 'dosage': '1'} for i in range(5)]
+        with CaptureQueriesContext(connection) as queries:
+            PrescriptionService.create_prescriptions(self.record, lines)
+        inserts = [q for q in queries if q['sql'].startswith('INSERT INTO "medical_records_prescription"')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(self.record.prescriptions.count(), 5)
+
+    def test_form_stores_formulary_spelling(self):
+        response = self.client.post(
+            reverse('medical_records:create_prescription', args=[self.record.record_id]), {
+                'medication_name[]': ['ARTEMETHER', 'Zinc', ''],
+                'dosage[]': ['80mg', '20mg', ''],
+                'frequency[]': ['Twice daily', 'Once daily', ''],
+                'duration[]': ['3 days', '10 days', ''],
+                'instructions[]': ['', 'With food', ''],
+            },
+        )
+        self.assertRedirects(
+            response, reverse('medical_records:medical_record_detail', args=[self.record.record_id]),
+            fetch_redirect_response=False,
+        )
+        self.assertEqual(
+            list(self.record.prescriptions.order_by('pk').values_list('medication_name', 'dosage', 'instructions')),
+            [('Artemether', '80mg', ''), ('Zinc', '20mg', 'With food')],
+        )
+
+
+class PrescriptionTemplatesTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.doctor = User.objects.create_user(email='doctor@example.com', role='doctor')
+        self.other = User.objects.create_user(email='other@example.com', role='doctor')
+        self.admin = User.objects.create_user(email='admin@example.com', role='administrator')
+        self.lines = [{'medication_name': 'Artemether', 'dosage': '80mg', 'frequency': 'Twice daily'}]
+
+    def post(self, user, name, medications, key=None):
+        self.client.force_login(user)
+        return self.client.post(
+            reverse('medical_records:get_prescription_template'),
+            json.dumps({'name': name, 'key': key, 'medications': medications}), content_type='application/json',
+        )
+
+    def medications(self, key):
+        return [line['medication_name'] for line in PrescriptionTemplates.get(key)['medications']]
+
+    def test_templates_are_served_from_the_cache(self):
+        self.assertEqual(self.medications('common_cold'), ['Paracetamol', 'Vitamin C'])
+        with self.assertNumQueries(0):
+            self.assertEqual(set(PrescriptionTemplates.all()), set(PrescriptionTemplate.get_default_templates()))
+
+    def test_saves_reach_the_cache_on_commit(self):
+        PrescriptionTemplates.all()
+        with self.captureOnCommitCallbacks(execute=True):
+            PrescriptionTemplates.save('malaria', 'Malaria', self.lines, self.doctor)
+            self.assertIsNone(PrescriptionTemplates.get('malaria'))
+        self.assertEqual(self.medications('malaria'), ['Artemether'])
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            try:
+                with transaction.atomic():
+                    PrescriptionTemplates.save('malaria', 'Malaria', [{'medication_name': 'Quinine'}], self.doctor)
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+        self.assertEqual(callbacks, [])
+        self.assertEqual(self.medications('malaria'), ['Artemether'])
+
+    def test_only_the_author_or_an_administrator_may_replace_a_template(self):
+        PrescriptionTemplates.all()
+        response = self.post(self.doctor, 'Common Cold', self.lines)
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.medications('common_cold'), ['Paracetamol', 'Vitamin C'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.post(self.doctor, 'Malaria', self.lines).status_code, 201)
+        self.assertEqual(PrescriptionTemplate.objects.get(key='malaria').created_by, self.doctor)
+        quinine = [{'medication_name': 'Quinine', 'dosage': '600mg'}]
+        self.assertEqual(self.post(self.other, 'Malaria', quinine).status_code, 403)
+        self.assertEqual(self.medications('malaria'), ['Artemether'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.post(self.doctor, 'Malaria (severe)', quinine, key='malaria').status_code, 201)
+            self.assertEqual(self.post(self.admin, 'Common Cold', self.lines).status_code, 201)
+        self.assertEqual(PrescriptionTemplates.get('malaria')['name'], 'Malaria (severe)')
+        self.assertEqual(self.medications('malaria'), ['Quinine'])
+        self.assertEqual(self.medications('common_cold'), ['Artemether'])
@@ -29,13 +29,22 @@ urlpatterns = [
     path('lab-tests/<int:test_id>/', views.lab_test_detail, name='lab_test_detail'),
     path('lab-tests/<int:test_id>/edit/', views.edit_lab_test, name='edit_lab_test'),
     path('lab-tests/<int:test_id>/results/', views.update_lab_results, name='update_lab_results'),
+    path('api/lab-queue/', views.lab_queue_api, name='lab_queue_api'),
+    path('api/lab-queue/claim/', views.lab_queue_claim_api, name='lab_queue_claim_api'),
+    path('api/lab-queue/release/', views.lab_queue_release_api, name='lab_queue_release_api'),
+    path('api/lab-queue/results/', views.lab_results_batch_api, name='lab_results_batch_api'),
+    path('api/lab-queue/turnaround/', views.lab_turnaround_api, name='lab_turnaround_api'),
     
     # Vitals
     path('vitals/record/<str:patient_id>/', views.record_vitals, name='record_vitals'),
     path('vitals/<str:patient_id>/history/', views.vitals_history, name='vitals_history'),
+    path('vitals/alerts/<int:alert_id>/acknowledge/', views.acknowledge_vital_alert, name='acknowledge_vital_alert'),
+    path('api/vitals-series/<str:patient_id>/', views.vitals_series_api, name='vitals_series_api'),
     
     # API endpoints
     path('api/patient-search/', views.patient_search, name='patient_search'),
     path('api/medical-history/<str:patient_id>/', views.get_medical_history, name='get_medical_history'),
+    path('api/timeline/<str:patient_id>/', views.patient_timeline_api, name='patient_timeline_api'),
     path('api/prescription-template/', views.get_prescription_template, name='get_prescription_template'),
+    path('api/medications/', views.medication_suggestions_api, name='medication_suggestions_api'),
 ]
\ No newline at end of file
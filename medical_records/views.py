@@ -3,13 +3,24 @@ from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.http import JsonResponse
 from django.core.paginator import Paginator
+from django.db import transaction
 from django.db.models import Q
 from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.text import slugify
+from datetime import datetime, timedelta
 import json
 
 from .models import MedicalRecord, Prescription, LabTest
 from patients.models import Patient, PatientVitals
+from patients.services import CriticalVitalsMonitor, PatientSearchIndex, VitalsSeries
 from appointments.models import Doctor, Appointment
+from dashboard.pagination import CursorPaginator, page_limit
+from pharmacy.services import Formulary
+from .services import (
+    PRESCRIPTION_FIELDS, LabQueueError, LabWorkQueue, PatientTimeline, PrescriptionService,
+    PrescriptionTemplateError, PrescriptionTemplates, parse_prescription_lines,
+)
 
 @login_required
 def medical_records_dashboard(request):
@@ -32,13 +43,11 @@ def medical_records_dashboard(request):
             'medical_record__patient__user'
         ).order_by('-test_date')[:5],
         
-        'critical_vitals': PatientVitals.objects.select_related(
-            'patient__user'
-        ).filter(
-            # Add conditions for critical vitals (high BP, fever, etc.)
-            Q(blood_pressure_systolic__gt=140) |
-            Q(temperature__gt=38.0)
-        ).order_by('-recorded_at')[:5],
+        # Open CriticalVitalAlert rows, raised when the vitals were recorded
+        'critical_vitals': CriticalVitalsMonitor.open_alerts().select_related(
+            'patient__user', 'vitals'
+        )[:5],
+        'critical_vitals_count': CriticalVitalsMonitor.open_alerts().count(),
     }
     return render(request, 'medical_records/dashboard.html', context)
 
@@ -56,11 +65,7 @@ def medical_record_list(request):
     date_to = request.GET.get('date_to')
     
     if patient_search:
-        records = records.filter(
-            Q(patient__user__first_name__icontains=patient_search) |
-            Q(patient__user__last_name__icontains=patient_search) |
-            Q(patient__patient_id__icontains=patient_search)
-        )
+        records = records.filter(patient__in=PatientSearchIndex.matching(patient_search))
     if doctor_search:
         records = records.filter(
             Q(doctor__user__first_name__icontains=doctor_search) |
@@ -71,9 +76,8 @@ def medical_record_list(request):
     if date_to:
         records = records.filter(created_at__date__lte=date_to)
     
-    paginator = Paginator(records, 20)
-    page_number = request.GET.get('page')
-    records = paginator.get_page(page_number)
+    paginator = CursorPaginator(records, 20, ['-created_at'], estimate_count=True)
+    records = paginator.get_page(request.GET.get('cursor'))
     
     context = {
         'records': records,
@@ -104,26 +108,24 @@ def create_medical_record(request, patient_id):
             # Get doctor
             doctor = Doctor.objects.get(user=request.user)
             
-            # Generate record ID
-            record_id = f"MR{timezone.now().strftime('%Y%m%d')}{MedicalRecord.objects.count() + 1:04d}"
-            
             # Get appointment if provided
             appointment = None
             if appointment_id:
                 appointment = get_object_or_404(Appointment, id=appointment_id)
             
-            # Create medical record
-            record = MedicalRecord.objects.create(
-                record_id=record_id,
-                patient=patient,
-                doctor=doctor,
-                appointment=appointment,
-                diagnosis=diagnosis,
-                symptoms=symptoms,
-                treatment_plan=treatment_plan,
-                notes=notes,
-                follow_up_date=follow_up_date if follow_up_date else None
-            )
+            # Create medical record and the prescriptions entered with it
+            with transaction.atomic():
+                record = MedicalRecord.objects.create(
+                    patient=patient,
+                    doctor=doctor,
+                    appointment=appointment,
+                    diagnosis=diagnosis,
+                    symptoms=symptoms,
+                    treatment_plan=treatment_plan,
+                    notes=notes,
+                    follow_up_date=follow_up_date if follow_up_date else None
+                )
+                PrescriptionService.create_prescriptions(record, parse_prescription_lines(request.POST))
             
             messages.success(request, f'Medical record {record.record_id} created successfully!')
             return redirect('medical_records:medical_record_detail', record_id=record.record_id)
@@ -171,22 +173,22 @@ def patient_medical_history(request, patient_id):
     # Get all medical records
     medical_records = MedicalRecord.objects.filter(
         patient=patient
-    ).order_by('-created_at')
+    ).select_related('doctor__user').order_by('-created_at')
     
     # Get all prescriptions
     prescriptions = Prescription.objects.filter(
         medical_record__patient=patient
-    ).order_by('-medical_record__created_at')
+    ).select_related('medical_record', 'dispensed_by').order_by('-medical_record__created_at')
     
     # Get all lab tests
     lab_tests = LabTest.objects.filter(
         medical_record__patient=patient
-    ).order_by('-test_date')
+    ).select_related('medical_record').order_by('-test_date')
     
     # Get vitals history
     vitals = PatientVitals.objects.filter(
         patient=patient
-    ).order_by('-recorded_at')[:10]
+    ).select_related('recorded_by').order_by('-recorded_at')[:10]
     
     context = {
         'patient': patient,
@@ -204,22 +206,7 @@ def create_prescription(request, record_id):
     
     if request.method == 'POST':
         try:
-            medications = request.POST.getlist('medication_name[]')
-            dosages = request.POST.getlist('dosage[]')
-            frequencies = request.POST.getlist('frequency[]')
-            durations = request.POST.getlist('duration[]')
-            instructions_list = request.POST.getlist('instructions[]')
-            
-            for i in range(len(medications)):
-                if medications[i]:  
-                    Prescription.objects.create(
-                        medical_record=record,
-                        medication_name=medications[i],
-                        dosage=dosages[i] if i < len(dosages) else '',
-                        frequency=frequencies[i] if i < len(frequencies) else '',
-                        duration=durations[i] if i < len(durations) else '',
-                        instructions=instructions_list[i] if i < len(instructions_list) else ''
-                    )
+            PrescriptionService.create_prescriptions(record, parse_prescription_lines(request.POST))
             
             messages.success(request, 'Prescriptions created successfully!')
             return redirect('medical_records:medical_record_detail', record_id=record.record_id)
@@ -239,16 +226,18 @@ def record_vitals(request, patient_id):
     
     if request.method == 'POST':
         try:
-            PatientVitals.objects.create(
-                patient=patient,
-                recorded_by=request.user,
-                height=request.POST.get('height') or None,
-                weight=request.POST.get('weight') or None,
-                blood_pressure_systolic=request.POST.get('bp_systolic') or None,
-                blood_pressure_diastolic=request.POST.get('bp_diastolic') or None,
-                pulse_rate=request.POST.get('pulse_rate') or None,
-                temperature=request.POST.get('temperature') or None,
-            )
+            # The reading, its rollups and any critical alerts are written together
+            with transaction.atomic():
+                PatientVitals.objects.create(
+                    patient=patient,
+                    recorded_by=request.user,
+                    height=request.POST.get('height') or None,
+                    weight=request.POST.get('weight') or None,
+                    blood_pressure_systolic=request.POST.get('bp_systolic') or None,
+                    blood_pressure_diastolic=request.POST.get('bp_diastolic') or None,
+                    pulse_rate=request.POST.get('pulse_rate') or None,
+                    temperature=request.POST.get('temperature') or None,
+                )
             
             messages.success(request, 'Vitals recorded successfully!')
             return redirect('medical_records:patient_medical_history', patient_id=patient_id)
@@ -267,16 +256,22 @@ def record_vitals(request, patient_id):
     }
     return render(request, 'medical_records/record_vitals.html', context)
 
+@login_required
+def acknowledge_vital_alert(request, alert_id):
+    """Mark a critical-vitals alert as reviewed"""
+    if request.method == 'POST':
+        if request.user.role == 'patient':
+            messages.error(request, 'Access denied.')
+        elif CriticalVitalsMonitor.acknowledge([alert_id], request.user):
+            messages.success(request, 'Alert acknowledged.')
+    return redirect('medical_records:medical_records_dashboard')
+
 @login_required
 def patient_search(request):
     """API endpoint for patient search"""
     query = request.GET.get('q', '')
     if query:
-        patients = Patient.objects.filter(
-            Q(user__first_name__icontains=query) |
-            Q(user__last_name__icontains=query) |
-            Q(patient_id__icontains=query)
-        ).select_related('user')[:10]
+        patients = PatientSearchIndex.search(query, limit=10)
         
         results = []
         for patient in patients:
@@ -305,11 +300,7 @@ def prescription_list(request):
     date_to = request.GET.get('date_to')
     
     if patient_search:
-        prescriptions = prescriptions.filter(
-            Q(medical_record__patient__user__first_name__icontains=patient_search) |
-            Q(medical_record__patient__user__last_name__icontains=patient_search) |
-            Q(medical_record__patient__patient_id__icontains=patient_search)
-        )
+        prescriptions = prescriptions.filter(medical_record__patient__in=PatientSearchIndex.matching(patient_search))
     
     if status == 'dispensed':
         prescriptions = prescriptions.filter(is_dispensed=True)
@@ -321,9 +312,8 @@ def prescription_list(request):
     if date_to:
         prescriptions = prescriptions.filter(medical_record__created_at__date__lte=date_to)
     
-    paginator = Paginator(prescriptions, 25)
-    page_number = request.GET.get('page')
-    prescriptions = paginator.get_page(page_number)
+    paginator = CursorPaginator(prescriptions, 25, ['-medical_record__created_at'], estimate_count=True)
+    prescriptions = paginator.get_page(request.GET.get('cursor'))
     
     context = {
         'prescriptions': prescriptions,
@@ -448,11 +438,7 @@ def lab_test_list(request):
     date_to = request.GET.get('date_to')
     
     if patient_search:
-        lab_tests = lab_tests.filter(
-            Q(medical_record__patient__user__first_name__icontains=patient_search) |
-            Q(medical_record__patient__user__last_name__icontains=patient_search) |
-            Q(medical_record__patient__patient_id__icontains=patient_search)
-        )
+        lab_tests = lab_tests.filter(medical_record__patient__in=PatientSearchIndex.matching(patient_search))
     
     if status:
         lab_tests = lab_tests.filter(status=status)
@@ -462,9 +448,8 @@ def lab_test_list(request):
     if date_to:
         lab_tests = lab_tests.filter(test_date__date__lte=date_to)
     
-    paginator = Paginator(lab_tests, 25)
-    page_number = request.GET.get('page')
-    lab_tests = paginator.get_page(page_number)
+    paginator = CursorPaginator(lab_tests, 25, ['-test_date'], estimate_count=True)
+    lab_tests = paginator.get_page(request.GET.get('cursor'))
     
     context = {
         'lab_tests': lab_tests,
@@ -558,6 +543,8 @@ def update_lab_results(request, test_id):
             lab_test.results = request.POST.get('results')
             lab_test.status = 'completed'
             lab_test.result_date = timezone.now()
+            lab_test.claimed_by = None
+            lab_test.claim_expires_at = None
             
             lab_test.save()
             
@@ -572,6 +559,112 @@ def update_lab_results(request, test_id):
     }
     return render(request, 'medical_records/update_lab_results.html', context)
 
+def _json_payload(request):
+    """JSON object body of a POST, or None"""
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+def _lab_test_ids(values):
+    """A JSON list of integer lab test ids (missing means none), or None when malformed"""
+    if values is None:
+        return []
+    if not isinstance(values, list) or not all(_is_int(value) for value in values):
+        return None
+    return values
+
+def _is_int(value):
+    # JSON true/false arrive as bool, which is an int subclass
+    return isinstance(value, int) and not isinstance(value, bool)
+
+@login_required
+def lab_queue_api(request):
+    """Open lab tests, oldest first: ?status=pending|in_progress&limit=&cursor="""
+    if request.user.role == 'patient':
+        return JsonResponse({'error': 'Access denied'}, status=403)
+    status = request.GET.get('status', 'pending')
+    if status not in LabWorkQueue.STATUSES:
+        return JsonResponse({'error': 'Invalid status'}, status=400)
+
+    page = LabWorkQueue.page(status, page_limit(request), request.GET.get('cursor'))
+    return JsonResponse({
+        'tests': [LabWorkQueue.serialize(test) for test in page],
+        'next_cursor': page.next_cursor,
+        'counts': LabWorkQueue.counts(),
+    })
+
+@login_required
+def lab_queue_claim_api(request):
+    """Claim the next tests ({"limit": n}) or specific ones ({"ids": [...]})"""
+    if request.user.role == 'patient':
+        return JsonResponse({'error': 'Access denied'}, status=403)
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+    data = _json_payload(request)
+    test_ids = _lab_test_ids(data.get('ids')) if data is not None else None
+    if test_ids is None:
+        return JsonResponse({'error': 'Invalid request'}, status=400)
+    limit = data.get('limit', 10)
+    if not _is_int(limit) or not 1 <= limit <= 100:
+        return JsonResponse({'error': 'limit must be between 1 and 100'}, status=400)
+
+    tests = LabWorkQueue.claim(request.user, limit=limit, test_ids=test_ids)
+    return JsonResponse({'tests': [LabWorkQueue.serialize(test) for test in tests]})
+
+@login_required
+def lab_queue_release_api(request):
+    """Hand claimed tests back to the queue: {"ids": [...]}"""
+    if request.user.role == 'patient':
+        return JsonResponse({'error': 'Access denied'}, status=403)
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+    data = _json_payload(request)
+    test_ids = _lab_test_ids(data.get('ids')) if data is not None else None
+    if not test_ids:
+        return JsonResponse({'error': 'Invalid request'}, status=400)
+    return JsonResponse({'released': LabWorkQueue.release(request.user, test_ids)})
+
+@login_required
+def lab_results_batch_api(request):
+    """
+    Enter many results at once: {"results": [{"id": 1, "results": "...",
+    "status": "completed"|"cancelled"}, ...]}. All are saved or none are.
+    """
+    if request.user.role == 'patient':
+        return JsonResponse({'error': 'Access denied'}, status=403)
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+    data = _json_payload(request)
+    entries = data.get('results') if data is not None else None
+    if not isinstance(entries, list) or not all(isinstance(entry, dict) for entry in entries):
+        return JsonResponse({'error': 'Invalid request'}, status=400)
+    for entry in entries:
+        if not all(isinstance(entry.get(field), (str, type(None))) for field in ('results', 'status')):
+            return JsonResponse({'error': 'results and status must be strings'}, status=400)
+    test_ids = _lab_test_ids([entry.get('id') for entry in entries])
+    if test_ids is None:
+        return JsonResponse({'error': 'Invalid lab test id'}, status=400)
+    entries = [dict(entry, id=test_id) for entry, test_id in zip(entries, test_ids)]
+
+    try:
+        saved = LabWorkQueue.submit_results(request.user, entries)
+    except LabQueueError as e:
+        return JsonResponse({'error': str(e)}, status=409)
+    return JsonResponse({'success': True, 'saved': saved, 'counts': LabWorkQueue.counts()})
+
+@login_required
+def lab_turnaround_api(request):
+    """Turnaround of tests completed in the last ?hours= (default 24)"""
+    if request.user.role == 'patient':
+        return JsonResponse({'error': 'Access denied'}, status=403)
+    hours = request.GET.get('hours', '24')
+    if not hours.isdigit() or not 0 < int(hours) <= 24 * 90:
+        return JsonResponse({'error': 'Invalid hours'}, status=400)
+    since = timezone.now() - timedelta(hours=int(hours))
+    return JsonResponse(dict(LabWorkQueue.turnaround(since), counts=LabWorkQueue.counts()))
+
 @login_required
 def vitals_history(request, patient_id):
     """Display patient vitals history"""
@@ -613,55 +706,96 @@ def get_medical_history(request, patient_id):
     
     return JsonResponse({'history': history_data})
 
+@login_required
+def patient_timeline_api(request, patient_id):
+    """
+    A patient's records, prescriptions, lab tests, vitals, appointments and bills as
+    one newest-first, cursor-paginated stream (?limit=, ?cursor=, ?types=record,bill).
+    """
+    patient = get_object_or_404(Patient, patient_id=patient_id)
+    if request.user.role == 'patient' and patient.user_id != request.user.pk:
+        return JsonResponse({'error': 'Access denied'}, status=403)
+
+    types = [name for name in request.GET.get('types', '').split(',') if name in PatientTimeline.SOURCES]
+    events, next_cursor = PatientTimeline.page(
+        patient, page_limit(request), cursor=request.GET.get('cursor'), types=types,
+    )
+    return JsonResponse({'events': events, 'next_cursor': next_cursor})
+
+@login_required
+def vitals_series_api(request, patient_id):
+    """
+    Vitals trend data for charts: ?metrics=systolic,temperature&from=&to= (ISO dates or
+    datetimes, default the last 30 days) and optional ?resolution=raw|hour|day, which
+    is coarsened for spans too long for it (the response says which was used).
+    """
+    patient = get_object_or_404(Patient, patient_id=patient_id)
+    if request.user.role == 'patient' and patient.user_id != request.user.pk:
+        return JsonResponse({'error': 'Access denied'}, status=403)
+
+    metrics = [metric for metric in request.GET.get('metrics', '').split(',') if metric in VitalsSeries.METRIC_FIELDS]
+    metrics = metrics or ['systolic', 'diastolic', 'pulse', 'temperature']
+    resolution = request.GET.get('resolution') or None
+    if resolution not in (None, 'raw', 'hour', 'day'):
+        return JsonResponse({'error': 'Invalid resolution'}, status=400)
+
+    bounds = []
+    for name, default in (('from', timezone.now() - timedelta(days=30)), ('to', timezone.now())):
+        value = request.GET.get(name)
+        if not value:
+            bounds.append(default)
+            continue
+        moment = parse_datetime(value)
+        if moment is None and parse_date(value) is not None:
+            moment = datetime.combine(parse_date(value), datetime.min.time())
+        if moment is None:
+            return JsonResponse({'error': f'Invalid {name}'}, status=400)
+        bounds.append(timezone.make_aware(moment) if timezone.is_naive(moment) else moment)
+    start, end = bounds
+    if start >= end:
+        return JsonResponse({'error': 'from must be before to'}, status=400)
+
+    return JsonResponse(VitalsSeries.series(patient, metrics, start, end, resolution))
+
 @login_required
 def get_prescription_template(request):
-    """API endpoint to get prescription templates"""
-    template_type = request.GET.get('type', 'common_cold')
-    
-    templates = {
-        'common_cold': [
-            {
-                'medication_name': 'Paracetamol',
-                'dosage': '500mg',
-                'frequency': 'Three times daily',
-                'duration': '5 days',
-                'instructions': 'Take with food'
-            },
-            {
-                'medication_name': 'Vitamin C',
-                'dosage': '1000mg',
-                'frequency': 'Once daily',
-                'duration': '7 days',
-                'instructions': 'Take with water'
-            }
-        ],
-        'hypertension': [
-            {
-                'medication_name': 'Amlodipine',
-                'dosage': '5mg',
-                'frequency': 'Once daily',
-                'duration': '30 days',
-                'instructions': 'Take in the morning'
-            },
-            {
-                'medication_name': 'Hydrochlorothiazide',
-                'dosage': '25mg',
-                'frequency': 'Once daily',
-                'duration': '30 days',
-                'instructions': 'Take with breakfast'
-            }
-        ],
-        'diabetes': [
-            {
-                'medication_name': 'Metformin',
-                'dosage': '500mg',
-                'frequency': 'Twice daily',
-                'duration': '30 days',
-                'instructions': 'Take with meals'
-            }
+    """Prescription templates: ?type=<key> for one template's lines, all templates otherwise; POST saves one"""
+    if request.method == 'POST':
+        if request.user.role not in ['doctor', 'administrator']:
+            return JsonResponse({'error': 'Access denied'}, status=403)
+        data = _json_payload(request)
+        medications = data.get('medications') if data is not None else None
+        name = str(data.get('name') or '').strip() if data is not None else ''
+        if not name or not isinstance(medications, list) or not all(isinstance(line, dict) for line in medications):
+            return JsonResponse({'error': 'Invalid request'}, status=400)
+        lines = [
+            {field: str(line.get(field) or '').strip() for field in PRESCRIPTION_FIELDS}
+            for line in medications
         ]
-    }
-    
+        lines = [line for line in lines if line['medication_name']]
+        key = slugify(data.get('key') or name).replace('-', '_')[:50]
+        if not lines or not key:
+            return JsonResponse({'error': 'A template needs a name and at least one medication'}, status=400)
+        try:
+            PrescriptionTemplates.save(key, name[:100], lines, request.user)
+        except PrescriptionTemplateError as e:
+            return JsonResponse({'error': str(e)}, status=403)
+        return JsonResponse({'key': key, 'name': name[:100], 'medications': lines}, status=201)
+
+    template_type = request.GET.get('type')
+    if template_type is None:
+        return JsonResponse({'templates': [
+            {'key': key, **template} for key, template in PrescriptionTemplates.all().items()
+        ]})
+    template = PrescriptionTemplates.get(template_type)
     return JsonResponse({
-        'template': templates.get(template_type, [])
-    })
\ No newline at end of file
+        'template': template['medications'] if template else []
+    })
+
+@login_required
+def medication_suggestions_api(request):
+    """Formulary medicines matching what has been typed: ?q=&limit="""
+    if request.user.role == 'patient':
+        return JsonResponse({'error': 'Access denied'}, status=403)
+    limit = page_limit(request, Formulary.MAX_SUGGESTIONS, 50)
+    return JsonResponse({'medications': Formulary.suggest(request.GET.get('q', ''), limit)})
@@ -0,0 +1,86 @@
+import json
+import sys
+import threading
+
+from django.conf import settings
+from django.core import mail
+
+
+class BaseBackend:
+    """Delivers a batch of notifications over one channel."""
+
+    def send_messages(self, notifications):
+        """Deliver ``notifications``; returns {pk: error message} for the ones that failed."""
+        raise NotImplementedError
+
+
+class InAppBackend(BaseBackend):
+    """In-app notifications are delivered by being in the recipient's inbox."""
+
+    def send_messages(self, notifications):
+        return {}
+
+
+class EmailBackend(BaseBackend):
+    """Sends over one connection of Django's EMAIL_BACKEND (console locally, SMTP in production)."""
+
+    def send_messages(self, notifications):
+        failures = {}
+        with mail.get_connection() as connection:
+            for notification in notifications:
+                if not notification.recipient.email:
+                    failures[notification.pk] = 'Recipient has no email address'
+                    continue
+                message = mail.EmailMessage(
+                    notification.subject,
+                    notification.message,
+                    to=[notification.recipient.email],
+                    connection=connection,
+                )
+                try:
+                    message.send()
+                except Exception as exc:
+                    failures[notification.pk] = str(exc) or exc.__class__.__name__
+        return failures
+
+
+class ConsoleBackend(BaseBackend):
+    """Local stand-in that prints each notification."""
+
+    _lock = threading.Lock()
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+
+    def format(self, notification):
+        recipient = notification.recipient
+        address = recipient.phone_number if notification.delivery_method == 'sms' else recipient.email
+        return (
+            f"[{notification.delivery_method}] to {recipient.get_full_name()} <{address}>: "
+            f"{notification.subject}\n{notification.message}\n"
+        )
+
+    def send_messages(self, notifications):
+        with self._lock:
+            for notification in notifications:
+                self.stream.write(self.format(notification))
+            self.stream.flush()
+        return {}
+
+
+class FileBackend(ConsoleBackend):
+    """Local stand-in that appends one JSON line per notification to NOTIFICATION_FILE_PATH."""
+
+    def format(self, notification):
+        return json.dumps({
+            'id': notification.pk,
+            'delivery_method': notification.delivery_method,
+            'recipient': notification.recipient.email,
+            'phone_number': notification.recipient.phone_number,
+            'subject': notification.subject,
+            'message': notification.message,
+        }) + '\n'
+
+    def send_messages(self, notifications):
+        with open(settings.NOTIFICATION_FILE_PATH, 'a', encoding='utf-8') as self.stream:
+            return super().send_messages(notifications)
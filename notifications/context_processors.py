@@ -1,10 +1,7 @@
-from .models import Notification
+from .services import UnreadCounter
 
 
 def notifications(request):
     if request.user.is_authenticated:
-        count = Notification.objects.filter(
-            recipient=request.user, status__in=['pending', 'sent']
-        ).count()
-        return {'unread_notifications': count}
+        return {'unread_notifications': UnreadCounter.get(request.user)}
     return {'unread_notifications': 0}
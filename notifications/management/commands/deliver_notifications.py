@@ -0,0 +1,46 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from notifications.services import NotificationDelivery
+
+
+class Command(BaseCommand):
+    help = 'Deliver pending notifications, polling the queue until interrupted'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Deliver whatever is due and exit instead of polling'
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=5,
+            help='Seconds to wait when nothing is due (default: 5)'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=settings.NOTIFICATION_BATCH_SIZE,
+            help=f'Notifications claimed per delivery method per pass (default: {settings.NOTIFICATION_BATCH_SIZE})'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            while True:
+                close_old_connections()
+                totals = NotificationDelivery.deliver_due(batch_size=options['batch_size'])
+                if totals:
+                    self.stdout.write(self.style.SUCCESS(
+                        f"Sent {totals['sent']}, retrying {totals['retry']}, failed {totals['failed']}"
+                    ))
+                if options['once']:
+                    break
+                if not totals:
+                    time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
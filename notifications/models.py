@@ -45,6 +45,23 @@ class Notification(models.Model):
     sent_at = models.DateTimeField(null=True, blank=True)
     read_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Delivery bookkeeping for the worker (notifications.services.NotificationDelivery)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(null=True, blank=True)
+    claim_token = models.CharField(max_length=32, blank=True)
+    last_error = models.TextField(blank=True)
+    # Idempotency key for generated notifications (e.g. one reminder per appointment slot)
+    dedupe_key = models.CharField(max_length=100, unique=True, null=True, blank=True)
+    
+    class Meta:
+        indexes = [
+            # Delivery queue: pending rows by due time
+            models.Index(fields=['status', 'next_attempt_at'], name='notif_delivery_due_idx'),
+            # Unread badge and status-filtered inbox
+            models.Index(fields=['recipient', 'status'], name='notif_recipient_status_idx'),
+            # Inbox ordering
+            models.Index(fields=['recipient', '-created_at'], name='notif_recipient_created_idx'),
+        ]
     
     def __str__(self):
         return f"{self.subject} - {self.recipient.get_full_name()}"
\ No newline at end of file
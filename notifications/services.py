@@ -0,0 +1,289 @@
+import logging
+import uuid
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, Q
+from django.template import Context, Engine, TemplateSyntaxError
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from dashboard import cache_versions
+
+logger = logging.getLogger(__name__)
+
+# Statuses that count towards the unread badge
+UNREAD_STATUSES = ('pending', 'sent')
+
+
+class UnreadCounter:
+    """Per-user unread notification count kept in the cache.
+
+    The count is one COUNT over notif_recipient_status_idx, cached until a write to
+    the user's notifications commits. Writers never adjust the cached number: the
+    Notification signals and bulk operations retire it and the next get() recounts.
+    Entries are keyed by a version stamp read before counting, so a count that raced
+    a commit is stored under the retired stamp and never served.
+    """
+
+    CACHE_KEY = 'notifications:unread:{user_id}:v{version}'
+    VERSION_KEY = 'notifications:unread:{user_id}:version'
+    # Bounds any drift from writes that bypass signals (e.g. raw queryset updates)
+    CACHE_TIMEOUT = 60 * 60
+
+    @classmethod
+    def get(cls, user):
+        version_key = cls.VERSION_KEY.format(user_id=user.pk)
+        key = cls.CACHE_KEY.format(user_id=user.pk, version=cache_versions.stamps([version_key])[version_key])
+        count = cache.get(key)
+        if count is None:
+            from .models import Notification
+            count = Notification.objects.filter(
+                recipient_id=user.pk, status__in=UNREAD_STATUSES
+            ).count()
+            cache.set(key, count, cls.CACHE_TIMEOUT)
+        return count
+
+    @classmethod
+    def invalidate(cls, user_id):
+        """
+        Retire a cached count once the current transaction commits (immediately
+        outside one), so a rolled-back write leaves it alone.
+        """
+        key = cls.VERSION_KEY.format(user_id=user_id)
+        transaction.on_commit(lambda: cache_versions.bump(key))
+
+    @classmethod
+    def invalidate_many(cls, user_ids):
+        for user_id in user_ids:
+            cache_versions.bump(cls.VERSION_KEY.format(user_id=user_id))
+
+
+class NotificationDelivery:
+    """Delivers pending notifications through the backends in NOTIFICATION_BACKENDS.
+
+    The pending rows are the queue: ``manage.py deliver_notifications`` polls for rows
+    that are due (scheduled_at reached, retry time reached), claims up to a batch of them
+    per delivery method with a conditional UPDATE so concurrent workers never send the
+    same row twice, and hands each batch to that method's backend in one call. Failures
+    are retried with exponential backoff until MAX_ATTEMPTS, then marked 'failed'. A
+    worker that dies mid-batch leaves its claim to expire after CLAIM_SECONDS, when the
+    rows become due again.
+    """
+
+    MAX_ATTEMPTS = 5
+    # Retry n waits BACKOFF_SECONDS * 2 ** (n - 1), capped at BACKOFF_MAX_SECONDS
+    BACKOFF_SECONDS = 60
+    BACKOFF_MAX_SECONDS = 60 * 60
+    CLAIM_SECONDS = 5 * 60
+
+    _backends = {}
+
+    @classmethod
+    def backend(cls, delivery_method):
+        path = settings.NOTIFICATION_BACKENDS[delivery_method]
+        if path not in cls._backends:
+            cls._backends[path] = import_string(path)()
+        return cls._backends[path]
+
+    @staticmethod
+    def due(now=None):
+        from .models import Notification
+        now = now or timezone.now()
+        return Notification.objects.filter(status='pending').filter(
+            Q(next_attempt_at__lte=now)
+            | Q(next_attempt_at__isnull=True) & (Q(scheduled_at__isnull=True) | Q(scheduled_at__lte=now))
+        )
+
+    @classmethod
+    def backoff(cls, attempts):
+        return timedelta(seconds=min(cls.BACKOFF_SECONDS * 2 ** (attempts - 1), cls.BACKOFF_MAX_SECONDS))
+
+    @classmethod
+    def claim(cls, delivery_method, limit, now=None):
+        """Claim up to ``limit`` due notifications of one delivery method for this worker."""
+        from .models import Notification
+        now = now or timezone.now()
+        token = uuid.uuid4().hex
+        candidates = cls.due(now).filter(delivery_method=delivery_method).order_by(
+            'scheduled_at', 'created_at', 'id'
+        ).values_list('id', flat=True)[:limit]
+        # Re-checking "due" in the UPDATE makes the claim exclusive: a row another worker
+        # claimed first has a future next_attempt_at and is skipped
+        cls.due(now).filter(pk__in=list(candidates)).update(
+            claim_token=token,
+            next_attempt_at=now + timedelta(seconds=cls.CLAIM_SECONDS),
+            attempts=F('attempts') + 1,
+        )
+        return list(Notification.objects.filter(claim_token=token, status='pending').select_related('recipient'))
+
+    @classmethod
+    def deliver_due(cls, batch_size=None, now=None):
+        """One pass over every delivery method; returns a Counter of 'sent', 'retry' and 'failed'."""
+        from .models import Notification
+        batch_size = batch_size or settings.NOTIFICATION_BATCH_SIZE
+        totals = Counter()
+        for delivery_method, _ in Notification.DELIVERY_METHODS:
+            batch = cls.claim(delivery_method, batch_size, now)
+            if not batch:
+                continue
+            try:
+                failures = cls.backend(delivery_method).send_messages(batch)
+            except Exception as exc:
+                logger.exception('%s backend failed on a batch of %d', delivery_method, len(batch))
+                failures = {notification.pk: str(exc) or exc.__class__.__name__ for notification in batch}
+            totals.update(cls._record(batch, failures, now))
+        return totals
+
+    @classmethod
+    def _record(cls, batch, failures, now=None):
+        from .models import Notification
+        now = now or timezone.now()
+        sent = [notification.pk for notification in batch if notification.pk not in failures]
+        # status='pending' leaves alone any row marked read while it was being sent
+        Notification.objects.filter(pk__in=sent, status='pending').update(
+            status='sent', sent_at=now, next_attempt_at=None, claim_token='', last_error='',
+        )
+        outcome = Counter(sent=len(sent)) if sent else Counter()
+        for notification in batch:
+            error = failures.get(notification.pk)
+            if error is None:
+                continue
+            rows = Notification.objects.filter(pk=notification.pk, status='pending')
+            if notification.attempts >= cls.MAX_ATTEMPTS:
+                # update() skips the signals, so retire the unread badge by hand
+                if rows.update(status='failed', next_attempt_at=None, claim_token='', last_error=error):
+                    UnreadCounter.invalidate(notification.recipient_id)
+                outcome['failed'] += 1
+            else:
+                rows.update(
+                    next_attempt_at=now + cls.backoff(notification.attempts), claim_token='', last_error=error,
+                )
+                outcome['retry'] += 1
+        return outcome
+
+
+def _appointments_on(days):
+    def audience():
+        from appointments.models import Appointment
+        return Appointment.objects.filter(
+            appointment_date=timezone.localdate() + timedelta(days=days),
+            status__in=('scheduled', 'confirmed'),
+        ).values('patient__user')
+    return audience
+
+
+def _outstanding_bills():
+    from billing.models import Bill
+    return Bill.objects.filter(status__in=('pending', 'partial', 'overdue')).values('patient__user')
+
+
+class BroadcastError(Exception):
+    """Raised when a broadcast has no audience or nothing to send."""
+
+
+class NotificationBroadcast:
+    """Queues one notification per user in an audience with set-based inserts.
+
+    Recipients are narrowed by role, department (a doctor's specialization or a billing
+    staff member's department) and/or a named audience from AUDIENCES, all as one query
+    that is streamed rather than loaded. The subject and message are compiled once as
+    Django templates and rendered per recipient with ``first_name``, ``last_name``,
+    ``full_name`` and ``email``; rows are written with bulk_create in CHUNK_SIZE chunks
+    inside one transaction. On SQLite each INSERT is further capped at 999 bound
+    parameters, 66 rows of Notification's 15 columns, so 50,000 recipients cost ~760
+    INSERTs (~50 on backends without the cap) rather than one per recipient. The rows
+    are queued as 'pending' for the delivery worker (see NotificationDelivery).
+    """
+
+    CHUNK_SIZE = 1000
+
+    # Named cohorts: each returns a subquery of user ids
+    AUDIENCES = {
+        'appointments_today': _appointments_on(0),
+        'appointments_tomorrow': _appointments_on(1),
+        'outstanding_bills': _outstanding_bills,
+    }
+
+    @classmethod
+    def recipients(cls, role=None, department=None, audience=None):
+        from django.contrib.auth import get_user_model
+        if audience and audience not in cls.AUDIENCES:
+            raise BroadcastError(f'Unknown audience "{audience}".')
+        if not (role or department or audience):
+            raise BroadcastError('Choose a role, department or audience.')
+        users = get_user_model().objects.filter(is_active=True)
+        if role:
+            users = users.filter(role=role)
+        if department:
+            users = users.filter(
+                Q(doctor__specialization__iexact=department) | Q(billingstaff__department__iexact=department)
+            )
+        if audience:
+            users = users.filter(pk__in=cls.AUDIENCES[audience]())
+        return users
+
+    @classmethod
+    def send(cls, recipients, subject='', message='', template=None, delivery_method='in_app', scheduled_at=None):
+        """Queue a notification for every user in ``recipients``; returns how many were created.
+
+        ``template`` (a NotificationTemplate) supplies the subject and message when given.
+        """
+        from .models import Notification
+        if template is not None:
+            subject, message = template.subject, template.message_template
+        if not (subject and message):
+            raise BroadcastError('A subject and message, or a template, are required.')
+        engine = Engine.get_default()
+        try:
+            subject_template = engine.from_string(subject)
+            message_template = engine.from_string(message)
+        except TemplateSyntaxError as e:
+            raise BroadcastError(f'Invalid template: {e}')
+
+        rows = recipients.order_by('pk').values_list('pk', 'first_name', 'last_name', 'email')
+        created = 0
+        chunk = []
+        with transaction.atomic():
+            for user_id, first_name, last_name, email in rows.iterator(chunk_size=cls.CHUNK_SIZE):
+                # Plain-text messages: no HTML escaping of names
+                context = Context({
+                    'first_name': first_name,
+                    'last_name': last_name,
+                    'full_name': f'{first_name} {last_name}'.strip(),
+                    'email': email,
+                }, autoescape=False)
+                chunk.append(Notification(
+                    recipient_id=user_id,
+                    template=template,
+                    subject=subject_template.render(context)[:200],
+                    message=message_template.render(context),
+                    delivery_method=delivery_method,
+                    status='pending',
+                    scheduled_at=scheduled_at,
+                ))
+                if len(chunk) >= cls.CHUNK_SIZE:
+                    Notification.objects.bulk_create(chunk)
+                    created += len(chunk)
+                    chunk = []
+            if chunk:
+                Notification.objects.bulk_create(chunk)
+                created += len(chunk)
+        # bulk_create skips the signals that keep the unread badges current. The audience
+        # is streamed again after commit rather than held in memory; the badge of a user
+        # who left it in between catches up within UnreadCounter.CACHE_TIMEOUT
+        transaction.on_commit(lambda: cls._invalidate_badges(recipients))
+        return created
+
+    @classmethod
+    def _invalidate_badges(cls, recipients):
+        chunk = []
+        for user_id in recipients.order_by().values_list('pk', flat=True).iterator(chunk_size=cls.CHUNK_SIZE):
+            chunk.append(user_id)
+            if len(chunk) >= cls.CHUNK_SIZE:
+                UnreadCounter.invalidate_many(chunk)
+                chunk = []
+        UnreadCounter.invalidate_many(chunk)
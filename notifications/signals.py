@@ -0,0 +1,32 @@
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Notification
+from .services import UnreadCounter, UNREAD_STATUSES
+
+
+@receiver(post_init, sender=Notification)
+def remember_loaded_status(sender, instance, **kwargs):
+    # Snapshot status and recipient so post_save can tell whether the row crossed the
+    # unread boundary or moved to another user's badge (read from __dict__ so deferred
+    # fields don't trigger a query)
+    instance._loaded_status = instance.__dict__.get('status')
+    instance._loaded_recipient_id = instance.__dict__.get('recipient_id')
+
+
+@receiver(post_save, sender=Notification)
+def invalidate_unread_counter_on_save(sender, instance, created, **kwargs):
+    was_unread = not created and instance._loaded_status in UNREAD_STATUSES
+    is_unread = instance.status in UNREAD_STATUSES
+    if was_unread or is_unread:
+        UnreadCounter.invalidate(instance.recipient_id)
+        if instance._loaded_recipient_id not in (None, instance.recipient_id):
+            UnreadCounter.invalidate(instance._loaded_recipient_id)
+    instance._loaded_status = instance.status
+    instance._loaded_recipient_id = instance.recipient_id
+
+
+@receiver(post_delete, sender=Notification)
+def invalidate_unread_counter_on_delete(sender, instance, **kwargs):
+    if instance._loaded_status in UNREAD_STATUSES:
+        UnreadCounter.invalidate(instance._loaded_recipient_id or instance.recipient_id)
@@ -1,3 +1,255 @@
-from django.test import TestCase
+import threading
+from datetime import date, time, timedelta
+from decimal import Decimal
+from io import StringIO
 
-# Create your tests here.
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from accounts.models import User
+from appointments.models import Appointment, Doctor
+from billing.models import Bill, BillingStaff
+from patients.models import Patient
+from .models import Notification
+from .services import BroadcastError, NotificationBroadcast, NotificationDelivery, UnreadCounter
+
+
+def notify(user, status='pending', delivery_method='in_app', **fields):
+    return Notification.objects.create(
+        recipient=user, subject='Hello', message='Hello there', delivery_method=delivery_method, status=status,
+        **fields,
+    )
+
+
+class UnreadCounterTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(email='patient@example.com', role='patient')
+
+    def test_count_is_retired_on_commit(self):
+        notify(self.user)
+        self.assertEqual(UnreadCounter.get(self.user), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            notification = notify(self.user)
+            self.assertEqual(UnreadCounter.get(self.user), 1)
+        self.assertEqual(UnreadCounter.get(self.user), 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            notification.status = 'read'
+            notification.save()
+        self.assertEqual(UnreadCounter.get(self.user), 1)
+
+    def test_rolled_back_write_keeps_the_count(self):
+        self.assertEqual(UnreadCounter.get(self.user), 0)
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            try:
+                with transaction.atomic():
+                    notify(self.user)
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+        self.assertEqual(callbacks, [])
+        self.assertEqual(UnreadCounter.get(self.user), 0)
+
+    def test_count_that_raced_a_write_is_not_served(self):
+        version_key = UnreadCounter.VERSION_KEY.format(user_id=self.user.pk)
+        UnreadCounter.get(self.user)
+        # A reader counts, then a notification commits before the reader stores its count
+        stale_key = UnreadCounter.CACHE_KEY.format(user_id=self.user.pk, version=cache.get(version_key))
+        with self.captureOnCommitCallbacks(execute=True):
+            notify(self.user)
+        cache.set(stale_key, 0)
+        self.assertEqual(UnreadCounter.get(self.user), 1)
+
+    def test_mark_all_read_recounts(self):
+        for _ in range(3):
+            notify(self.user)
+        other = notify(User.objects.create_user(email='other@example.com', role='patient'))
+        self.assertEqual(UnreadCounter.get(self.user), 3)
+        self.client.force_login(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('notifications:mark_all_read'))
+        self.assertEqual(UnreadCounter.get(self.user), 0)
+        self.assertEqual(UnreadCounter.get(other.recipient), 1)
+
+
+class NotificationDeliveryTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(email='patient@example.com', role='patient')
+        self.now = timezone.now()
+
+    def test_claimed_rows_are_skipped_until_the_claim_expires(self):
+        notifications = [notify(self.user) for _ in range(3)]
+        claimed = NotificationDelivery.claim('in_app', 2, self.now)
+        self.assertEqual(claimed, notifications[:2])
+        self.assertEqual(NotificationDelivery.claim('in_app', 10, self.now), notifications[2:])
+        self.assertEqual(NotificationDelivery.claim('in_app', 10, self.now), [])
+        # A worker that died mid-batch: its rows come back once the claim lapses
+        expired = self.now + timedelta(seconds=NotificationDelivery.CLAIM_SECONDS)
+        self.assertEqual(NotificationDelivery.claim('in_app', 10, expired), notifications)
+        self.assertEqual([n.attempts for n in Notification.objects.order_by('pk')], [2, 2, 2])
+
+    def test_scheduled_rows_wait(self):
+        later = notify(self.user, scheduled_at=self.now + timedelta(hours=1))
+        self.assertEqual(NotificationDelivery.claim('in_app', 10, self.now), [])
+        self.assertEqual(NotificationDelivery.claim('in_app', 10, later.scheduled_at), [later])
+
+    def test_failures_back_off_then_fail(self):
+        User.objects.filter(pk=self.user.pk).update(email='')
+        notification = notify(self.user, delivery_method='email')
+        self.assertEqual(UnreadCounter.get(self.user), 1)
+        now = self.now
+        for attempt in range(1, NotificationDelivery.MAX_ATTEMPTS):
+            self.assertEqual(NotificationDelivery.deliver_due(now=now), {'retry': 1})
+            notification.refresh_from_db()
+            wait = timedelta(seconds=60 * 2 ** (attempt - 1))
+            self.assertEqual((notification.attempts, notification.next_attempt_at), (attempt, now + wait))
+            self.assertEqual(notification.last_error, 'Recipient has no email address')
+            # Not due a moment before the backoff ends
+            self.assertEqual(NotificationDelivery.deliver_due(now=now + wait - timedelta(seconds=1)), {})
+            now += wait
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(NotificationDelivery.deliver_due(now=now), {'failed': 1})
+        notification.refresh_from_db()
+        self.assertEqual((notification.status, notification.attempts), ('failed', NotificationDelivery.MAX_ATTEMPTS))
+        self.assertEqual(NotificationDelivery.deliver_due(now=now + timedelta(days=1)), {})
+        self.assertEqual(UnreadCounter.get(self.user), 0)
+
+    def test_backoff_is_capped(self):
+        self.assertEqual(NotificationDelivery.backoff(1), timedelta(minutes=1))
+        self.assertEqual(NotificationDelivery.backoff(20), timedelta(seconds=NotificationDelivery.BACKOFF_MAX_SECONDS))
+
+
+
+class SmallChunkBroadcast(NotificationBroadcast):
+    CHUNK_SIZE = 2
+
+
+class NotificationBroadcastTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.cardiologist = self.user('cardio@example.com', 'doctor', first_name='Amina')
+        Doctor.objects.filter(user=self.cardiologist).update(specialization='Cardiology')
+        self.surgeon = self.user('surgeon@example.com', 'doctor')
+        Doctor.objects.filter(user=self.surgeon).update(specialization='Surgery')
+        self.retired = self.user('retired@example.com', 'doctor', is_active=False)
+        self.cashier = self.user('cashier@example.com', 'billing_staff')
+        BillingStaff.objects.filter(user=self.cashier).update(department='cardiology')
+        self.patients = [self.user(f'patient{i}@example.com', 'patient', first_name=f'P{i}') for i in range(4)]
+
+    def user(self, email, role, **fields):
+        return User.objects.create_user(email=email, role=role, **fields)
+
+    def recipients(self, **filters):
+        return set(NotificationBroadcast.recipients(**filters))
+
+    def test_role_and_department(self):
+        self.assertEqual(self.recipients(role='doctor'), {self.cardiologist, self.surgeon})
+        self.assertEqual(self.recipients(department='CARDIOLOGY'), {self.cardiologist, self.cashier})
+        self.assertEqual(self.recipients(role='doctor', department='cardiology'), {self.cardiologist})
+
+    def test_audiences(self):
+        tomorrow = date.today() + timedelta(days=1)
+        doctor = Doctor.objects.get(user=self.surgeon)
+        for user, day, status in [
+            (self.patients[0], tomorrow, 'scheduled'),
+            (self.patients[1], tomorrow, 'cancelled'),
+            (self.patients[2], date.today(), 'confirmed'),
+        ]:
+            Appointment.objects.create(
+                patient=Patient.objects.get(user=user), doctor=doctor, appointment_date=day,
+                appointment_time=time(9, 0), status=status, reason='Review',
+            )
+        for user, status in [(self.patients[1], 'overdue'), (self.patients[3], 'paid')]:
+            Bill.objects.create(
+                patient=Patient.objects.get(user=user), created_by=BillingStaff.objects.get(user=self.cashier),
+                due_date=date.today(), status=status, total_amount=Decimal('100.00'),
+            )
+        self.assertEqual(self.recipients(audience='appointments_tomorrow'), {self.patients[0]})
+        self.assertEqual(self.recipients(audience='appointments_today'), {self.patients[2]})
+        self.assertEqual(self.recipients(audience='outstanding_bills'), {self.patients[1]})
+        self.assertEqual(self.recipients(role='doctor', audience='outstanding_bills'), set())
+        with self.assertRaisesMessage(BroadcastError, 'Unknown audience'):
+            NotificationBroadcast.recipients(audience='everyone')
+        with self.assertRaises(BroadcastError):
+            NotificationBroadcast.recipients()
+
+    def test_send_renders_per_recipient_and_refreshes_badges(self):
+        for user in self.patients:
+            self.assertEqual(UnreadCounter.get(user), 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            queued = SmallChunkBroadcast.send(
+                NotificationBroadcast.recipients(role='patient'),
+                subject='Hello {{ first_name }}', message='Dear {{ full_name }} <{{ email }}>',
+            )
+        self.assertEqual(queued, 4)
+        notification = Notification.objects.get(recipient=self.patients[3])
+        self.assertEqual(notification.subject, 'Hello P3')
+        self.assertEqual(notification.message, 'Dear P3 <patient3@example.com>')
+        for user in self.patients:
+            self.assertEqual(UnreadCounter.get(user), 1)
+
+
+class NotificationWorkerTests(TransactionTestCase):
+    """The delivery worker on committed data: concurrent claims and the management command."""
+
+    WORKERS = 8
+
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create_user(email='patient@example.com', role='patient')
+        Notification.objects.bulk_create(
+            Notification(recipient=user, subject='Hello', message='Hello there', delivery_method='in_app')
+            for _ in range(40)
+        )
+
+    def test_concurrent_claims_are_exclusive(self):
+        barrier = threading.Barrier(self.WORKERS)
+        claims = []
+        lock = threading.Lock()
+
+        def claim():
+            claimed = []
+            try:
+                barrier.wait()
+                # A claim that lost every row to another worker comes back short; keep
+                # polling until nothing is due
+                while True:
+                    batch = NotificationDelivery.claim('in_app', 5)
+                    claimed += [notification.pk for notification in batch]
+                    if not batch and not NotificationDelivery.due().exists():
+                        break
+            except Exception as exc:
+                claimed.append(exc)
+            finally:
+                connection.close()
+            with lock:
+                claims.append(claimed)
+
+        threads = [threading.Thread(target=claim) for _ in range(self.WORKERS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        claimed = [pk for batch in claims for pk in batch]
+        self.assertEqual(len(claimed), len(set(claimed)), claims)
+        self.assertEqual(sorted(claimed), sorted(Notification.objects.values_list('pk', flat=True)))
+        self.assertEqual(set(Notification.objects.values_list('attempts', flat=True)), {1})
+
+    def test_command_sends_what_is_due(self):
+        Notification.objects.update(delivery_method='email')
+        out = StringIO()
+        call_command('deliver_notifications', '--once', '--batch-size', '100', stdout=out)
+        self.assertIn('Sent 40, retrying 0, failed 0', out.getvalue())
+        self.assertEqual(len(mail.outbox), 40)
+        self.assertEqual(set(Notification.objects.values_list('status', flat=True)), {'sent'})
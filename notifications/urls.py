@@ -12,4 +12,5 @@ urlpatterns = [
     # AJAX
     path('api/mark-read/<int:pk>/', views.mark_read_ajax, name='mark_read_ajax'),
     path('api/unread-count/', views.unread_count_api, name='unread_count_api'),
+    path('api/broadcast/', views.broadcast_api, name='broadcast_api'),
 ]
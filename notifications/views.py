@@ -1,11 +1,15 @@
+import json
+
 from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.http import JsonResponse
 from django.utils import timezone
-from django.core.paginator import Paginator
+from django.utils.dateparse import parse_datetime
 
 from .models import Notification, NotificationTemplate
+from .services import BroadcastError, NotificationBroadcast, UnreadCounter
+from dashboard.pagination import CursorPaginator
 
 
 @login_required
@@ -18,13 +22,10 @@ def notification_list(request):
     if filter_status:
         notifications = notifications.filter(status=filter_status)
 
-    unread_count = Notification.objects.filter(
-        recipient=request.user, status__in=['pending', 'sent']
-    ).count()
+    unread_count = UnreadCounter.get(request.user)
 
-    paginator = Paginator(notifications, 20)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    paginator = CursorPaginator(notifications, 20, ['-created_at'])
+    page_obj = paginator.get_page(request.GET.get('cursor'))
 
     context = {
         'title': 'Notifications',
@@ -59,6 +60,7 @@ def mark_all_read(request):
             recipient=request.user,
             status__in=['pending', 'sent']
         ).update(status='read', read_at=timezone.now())
+        UnreadCounter.invalidate(request.user.pk)
         messages.success(request, 'All notifications marked as read.')
     return redirect('notifications:notification_list')
 
@@ -70,19 +72,13 @@ def mark_read_ajax(request, pk):
         notification.status = 'read'
         notification.read_at = timezone.now()
         notification.save(update_fields=['status', 'read_at'])
-        unread = Notification.objects.filter(
-            recipient=request.user, status__in=['pending', 'sent']
-        ).count()
-        return JsonResponse({'success': True, 'unread_count': unread})
+        return JsonResponse({'success': True, 'unread_count': UnreadCounter.get(request.user)})
     return JsonResponse({'success': False}, status=405)
 
 
 @login_required
 def unread_count_api(request):
-    count = Notification.objects.filter(
-        recipient=request.user, status__in=['pending', 'sent']
-    ).count()
-    return JsonResponse({'unread_count': count})
+    return JsonResponse({'unread_count': UnreadCounter.get(request.user)})
 
 
 @login_required
@@ -111,9 +107,14 @@ def create_notification(request):
         message = request.POST.get('message', '').strip()
         delivery_method = request.POST.get('delivery_method', 'in_app')
         template_id = request.POST.get('template_id')
+        scheduled_at = parse_datetime(request.POST.get('scheduled_at', ''))
+        if scheduled_at is not None and timezone.is_naive(scheduled_at):
+            scheduled_at = timezone.make_aware(scheduled_at)
 
         if not (recipient_id and subject and message):
             messages.error(request, 'Recipient, subject and message are required.')
+        elif request.POST.get('scheduled_at') and scheduled_at is None:
+            messages.error(request, 'Invalid schedule time.')
         else:
             recipient = get_object_or_404(User, pk=recipient_id)
             template = None
@@ -126,13 +127,13 @@ def create_notification(request):
                 subject=subject,
                 message=message,
                 delivery_method=delivery_method,
-                status='sent',
-                sent_at=timezone.now(),
+                status='pending',
+                scheduled_at=scheduled_at,
             )
-            messages.success(request, f'Notification sent to {recipient.get_full_name()}.')
+            messages.success(request, f'Notification queued for {recipient.get_full_name()}.')
             return redirect('notifications:notification_list')
 
-    users = User.objects.filter(is_active=True).order_by('first_name', 'last_name')
+    users = User.objects.filter(is_active=True).order_by('first_name', 'last_name').only('first_name', 'last_name', 'role')
     templates = NotificationTemplate.objects.filter(is_active=True)
     context = {
         'title': 'Send Notification',
@@ -141,3 +142,56 @@ def create_notification(request):
         'delivery_methods': Notification.DELIVERY_METHODS,
     }
     return render(request, 'notifications/create_notification.html', context)
+
+
+@login_required
+def broadcast_api(request):
+    """
+    Queue a notification for a whole audience. POST JSON (or form data) with
+    ``role``, ``department`` and/or ``audience`` (see NotificationBroadcast.AUDIENCES),
+    then ``template_id`` or ``subject`` and ``message``, optionally ``delivery_method``
+    and ``scheduled_at``. Subject and message may use {{ first_name }}, {{ last_name }},
+    {{ full_name }} and {{ email }}.
+    """
+    if request.user.role != 'administrator':
+        return JsonResponse({'error': 'Access denied'}, status=403)
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+
+    if request.content_type == 'application/json':
+        try:
+            data = json.loads(request.body)
+        except ValueError:
+            return JsonResponse({'error': 'Invalid JSON'}, status=400)
+    else:
+        data = request.POST
+
+    delivery_method = data.get('delivery_method') or 'in_app'
+    if delivery_method not in dict(Notification.DELIVERY_METHODS):
+        return JsonResponse({'error': 'Invalid delivery method'}, status=400)
+    scheduled_at = None
+    if data.get('scheduled_at'):
+        scheduled_at = parse_datetime(str(data['scheduled_at']))
+        if scheduled_at is None:
+            return JsonResponse({'error': 'Invalid scheduled_at'}, status=400)
+        if timezone.is_naive(scheduled_at):
+            scheduled_at = timezone.make_aware(scheduled_at)
+    template = None
+    if data.get('template_id'):
+        template = get_object_or_404(NotificationTemplate, pk=data['template_id'], is_active=True)
+
+    try:
+        recipients = NotificationBroadcast.recipients(
+            role=data.get('role'), department=data.get('department'), audience=data.get('audience'),
+        )
+        queued = NotificationBroadcast.send(
+            recipients,
+            subject=(data.get('subject') or '').strip(),
+            message=(data.get('message') or '').strip(),
+            template=template,
+            delivery_method=delivery_method,
+            scheduled_at=scheduled_at,
+        )
+    except BroadcastError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({'success': True, 'queued': queued})
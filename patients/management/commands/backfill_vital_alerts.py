@@ -0,0 +1,23 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from patients.services import CriticalVitalsMonitor
+
+
+class Command(BaseCommand):
+    help = 'Raise CriticalVitalAlert rows for existing PatientVitals readings outside CRITICAL_VITAL_THRESHOLDS'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=30,
+            help='Only scan readings from the last N days; 0 scans all (default: 30)'
+        )
+
+    def handle(self, *args, **options):
+        since = timezone.now() - timedelta(days=options['days']) if options['days'] else None
+        found = CriticalVitalsMonitor.backfill(since)
+        self.stdout.write(self.style.SUCCESS(f'Found {found} critical readings'))
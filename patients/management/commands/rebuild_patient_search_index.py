@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from patients.services import PatientSearchIndex
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the patient search token index from Patient and User rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Patients reindexed per transaction (default: 1000)'
+        )
+
+    def handle(self, *args, **options):
+        count = PatientSearchIndex.rebuild(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Indexed {count} patients'))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from patients.services import VitalsSeries
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the hourly and daily VitalsRollup buckets from PatientVitals rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--patient',
+            action='append',
+            dest='patients',
+            help='Patient ID to rebuild (repeatable); defaults to every patient'
+        )
+
+    def handle(self, *args, **options):
+        count = VitalsSeries.rebuild(options['patients'])
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {count} vitals rollup rows'))
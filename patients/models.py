@@ -32,6 +32,10 @@ class Patient(models.Model):
     created_at = models.DateTimeField(auto_now_add=True, blank=True, null=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['-created_at'], name='patient_created_idx'),
+        ]
 
     def save(self, *args, **kwargs):
         if self.user.role != 'patient':
@@ -77,3 +81,111 @@ class PatientVitals(models.Model):
 
     class Meta:
         ordering = ['-recorded_at']
+        indexes = [
+            models.Index(fields=['patient', '-recorded_at'], name='vitals_patient_recorded_idx'),
+        ]
+
+
+class PatientSearchToken(models.Model):
+    """
+    Normalized search keys for a patient, maintained by patients.signals.
+
+    Lookups are index range scans on ``token`` instead of icontains scans over users;
+    see patients.services.PatientSearchIndex for how tokens are built and queried.
+    """
+    KINDS = [
+        ('name', 'Name word'),
+        ('email', 'Email'),
+        ('id', 'Patient ID'),
+        ('insurance', 'Insurance provider word'),
+        ('phone', 'Phone digits, reversed'),
+        ('dial', 'Phone digits, as dialled'),
+        ('sound', 'Soundex of a name word'),
+    ]
+
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='search_tokens')
+    kind = models.CharField(max_length=10, choices=KINDS)
+    token = models.CharField(max_length=64)
+
+    class Meta:
+        indexes = [
+            # Covering index: prefix scans never touch the table rows
+            models.Index(fields=['token', 'kind', 'patient'], name='patient_search_token_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.patient_id} {self.kind}:{self.token}"
+
+
+class VitalsRollup(models.Model):
+    """
+    Hourly and daily per-patient, per-metric summaries of PatientVitals readings,
+    maintained by patients.signals; see patients.services.VitalsSeries.
+    """
+    METRICS = [
+        ('systolic', 'Systolic BP'),
+        ('diastolic', 'Diastolic BP'),
+        ('pulse', 'Pulse rate'),
+        ('temperature', 'Temperature'),
+        ('weight', 'Weight'),
+        ('height', 'Height'),
+    ]
+    RESOLUTIONS = [
+        ('hour', 'Hourly'),
+        ('day', 'Daily'),
+    ]
+
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='vitals_rollups')
+    metric = models.CharField(max_length=12, choices=METRICS)
+    resolution = models.CharField(max_length=4, choices=RESOLUTIONS)
+    bucket_start = models.DateTimeField()
+    count = models.PositiveIntegerField(default=0)
+    total = models.FloatField(default=0)
+    minimum = models.FloatField()
+    maximum = models.FloatField()
+
+    class Meta:
+        # Also the range-scan index for series queries
+        unique_together = ('patient', 'resolution', 'metric', 'bucket_start')
+
+    @property
+    def average(self):
+        return self.total / self.count if self.count else None
+
+    def __str__(self):
+        return f"{self.patient_id} {self.metric} {self.resolution} {self.bucket_start:%Y-%m-%d %H:%M}"
+
+
+class CriticalVitalAlert(models.Model):
+    """
+    A reading outside settings.CRITICAL_VITAL_THRESHOLDS, raised by patients.signals when
+    vitals are recorded, so dashboards read open alerts instead of scanning PatientVitals.
+    """
+    DIRECTIONS = [
+        ('high', 'Above threshold'),
+        ('low', 'Below threshold'),
+    ]
+
+    vitals = models.ForeignKey(PatientVitals, on_delete=models.CASCADE, related_name='alerts')
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='vital_alerts')
+    metric = models.CharField(max_length=12, choices=VitalsRollup.METRICS)
+    value = models.FloatField()
+    threshold = models.FloatField()
+    direction = models.CharField(max_length=4, choices=DIRECTIONS)
+    recorded_at = models.DateTimeField()
+    acknowledged = models.BooleanField(default=False)
+    acknowledged_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, related_name='+'
+    )
+    acknowledged_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = ('vitals', 'metric')
+        indexes = [
+            # Open alerts, newest first; stays as small as the unacknowledged backlog
+            models.Index(fields=['-recorded_at'], condition=models.Q(acknowledged=False), name='vital_alert_open_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.patient_id} {self.metric} {self.value} ({self.get_direction_display()} {self.threshold})"
+
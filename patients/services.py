@@ -0,0 +1,454 @@
+import re
+import unicodedata
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Max, Min, Q, Sum
+from django.db.models.functions import Greatest, Least, Trunc
+from django.utils import timezone
+
+from .models import CriticalVitalAlert, Patient, PatientSearchToken, PatientVitals, VitalsRollup
+
+TOKEN_LENGTH = PatientSearchToken._meta.get_field('token').max_length
+# Kinds matched by plain prefix; phone and sound tokens have their own rules
+PREFIX_KINDS = ['name', 'email', 'id', 'insurance']
+PHONE_QUERY = re.compile(r'^[\d\s()+-]+$')
+
+_SOUNDEX_CODES = {
+    **dict.fromkeys('bfpv', '1'), **dict.fromkeys('cgjkqsxz', '2'),
+    **dict.fromkeys('dt', '3'), 'l': '4', **dict.fromkeys('mn', '5'), 'r': '6',
+}
+
+
+def normalize(text):
+    """Lowercase and strip accents: 'Müller' -> 'muller'."""
+    text = unicodedata.normalize('NFKD', text or '')
+    return ''.join(char for char in text if not unicodedata.combining(char)).lower()
+
+
+def words(text):
+    return [word for word in re.split(r'[^0-9a-z]+', normalize(text).replace("'", '')) if word]
+
+
+def soundex(word):
+    """Classic four-character Soundex, used for fuzzy name matches ('Mwangi' ~ 'Mwangy')."""
+    word = ''.join(char for char in word if char.isalpha())
+    if not word:
+        return ''
+    code, previous = word[0], _SOUNDEX_CODES.get(word[0], '')
+    for char in word[1:]:
+        digit = _SOUNDEX_CODES.get(char, '')
+        if digit and digit != previous:
+            code += digit
+        if char not in 'hw':
+            previous = digit
+    return (code + '000')[:4]
+
+
+def _prefix(field, value):
+    """Range condition equivalent to startswith that any B-tree index can serve."""
+    return Q(**{f'{field}__gte': value, f'{field}__lt': value[:-1] + chr(ord(value[-1]) + 1)})
+
+
+class PatientSearchIndex:
+    """
+    Token index behind every patient search box.
+
+    Each patient gets a handful of PatientSearchToken rows: name and insurance words,
+    the email, the patient ID (also its bare number), the phone number's digits both
+    as dialled and reversed (so '+254...' and '...5678' are both prefix searches) and
+    the Soundex of each name word. Every query term must match some token; prefix matches on the
+    (token, kind) index keep lookups logarithmic in the number of patients.
+    """
+
+    @staticmethod
+    def tokens_for(patient):
+        user = patient.user
+        tokens = set()
+        for word in words(user.first_name) + words(user.last_name):
+            tokens.add(('name', word))
+            if not word.isdigit():
+                tokens.add(('sound', soundex(word)))
+        if user.email:
+            tokens.add(('email', normalize(user.email)))
+        patient_id = normalize(patient.patient_id)
+        tokens.add(('id', patient_id))
+        number = re.sub(r'\D', '', patient_id).lstrip('0')
+        if number:
+            tokens.add(('id', number))
+        digits = re.sub(r'\D', '', user.phone_number or '')
+        if digits:
+            tokens.add(('dial', digits))
+            tokens.add(('phone', digits[::-1]))
+        for word in words(patient.insurance_provider):
+            tokens.add(('insurance', word))
+        return {(kind, token[:TOKEN_LENGTH]) for kind, token in tokens if token}
+
+    @classmethod
+    def reindex(cls, patients):
+        """Rebuild the tokens of the given patients (instances with ``user`` loaded)."""
+        patients = list(patients)
+        rows = [
+            PatientSearchToken(patient=patient, kind=kind, token=token)
+            for patient in patients for kind, token in cls.tokens_for(patient)
+        ]
+        with transaction.atomic():
+            PatientSearchToken.objects.filter(patient__in=[patient.pk for patient in patients]).delete()
+            PatientSearchToken.objects.bulk_create(rows, batch_size=1000)
+
+    @classmethod
+    def rebuild(cls, batch_size=1000):
+        """Reindex every patient; returns the number of patients indexed."""
+        PatientSearchToken.objects.all().delete()
+        total = 0
+        batch = []
+        for patient in Patient.objects.select_related('user').order_by('pk').iterator(chunk_size=batch_size):
+            batch.append(patient)
+            if len(batch) >= batch_size:
+                cls.reindex(batch)
+                total += len(batch)
+                batch = []
+        if batch:
+            cls.reindex(batch)
+            total += len(batch)
+        return total
+
+    @staticmethod
+    def _term_condition(term, fuzzy, exact=False):
+        if exact:
+            def match(field, value):
+                return Q(**{field: value[:TOKEN_LENGTH]})
+        else:
+            match = _prefix
+        word = ''.join(words(term))
+        email = normalize(term)
+        condition = Q()
+        if word:
+            condition |= Q(kind__in=PREFIX_KINDS) & match('token', word)
+        if '@' in email or '.' in email:
+            condition |= Q(kind='email') & match('token', email)
+        digits = re.sub(r'\D', '', term)
+        if PHONE_QUERY.match(term) and len(digits) >= 3:
+            condition |= Q(kind='dial') & match('token', digits)
+            if not exact:
+                condition |= Q(kind='phone') & _prefix('token', digits[::-1])
+        if fuzzy and not exact and word.isalpha() and len(word) >= 3:
+            condition |= Q(kind='sound', token=soundex(word))
+        return condition
+
+    @classmethod
+    def matching(cls, query, fuzzy=True, exact=False):
+        """
+        Patient primary keys matching every term of ``query``, as a subquery usable in
+        ``filter(pk__in=...)`` or ``filter(patient__in=...)``. ``exact`` requires each
+        term to equal a whole token rather than start one.
+        """
+        # A query made only of phone characters is one number, however it is spaced
+        terms = [query.strip()] if PHONE_QUERY.match(query.strip()) else query.split()
+        matches = None
+        for term in terms:
+            condition = cls._term_condition(term, fuzzy, exact)
+            if not condition:
+                return Patient.objects.none().values('pk')
+            term_matches = PatientSearchToken.objects.filter(condition).values('patient_id')
+            matches = Patient.objects.filter(pk__in=term_matches) if matches is None else matches.filter(pk__in=term_matches)
+        if matches is None:
+            return Patient.objects.none().values('pk')
+        return matches.values('pk')
+
+    @classmethod
+    def search(cls, query, limit=10):
+        """
+        Up to ``limit`` patients for an autocomplete box, ranked by how they match:
+        whole-token matches first, then prefix matches, then sound-alike names. Each
+        tier is one indexed query and only runs while the box is not yet full.
+        """
+        patients = Patient.objects.select_related('user')
+        results = []
+        for tier in ({'exact': True}, {'fuzzy': False}, {}):
+            if len(results) >= limit:
+                break
+            seen = [patient.pk for patient in results]
+            results += list(
+                patients.filter(pk__in=cls.matching(query, **tier)).exclude(pk__in=seen)[:limit - len(results)]
+            )
+        return results
+
+
+class VitalsSeries:
+    """
+    Time-series reads over PatientVitals for trend charts, backed by the VitalsRollup
+    hourly/daily buckets so a months-long chart reads a few hundred summary rows instead
+    of every reading.
+
+    New readings are folded into their buckets with conditional F() upserts (see
+    patients.signals); edited or deleted readings have their buckets recomputed from
+    the raw rows. series() returns parallel columns (epoch seconds, min, max, avg,
+    count) that chart libraries and numpy.asarray() take as-is.
+    """
+
+    # Metric name -> PatientVitals field
+    METRIC_FIELDS = {
+        'systolic': 'blood_pressure_systolic',
+        'diastolic': 'blood_pressure_diastolic',
+        'pulse': 'pulse_rate',
+        'temperature': 'temperature',
+        'weight': 'weight',
+        'height': 'height',
+    }
+    # series() reads raw readings up to this span and hourly buckets up to the next
+    RAW_MAX_SPAN = timedelta(days=2)
+    HOURLY_MAX_SPAN = timedelta(days=60)
+    RESOLUTIONS = ('raw', 'hour', 'day')
+
+    @staticmethod
+    def bucket_bounds(moment, resolution):
+        """(start, end) of the local hour or day containing ``moment``."""
+        local = timezone.localtime(moment)
+        if resolution == 'hour':
+            start = local.replace(minute=0, second=0, microsecond=0)
+            return start, start + timedelta(hours=1)
+        day = local.date()
+        return (
+            timezone.make_aware(datetime.combine(day, time())),
+            timezone.make_aware(datetime.combine(day + timedelta(days=1), time())),
+        )
+
+    @classmethod
+    def values(cls, vitals):
+        """{metric: value} for the metrics a reading recorded."""
+        return {
+            metric: float(getattr(vitals, field))
+            for metric, field in cls.METRIC_FIELDS.items() if getattr(vitals, field) is not None
+        }
+
+    @classmethod
+    def record(cls, vitals):
+        """Fold a new reading into its hourly and daily buckets."""
+        values = cls.values(vitals)
+        with transaction.atomic():
+            for resolution, _ in VitalsRollup.RESOLUTIONS:
+                start, _ = cls.bucket_bounds(vitals.recorded_at, resolution)
+                for metric, value in values.items():
+                    bucket = VitalsRollup.objects.filter(
+                        patient_id=vitals.patient_id, resolution=resolution, metric=metric, bucket_start=start
+                    )
+                    fold = {
+                        'count': F('count') + 1,
+                        'total': F('total') + value,
+                        'minimum': Least('minimum', value),
+                        'maximum': Greatest('maximum', value),
+                    }
+                    if bucket.update(**fold):
+                        continue
+                    try:
+                        with transaction.atomic():
+                            VitalsRollup.objects.create(
+                                patient_id=vitals.patient_id, resolution=resolution, metric=metric,
+                                bucket_start=start, count=1, total=value, minimum=value, maximum=value,
+                            )
+                    except IntegrityError:
+                        # A concurrent reading opened the bucket first
+                        bucket.update(**fold)
+
+    @classmethod
+    def _aggregates(cls):
+        aggregates = {}
+        for metric, field in cls.METRIC_FIELDS.items():
+            aggregates.update({
+                f'{metric}_count': Count(field),
+                f'{metric}_total': Sum(field),
+                f'{metric}_minimum': Min(field),
+                f'{metric}_maximum': Max(field),
+            })
+        return aggregates
+
+    @classmethod
+    def _rollups(cls, patient_id, resolution, bucket_start, row):
+        return [
+            VitalsRollup(
+                patient_id=patient_id, resolution=resolution, metric=metric, bucket_start=bucket_start,
+                count=row[f'{metric}_count'], total=row[f'{metric}_total'],
+                minimum=row[f'{metric}_minimum'], maximum=row[f'{metric}_maximum'],
+            )
+            for metric in cls.METRIC_FIELDS if row[f'{metric}_count']
+        ]
+
+    @classmethod
+    def recompute(cls, patient_id, moment):
+        """Rebuild the buckets containing ``moment`` from the raw readings (after an edit or delete)."""
+        with transaction.atomic():
+            for resolution, _ in VitalsRollup.RESOLUTIONS:
+                start, end = cls.bucket_bounds(moment, resolution)
+                row = PatientVitals.objects.filter(
+                    patient_id=patient_id, recorded_at__gte=start, recorded_at__lt=end
+                ).aggregate(**cls._aggregates())
+                VitalsRollup.objects.filter(patient_id=patient_id, resolution=resolution, bucket_start=start).delete()
+                VitalsRollup.objects.bulk_create(cls._rollups(patient_id, resolution, start, row))
+
+    @classmethod
+    def rebuild(cls, patient_ids=None):
+        """Recompute every rollup from PatientVitals, optionally for some patients only."""
+        readings = PatientVitals.objects.all()
+        rollups = VitalsRollup.objects.all()
+        if patient_ids:
+            readings = readings.filter(patient_id__in=patient_ids)
+            rollups = rollups.filter(patient_id__in=patient_ids)
+
+        created = 0
+        with transaction.atomic():
+            rollups.delete()
+            for resolution, _ in VitalsRollup.RESOLUTIONS:
+                rows = readings.annotate(
+                    bucket=Trunc('recorded_at', resolution, tzinfo=timezone.get_current_timezone())
+                ).values('patient_id', 'bucket').annotate(**cls._aggregates()).order_by()
+                batch = []
+                for row in rows.iterator(chunk_size=2000):
+                    batch += cls._rollups(row['patient_id'], resolution, row['bucket'], row)
+                    if len(batch) >= 1000:
+                        created += len(VitalsRollup.objects.bulk_create(batch))
+                        batch = []
+                created += len(VitalsRollup.objects.bulk_create(batch))
+        return created
+
+    @classmethod
+    def resolution_for(cls, start, end):
+        span = end - start
+        if span <= cls.RAW_MAX_SPAN:
+            return 'raw'
+        return 'hour' if span <= cls.HOURLY_MAX_SPAN else 'day'
+
+    @classmethod
+    def series(cls, patient, metrics, start, end, resolution=None):
+        """
+        Readings of ``metrics`` between ``start`` and ``end`` as
+        {'resolution': ..., 'metrics': {metric: {'t': [...], 'min': [...], 'max': [...],
+        'avg': [...], 'count': [...]}}}, with t in epoch seconds (bucket starts for
+        'hour'/'day'; raw readings have min = max = avg). ``resolution`` is 'raw', 'hour'
+        or 'day', or None to choose from the span; one finer than the span allows (see
+        RAW_MAX_SPAN and HOURLY_MAX_SPAN) is coarsened so a request never reads more
+        than a span's worth of rows.
+        """
+        resolution = max(resolution or 'raw', cls.resolution_for(start, end), key=cls.RESOLUTIONS.index)
+        columns = {metric: {'t': [], 'min': [], 'max': [], 'avg': [], 'count': []} for metric in metrics}
+
+        if resolution == 'raw':
+            fields = [cls.METRIC_FIELDS[metric] for metric in metrics]
+            rows = PatientVitals.objects.filter(
+                patient=patient, recorded_at__gte=start, recorded_at__lt=end
+            ).order_by('recorded_at').values_list('recorded_at', *fields)
+            for recorded_at, *values in rows:
+                stamp = int(recorded_at.timestamp())
+                for metric, value in zip(metrics, values):
+                    if value is None:
+                        continue
+                    column = columns[metric]
+                    column['t'].append(stamp)
+                    column['min'].append(value)
+                    column['max'].append(value)
+                    column['avg'].append(value)
+                    column['count'].append(1)
+        else:
+            first_bucket, _ = cls.bucket_bounds(start, resolution)
+            rows = VitalsRollup.objects.filter(
+                patient=patient, resolution=resolution, metric__in=metrics,
+                bucket_start__gte=first_bucket, bucket_start__lt=end,
+            ).order_by('metric', 'bucket_start').values_list(
+                'metric', 'bucket_start', 'count', 'total', 'minimum', 'maximum'
+            )
+            for metric, bucket_start, count, total, minimum, maximum in rows:
+                column = columns[metric]
+                column['t'].append(int(bucket_start.timestamp()))
+                column['min'].append(minimum)
+                column['max'].append(maximum)
+                column['avg'].append(round(total / count, 2))
+                column['count'].append(count)
+        return {'resolution': resolution, 'metrics': columns}
+
+
+class CriticalVitalsMonitor:
+    """
+    Raises CriticalVitalAlert rows when a reading crosses CRITICAL_VITAL_THRESHOLDS, at
+    write time (patients.signals), and reads the open ones back for dashboards.
+
+    Editing a reading re-evaluates its open alerts; acknowledged alerts are kept as the
+    record of who reviewed them.
+    """
+
+    @staticmethod
+    def thresholds():
+        return settings.CRITICAL_VITAL_THRESHOLDS
+
+    @classmethod
+    def breaches(cls, vitals):
+        """Unsaved alerts for the metrics of ``vitals`` outside their thresholds."""
+        values = VitalsSeries.values(vitals)
+        alerts = []
+        for metric, limits in cls.thresholds().items():
+            value = values.get(metric)
+            above, below = limits.get('above'), limits.get('below')
+            if value is None:
+                continue
+            if above is not None and value > above:
+                direction, threshold = 'high', above
+            elif below is not None and value < below:
+                direction, threshold = 'low', below
+            else:
+                continue
+            alerts.append(CriticalVitalAlert(
+                vitals_id=vitals.pk, patient_id=vitals.patient_id, metric=metric, value=value,
+                threshold=threshold, direction=direction, recorded_at=vitals.recorded_at,
+            ))
+        return alerts
+
+    @classmethod
+    def check(cls, vitals, created=True):
+        alerts = cls.breaches(vitals)
+        if created:
+            CriticalVitalAlert.objects.bulk_create(alerts)
+            return alerts
+        with transaction.atomic():
+            vitals.alerts.filter(acknowledged=False).delete()
+            reviewed = set(vitals.alerts.values_list('metric', flat=True))
+            alerts = [alert for alert in alerts if alert.metric not in reviewed]
+            CriticalVitalAlert.objects.bulk_create(alerts)
+        return alerts
+
+    @staticmethod
+    def open_alerts():
+        return CriticalVitalAlert.objects.filter(acknowledged=False).order_by('-recorded_at')
+
+    @staticmethod
+    def acknowledge(alert_ids, user):
+        return CriticalVitalAlert.objects.filter(pk__in=alert_ids, acknowledged=False).update(
+            acknowledged=True, acknowledged_by=user, acknowledged_at=timezone.now(),
+        )
+
+    @classmethod
+    def backfill(cls, since=None):
+        """
+        Raise alerts for existing readings (e.g. after changing thresholds); readings that
+        already have an alert for a metric keep it. Returns the number of breaches found.
+        """
+        condition = Q(pk__in=[])
+        for metric, limits in cls.thresholds().items():
+            field = VitalsSeries.METRIC_FIELDS[metric]
+            if limits.get('above') is not None:
+                condition |= Q(**{f'{field}__gt': limits['above']})
+            if limits.get('below') is not None:
+                condition |= Q(**{f'{field}__lt': limits['below']})
+        readings = PatientVitals.objects.filter(condition)
+        if since is not None:
+            readings = readings.filter(recorded_at__gte=since)
+
+        found = 0
+        batch = []
+        for vitals in readings.order_by().iterator(chunk_size=2000):
+            batch += cls.breaches(vitals)
+            if len(batch) >= 1000:
+                found += len(CriticalVitalAlert.objects.bulk_create(batch, ignore_conflicts=True))
+                batch = []
+        found += len(CriticalVitalAlert.objects.bulk_create(batch, ignore_conflicts=True))
+        return found
+
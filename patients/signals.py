@@ -0,0 +1,44 @@
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Patient, PatientVitals
+from .services import CriticalVitalsMonitor, PatientSearchIndex, VitalsSeries
+
+
+@receiver(post_save, sender=Patient)
+def index_patient(sender, instance, **kwargs):
+    PatientSearchIndex.reindex([instance])
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def index_patient_user(sender, instance, created, update_fields=None, **kwargs):
+    # New patient users are indexed when their Patient profile is saved, and a login
+    # only saves last_login, which no token is built from
+    if created or instance.role != 'patient':
+        return
+    if update_fields is not None and set(update_fields) <= {'last_login'}:
+        return
+    patient = Patient.objects.filter(user=instance).first()
+    if patient:
+        patient.user = instance
+        PatientSearchIndex.reindex([patient])
+
+
+@receiver(post_save, sender=PatientVitals)
+def roll_up_vitals(sender, instance, created, **kwargs):
+    if created:
+        VitalsSeries.record(instance)
+    else:
+        VitalsSeries.recompute(instance.patient_id, instance.recorded_at)
+
+
+@receiver(post_save, sender=PatientVitals)
+def raise_vital_alerts(sender, instance, created, **kwargs):
+    CriticalVitalsMonitor.check(instance, created)
+
+
+@receiver(post_delete, sender=PatientVitals)
+def roll_up_deleted_vitals(sender, instance, **kwargs):
+    VitalsSeries.recompute(instance.patient_id, instance.recorded_at)
+
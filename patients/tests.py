@@ -1,3 +1,251 @@
-from django.test import TestCase
+from datetime import date, datetime, time, timedelta
 
-# Create your tests here.
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Max, Min, Sum
+from django.db.models.signals import post_save
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from accounts.models import User
+from appointments.models import Appointment, Doctor
+from billing.models import Bill, BillingStaff
+from medical_records.models import MedicalRecord
+from .models import CriticalVitalAlert, Patient, PatientVitals, VitalsRollup
+from .services import CriticalVitalsMonitor, PatientSearchIndex, VitalsSeries
+
+
+class PatientListQueryCountTests(TestCase):
+    """patient_list must cost the same number of queries whatever the page size."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_user(email='admin@example.com', role='administrator')
+        doctor_user = User.objects.create_user(email='doctor@example.com', role='doctor')
+        staff_user = User.objects.create_user(email='billing@example.com', role='billing_staff')
+        doctor = Doctor.objects.get(user=doctor_user)
+        staff = BillingStaff.objects.get(user=staff_user)
+        for i in range(60):
+            user = User.objects.create_user(
+                email=f'patient{i}@example.com', role='patient',
+                first_name=f'Patient{i}', date_of_birth=date(1990, 1, 1) + timedelta(days=i),
+            )
+            patient = Patient.objects.get(user=user)
+            Appointment.objects.create(
+                patient=patient, doctor=doctor, appointment_date=date.today(),
+                appointment_time=time(9, 0), reason='Checkup',
+            )
+            MedicalRecord.objects.create(
+                patient=patient, doctor=doctor, diagnosis='Flu', symptoms='Fever', treatment_plan='Rest',
+            )
+            Bill.objects.create(patient=patient, due_date=date.today(), created_by=staff, total_amount=100)
+        cls.patient = patient
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.admin)
+
+    def _queries_for_page(self, per_page):
+        # Warm the per-role caches (permissions, unread badge) so only the page is measured
+        self.client.get(reverse('patients:patient_list'), {'per_page': per_page})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('patients:patient_list'), {'per_page': per_page})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['patients']), per_page)
+        return len(queries)
+
+    def test_query_count_is_constant_per_page_size(self):
+        counts = {per_page: self._queries_for_page(per_page) for per_page in (10, 25, 50)}
+        self.assertEqual(len(set(counts.values())), 1, counts)
+
+    def test_stats_are_annotated(self):
+        response = self.client.get(reverse('patients:patient_list'), {'per_page': 10})
+        newest = response.context['patients'][0]
+        self.assertEqual(newest.pk, self.patient.pk)
+        self.assertEqual(newest.appointment_count, 1)
+        self.assertEqual(newest.medical_record_count, 1)
+        self.assertEqual(newest.outstanding_bills, 1)
+        self.assertIsNotNone(newest.calculated_age)
+
+
+class PatientSearchIndexTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            email='wanjiru@example.com', role='patient', first_name='Wanjiru', last_name='Kamau',
+            phone_number='+254712345678',
+        )
+        self.patient = Patient.objects.get(user=self.user)
+
+    def found(self, query):
+        return self.patient in Patient.objects.filter(pk__in=PatientSearchIndex.matching(query))
+
+    def test_phone_prefix_and_suffix(self):
+        for query in ('+254', '254712', '+254 712 345', '5678', '345678'):
+            with self.subTest(query=query):
+                self.assertTrue(self.found(query))
+        self.assertFalse(self.found('+255'))
+
+    def test_search_ranks_exact_then_prefix_then_sound_alike(self):
+        def patient(first_name):
+            user = User.objects.create_user(
+                email=f'{first_name.lower()}@example.com', role='patient', first_name=first_name, last_name='Otieno',
+            )
+            return Patient.objects.get(user=user)
+
+        # Created worst match first, so insertion order cannot explain the ranking
+        aune, annabel, ann = patient('Aune'), patient('Annabel'), patient('Ann')
+        self.assertEqual(PatientSearchIndex.search('ann'), [ann, annabel, aune])
+        self.assertEqual(PatientSearchIndex.search('ann otieno', limit=2), [ann, annabel])
+        self.assertEqual(PatientSearchIndex.search('ann', limit=1), [ann])
+
+    def test_login_does_not_reindex(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.force_login(self.user)
+        self.assertFalse([q for q in queries if 'patientsearchtoken' in q['sql']])
+        self.user.phone_number = '+254700000001'
+        self.user.save()
+        self.assertTrue(self.found('0001'))
+        self.assertFalse(self.found('5678'))
+
+
+class VitalsSeriesTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.doctor_user = User.objects.create_user(email='doctor@example.com', role='doctor')
+        self.patient = Patient.objects.get(user=User.objects.create_user(email='patient@example.com', role='patient'))
+        self.base = timezone.make_aware(datetime.combine(timezone.localdate() - timedelta(days=100), time(8, 0)))
+
+    def reading(self, minutes=None, **values):
+        vitals = PatientVitals.objects.create(patient=self.patient, recorded_by=self.doctor_user, **values)
+        if minutes is not None:
+            PatientVitals.objects.filter(pk=vitals.pk).update(recorded_at=self.base + timedelta(minutes=minutes))
+        return vitals
+
+    def rollups(self):
+        return sorted(
+            (row.resolution, row.metric, row.bucket_start, row.count, round(row.total, 6), row.minimum, row.maximum)
+            for row in VitalsRollup.objects.filter(patient=self.patient)
+        )
+
+    def assertMatchesRebuild(self):
+        incremental = self.rollups()
+        VitalsSeries.rebuild([self.patient.pk])
+        self.assertEqual(incremental, self.rollups())
+
+    def test_buckets_follow_creates_edits_and_deletes(self):
+        first = self.reading(pulse_rate=70, temperature=36.6)
+        self.reading(pulse_rate=90)
+        last = self.reading(pulse_rate=80, blood_pressure_systolic=120)
+        self.assertMatchesRebuild()
+        # The readings may straddle an hour boundary, so fold the hourly buckets together
+        hourly = VitalsRollup.objects.filter(patient=self.patient, resolution='hour', metric='pulse')
+        self.assertEqual(
+            hourly.aggregate(count=Sum('count'), total=Sum('total'), low=Min('minimum'), high=Max('maximum')),
+            {'count': 3, 'total': 240, 'low': 70, 'high': 90},
+        )
+
+        first.pulse_rate = 100
+        first.save()
+        self.assertMatchesRebuild()
+        last.delete()
+        self.assertMatchesRebuild()
+        self.assertFalse(VitalsRollup.objects.filter(patient=self.patient, metric='systolic').exists())
+
+    def test_series_columns(self):
+        for minutes, pulse in ((0, 60), (20, 80), (70, 100), (24 * 60, 90)):
+            self.reading(minutes, pulse_rate=pulse)
+        VitalsSeries.rebuild([self.patient.pk])
+        start, end = self.base, self.base + timedelta(days=2)
+        epoch = int(self.base.timestamp())
+
+        raw = VitalsSeries.series(self.patient, ['pulse'], start, end)
+        self.assertEqual(raw['resolution'], 'raw')
+        self.assertEqual(raw['metrics']['pulse']['t'], [epoch, epoch + 1200, epoch + 4200, epoch + 86400])
+        self.assertEqual(raw['metrics']['pulse']['avg'], [60, 80, 100, 90])
+
+        hourly = VitalsSeries.series(self.patient, ['pulse', 'temperature'], start, end, 'hour')['metrics']
+        self.assertEqual(hourly['pulse'], {
+            't': [epoch, epoch + 3600, epoch + 86400], 'min': [60, 100, 90], 'max': [80, 100, 90],
+            'avg': [70, 100, 90], 'count': [2, 1, 1],
+        })
+        self.assertEqual(hourly['temperature']['t'], [])
+
+        daily = VitalsSeries.series(self.patient, ['pulse'], start, end, 'day')['metrics']['pulse']
+        self.assertEqual((daily['count'], daily['avg']), ([3, 1], [80, 90]))
+
+    def test_fine_resolutions_are_coarsened_for_long_spans(self):
+        def resolution(days, requested):
+            end = self.base + timedelta(days=days)
+            return VitalsSeries.series(self.patient, ['pulse'], self.base, end, requested)['resolution']
+
+        self.assertEqual(resolution(1, 'raw'), 'raw')
+        self.assertEqual(resolution(30, 'raw'), 'hour')
+        self.assertEqual(resolution(90, 'hour'), 'day')
+        self.assertEqual(resolution(1, 'day'), 'day')
+
+        self.client.force_login(self.doctor_user)
+        response = self.client.get(reverse('medical_records:vitals_series_api', args=[self.patient.patient_id]), {
+            'from': '2020-01-01', 'to': '2021-01-01', 'resolution': 'raw',
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['resolution'], 'day')
+
+
+@override_settings(CRITICAL_VITAL_THRESHOLDS={
+    'systolic': {'above': 140},
+    'pulse': {'below': 40, 'above': 130},
+})
+class CriticalVitalsMonitorTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.doctor_user = User.objects.create_user(email='doctor@example.com', role='doctor')
+        self.patient = Patient.objects.get(user=User.objects.create_user(email='patient@example.com', role='patient'))
+
+    def reading(self, **values):
+        return PatientVitals.objects.create(patient=self.patient, recorded_by=self.doctor_user, **values)
+
+    def alerts(self):
+        fields = ('metric', 'direction', 'value', 'threshold', 'acknowledged')
+        return sorted(CriticalVitalAlert.objects.values_list(*fields))
+
+    def test_threshold_crossings(self):
+        self.reading(blood_pressure_systolic=140, pulse_rate=40)
+        self.reading(blood_pressure_systolic=120, pulse_rate=130, temperature=41.0)
+        self.assertEqual(self.alerts(), [])
+        self.reading(blood_pressure_systolic=141, pulse_rate=39)
+        self.assertEqual(self.alerts(), [('pulse', 'low', 39, 40, False), ('systolic', 'high', 141, 140, False)])
+
+    def test_resave_does_not_duplicate_alerts(self):
+        vitals = self.reading(blood_pressure_systolic=180, pulse_rate=150)
+        vitals.save()
+        self.assertEqual(CriticalVitalAlert.objects.count(), 2)
+
+        CriticalVitalsMonitor.acknowledge([vitals.alerts.get(metric='systolic').pk], self.doctor_user)
+        vitals.blood_pressure_systolic = 190
+        vitals.pulse_rate = 70
+        vitals.save()
+        # The reviewed alert is kept as it was; the pulse alert no longer applies
+        self.assertEqual(self.alerts(), [('systolic', 'high', 180, 140, True)])
+        self.assertEqual(list(CriticalVitalsMonitor.open_alerts()), [])
+
+    def test_alerts_share_the_reading_transaction(self):
+        self.client.force_login(self.doctor_user)
+        url = reverse('medical_records:record_vitals', args=[self.patient.patient_id])
+        self.client.post(url, {'bp_systolic': '170', 'pulse_rate': '80'})
+        self.assertEqual(self.alerts(), [('systolic', 'high', 170, 140, False)])
+
+        def fail(**kwargs):
+            raise RuntimeError('rollup failed')
+
+        # A receiver that runs after the alerts fails: the reading and its alert go together
+        post_save.connect(fail, sender=PatientVitals, dispatch_uid='test_fail_after_alerts')
+        self.addCleanup(post_save.disconnect, sender=PatientVitals, dispatch_uid='test_fail_after_alerts')
+        self.client.post(url, {'bp_systolic': '200'})
+        self.assertEqual(PatientVitals.objects.count(), 1)
+        self.assertEqual(CriticalVitalAlert.objects.count(), 1)
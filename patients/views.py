@@ -1,21 +1,52 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse
 from django.views.decorators.http import require_http_methods
 from django.db import transaction
-from django.db.models import Q, Count
-from django.core.paginator import Paginator
+from django.db.models import Q, Count, Case, When, Value, OuterRef, Subquery
+from django.db.models.functions import Coalesce, ExtractYear
 from django.template.loader import render_to_string
 from django.utils import timezone
 from datetime import date, timedelta
-import csv
 import json
 from .forms import PatientCreationForm
 from .models import Patient
+from .services import PatientSearchIndex
 from appointments.models import Appointment
 from medical_records.models import MedicalRecord
 from billing.models import Bill
+from dashboard.exports import Column, choice_label, streaming_export
+from dashboard.pagination import CursorPaginator
+
+def _related_count(queryset):
+    """Correlated COUNT of ``queryset`` rows belonging to the outer patient."""
+    return Coalesce(Subquery(
+        queryset.filter(patient=OuterRef('pk')).order_by()
+        .values('patient').annotate(c=Count('pk')).values('c')
+    ), 0)
+
+
+def annotate_patient_list_stats(patients, today=None):
+    """
+    Annotate age, appointment/record counts and outstanding bills in SQL.
+    Correlated subqueries (rather than joins) keep row counts intact and are only
+    evaluated for the rows actually fetched, i.e. the current page.
+    """
+    today = today or date.today()
+    dob = 'user__date_of_birth'
+    birthday_pending = Q(**{f'{dob}__month__gt': today.month}) | Q(
+        **{f'{dob}__month': today.month, f'{dob}__day__gt': today.day}
+    )
+    return patients.annotate(
+        calculated_age=Value(today.year) - ExtractYear(dob) - Case(
+            When(birthday_pending, then=Value(1)), default=Value(0)
+        ),
+        appointment_count=_related_count(Appointment.objects.all()),
+        medical_record_count=_related_count(MedicalRecord.objects.all()),
+        outstanding_bills=_related_count(Bill.objects.filter(status__in=['pending', 'overdue'])),
+    )
+
 
 @login_required
 def create_patient(request):
@@ -85,15 +116,7 @@ def patient_search_ajax(request):
     if len(query) < 2:
         return JsonResponse({'patients': []})
 
-    patients = Patient.objects.filter(
-        user__first_name__icontains=query
-    ).union(
-        Patient.objects.filter(user__last_name__icontains=query)
-    ).union(
-        Patient.objects.filter(user__email__icontains=query)
-    ).union(
-        Patient.objects.filter(patient_id__icontains=query)
-    )[:10]
+    patients = PatientSearchIndex.search(query, limit=10)
 
     patient_data = [{
         'id': patient.patient_id,
@@ -113,20 +136,13 @@ def patient_list(request):
         messages.error(request, "You don't have permission to view patients.")
         return redirect('dashboard:dashboard')
 
-    # Base queryset with related data
-    patients = Patient.objects.select_related('user').prefetch_related('appointments', 'medical_records', 'bills')
+    # Base queryset with related data (per-patient stats are annotated below)
+    patients = Patient.objects.select_related('user')
 
     # Search functionality
     search_query = request.GET.get('search', '') or request.GET.get('q', '')
     if search_query:
-        patients = patients.filter(
-            Q(user__first_name__icontains=search_query) |
-            Q(user__last_name__icontains=search_query) |
-            Q(user__email__icontains=search_query) |
-            Q(patient_id__icontains=search_query) |
-            Q(user__phone_number__icontains=search_query) |
-            Q(insurance_provider__icontains=search_query)
-        )
+        patients = patients.filter(pk__in=PatientSearchIndex.matching(search_query))
 
     # Filter by gender
     gender_filter = request.GET.get('gender', '')
@@ -149,30 +165,17 @@ def patient_list(request):
         elif date_filter == 'month':
             patients = patients.filter(created_at__date__gte=today - timedelta(days=30))
 
-    # Sorting
+    # Sorting (applied by the cursor paginator, which needs the columns as a list)
     sort_by = request.GET.get('sort', 'date')
     if sort_by == 'name':
-        patients = patients.order_by('user__last_name', 'user__first_name')
-    elif sort_by == 'date':
-        patients = patients.order_by('-created_at')
+        ordering = ['user__last_name', 'user__first_name']
     elif sort_by == 'id':
-        patients = patients.order_by('patient_id')
+        ordering = ['patient_id']
     else:
-        patients = patients.order_by('-created_at')
-
-    # Calculate ages and additional stats
-    for patient in patients:
-        if hasattr(patient.user, 'date_of_birth') and patient.user.date_of_birth:
-            today = date.today()
-            patient.calculated_age = today.year - patient.user.date_of_birth.year - (
-                (today.month, today.day) < (patient.user.date_of_birth.month, patient.user.date_of_birth.day)
-            )
-        else:
-            patient.calculated_age = None
+        ordering = ['-created_at']
 
-        patient.appointment_count = patient.appointments.count()
-        patient.medical_record_count = patient.medical_records.count()
-        patient.outstanding_bills = patient.bills.filter(status__in=['pending', 'overdue']).count()
+    # Ages and additional stats, computed in SQL for the visible page only
+    patients = annotate_patient_list_stats(patients)
 
     # Pagination
     page_size = request.GET.get('per_page', 25)
@@ -183,9 +186,8 @@ def patient_list(request):
     except (ValueError, TypeError):
         page_size = 25
 
-    paginator = Paginator(patients, page_size)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    paginator = CursorPaginator(patients, page_size, ordering, estimate_count=True)
+    page_obj = paginator.get_page(request.GET.get('cursor'))
 
     # Statistics
     total_patients = Patient.objects.count()
@@ -324,42 +326,29 @@ def patient_delete(request, patient_id):
 
 @login_required
 def patient_export(request):
-    """Export patients to CSV"""
+    """Stream patients as CSV, NDJSON or XLSX (?format=)"""
 
     if not request.user.role in ['doctor', 'administrator']:
         messages.error(request, "You don't have permission to export patient data.")
         return redirect('patients:patient_list')
 
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = 'attachment; filename="patients_export.csv"'
-
-    writer = csv.writer(response)
-    writer.writerow([
-        'Patient ID', 'First Name', 'Last Name', 'Email', 'Phone',
-        'Gender', 'Blood Group', 'Date of Birth', 'Address',
-        'Emergency Contact', 'Emergency Phone', 'Insurance Provider',
-        'Registration Date'
-    ])
-
-    patients = Patient.objects.select_related('user').all()
-    for patient in patients:
-        writer.writerow([
-            patient.patient_id,
-            patient.user.first_name,
-            patient.user.last_name,
-            patient.user.email,
-            getattr(patient.user, 'phone_number', ''),
-            patient.get_gender_display(),
-            patient.blood_group,
-            getattr(patient.user, 'date_of_birth', ''),
-            getattr(patient.user, 'address', ''),
-            patient.emergency_contact_name,
-            patient.emergency_contact_phone,
-            patient.insurance_provider,
-            patient.created_at.strftime('%Y-%m-%d') if patient.created_at else ''
-        ])
-
-    return response
+    columns = [
+        Column('Patient ID', 'patient_id'),
+        Column('First Name', 'user__first_name'),
+        Column('Last Name', 'user__last_name'),
+        Column('Email', 'user__email'),
+        Column('Phone', 'user__phone_number'),
+        Column('Gender', 'gender', choice_label(Patient.GENDER_CHOICES)),
+        Column('Blood Group', 'blood_group'),
+        Column('Date of Birth', 'user__date_of_birth'),
+        Column('Address', 'user__address'),
+        Column('Emergency Contact', 'emergency_contact_name'),
+        Column('Emergency Phone', 'emergency_contact_phone'),
+        Column('Insurance Provider', 'insurance_provider'),
+        Column('Registration Date', 'created_at', lambda value: timezone.localtime(value).date() if value else None),
+    ]
+    patients = Patient.objects.order_by('created_at', 'patient_id')
+    return streaming_export(patients, columns, 'patients_export', request.GET.get('format', 'csv'))
 
 
 @login_required
@@ -0,0 +1,156 @@
+import asyncio
+import json
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+# Seconds between keepalive comments on an idle stream
+HEARTBEAT_SECONDS = 15
+# Under WSGI each stream holds a worker thread, so it is closed after this long;
+# EventSource reconnects on its own and resumes from Last-Event-ID
+WSGI_STREAM_SECONDS = 300
+
+
+class Subscription:
+    """
+    One listener's queue. Brokers call put() from any thread; the stream reads with
+    aget() on its event loop (ASGI) or get() on its worker thread (WSGI).
+    """
+
+    def __init__(self, backlog=(), maxlen=1000):
+        # A consumer that falls this far behind loses its oldest events
+        self._events = deque(backlog, maxlen=maxlen)
+        self._condition = threading.Condition()
+        try:
+            self._loop = asyncio.get_running_loop()
+            self._wakeup = asyncio.Event()
+        except RuntimeError:
+            self._loop = None
+
+    def put(self, record):
+        with self._condition:
+            self._events.append(record)
+            self._condition.notify()
+        if self._loop is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._wakeup.set)
+            except RuntimeError:
+                pass  # the listener's loop has shut down
+
+    def _pop(self):
+        with self._condition:
+            return self._events.popleft() if self._events else None
+
+    def get(self, timeout):
+        """Next (id, event, data) record, or None after ``timeout`` seconds."""
+        with self._condition:
+            if not self._events:
+                self._condition.wait(timeout)
+            return self._events.popleft() if self._events else None
+
+    async def aget(self, timeout):
+        record = self._pop()
+        if record is None:
+            self._wakeup.clear()
+            # Re-check after clearing so an event published in between is not missed
+            record = self._pop()
+            if record is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    return None
+                record = self._pop()
+        return record
+
+
+class InProcessBroker:
+    """
+    Fans events out to the subscribers of this process and keeps the last ``history``
+    events so reconnecting clients can catch up.
+
+    Only listeners in the publishing process are reached; deployments running several
+    workers point PHARMACY_EVENT_BROKER at a broker with the same publish/subscribe/
+    unsubscribe methods backed by a shared channel.
+    """
+
+    def __init__(self, history=500):
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._history = deque(maxlen=history)
+        self._last_id = 0
+
+    def publish(self, event, data):
+        with self._lock:
+            self._last_id += 1
+            record = (self._last_id, event, data)
+            self._history.append(record)
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            subscription.put(record)
+
+    def subscribe(self, last_event_id=None):
+        with self._lock:
+            backlog = []
+            if last_event_id is not None and last_event_id <= self._last_id:
+                backlog = [record for record in self._history if record[0] > last_event_id]
+            subscription = Subscription(backlog)
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            _broker = import_string(settings.PHARMACY_EVENT_BROKER)()
+        return _broker
+
+
+def publish(event, data):
+    """Publish once the current transaction commits (immediately outside one)."""
+    transaction.on_commit(lambda: get_broker().publish(event, data))
+
+
+def _format(record):
+    event_id, event, data = record
+    return f"id: {event_id}\nevent: {event}\ndata: {json.dumps(data, cls=DjangoJSONEncoder)}\n\n"
+
+
+async def stream(last_event_id=None):
+    """Server-sent events for an ASGI response; runs until the client disconnects."""
+    broker = get_broker()
+    subscription = broker.subscribe(last_event_id)
+    try:
+        yield 'retry: 5000\n\n'
+        while True:
+            record = await subscription.aget(HEARTBEAT_SECONDS)
+            yield _format(record) if record else ': keepalive\n\n'
+    finally:
+        broker.unsubscribe(subscription)
+
+
+def stream_sync(last_event_id=None):
+    """Bounded server-sent events for WSGI servers (see WSGI_STREAM_SECONDS)."""
+    broker = get_broker()
+    subscription = broker.subscribe(last_event_id)
+    deadline = time.monotonic() + WSGI_STREAM_SECONDS
+    try:
+        yield 'retry: 1000\n\n'
+        while time.monotonic() < deadline:
+            record = subscription.get(HEARTBEAT_SECONDS)
+            yield _format(record) if record else ': keepalive\n\n'
+    finally:
+        broker.unsubscribe(subscription)
@@ -38,6 +38,11 @@ class Inventory(models.Model):
     
     class Meta:
         verbose_name_plural = "Inventories"
+        indexes = [
+            models.Index(fields=['expiry_date'], name='inventory_expiry_idx'),
+            # MAX(updated_at) fingerprints the inventory API responses (pharmacy.services.inventory_etag)
+            models.Index(fields=['updated_at'], name='inventory_updated_idx'),
+        ]
     
     def __str__(self):
         return f"{self.medicine.name} - Batch: {self.batch_number}"
@@ -50,6 +55,11 @@ class MedicineDispensing(models.Model):
     dispensed_at = models.DateTimeField(auto_now_add=True)
     notes = models.TextField(blank=True)
     
+    class Meta:
+        indexes = [
+            models.Index(fields=['dispensed_at'], name='dispensing_date_idx'),
+        ]
+    
     def __str__(self):
         return f"Dispensed: {self.inventory_item.medicine.name} - {self.quantity_dispensed} units"
     
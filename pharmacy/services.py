@@ -0,0 +1,394 @@
+import hashlib
+import threading
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, CharField, Count, Exists, F, Max, OuterRef, Sum, Value, When
+from django.utils import timezone
+
+from dashboard.pagination import CursorPaginator
+from medical_records.models import MedicalRecord, Prescription
+from patients.services import words
+from .events import publish
+from .models import Inventory, Medicine, MedicineDispensing
+
+# Same thresholds as stockStatus() in static/pharmacy/js/script.js
+EXPIRY_WARNING_DAYS = 90
+CRITICAL_STOCK_LEVEL = 5
+
+
+def stock_status(today=None):
+    """
+    SQL expression for an inventory row's status: 'expiring' within EXPIRY_WARNING_DAYS,
+    else 'critical' at CRITICAL_STOCK_LEVEL units or fewer, else 'low' at or below the
+    row's minimum_stock_level, else 'normal'.
+    """
+    today = today or timezone.localdate()
+    return Case(
+        When(expiry_date__lt=today + timedelta(days=EXPIRY_WARNING_DAYS), then=Value('expiring')),
+        When(quantity_in_stock__lte=CRITICAL_STOCK_LEVEL, then=Value('critical')),
+        When(quantity_in_stock__lte=F('minimum_stock_level'), then=Value('low')),
+        default=Value('normal'),
+        output_field=CharField(),
+    )
+
+
+def stock_level(quantity, minimum_stock_level):
+    """'critical', 'low' or 'normal': the stock half of stock_status(), for a single row in Python."""
+    if quantity <= CRITICAL_STOCK_LEVEL:
+        return 'critical'
+    if quantity <= minimum_stock_level:
+        return 'low'
+    return 'normal'
+
+
+def publish_stock_change(item, previous_level):
+    """Push a 'stock' event to the pharmacy live-update stream."""
+    publish('stock', {
+        'id': item.pk,
+        'medicine': item.medicine.name,
+        'generic_name': item.medicine.generic_name,
+        'batch_number': item.batch_number,
+        'quantity_in_stock': item.quantity_in_stock,
+        'minimum_stock_level': item.minimum_stock_level,
+        'unit_price': str(item.unit_price),
+        'expiry_date': item.expiry_date,
+        'supplier': item.supplier,
+        'date_received': item.date_received,
+        'level': stock_level(item.quantity_in_stock, item.minimum_stock_level),
+        'previous_level': previous_level,
+    })
+
+
+def inventory_etag(request, *args, **kwargs):
+    """
+    ETag for the inventory JSON endpoints, for use with django's @etag.
+
+    Stock changes show up as a new MAX(updated_at) (or a new row count after a delete;
+    medicine edits touch their batches, see pharmacy.signals). The date is included
+    because statuses age into 'expiring', and the full path because each query string
+    and cursor is a different page.
+    """
+    state = Inventory.objects.aggregate(count=Count('id'), updated=Max('updated_at'))
+    fingerprint = f"{state['count']}:{state['updated']}:{timezone.localdate()}:{request.get_full_path()}"
+    return hashlib.md5(fingerprint.encode()).hexdigest()
+
+
+class DispensingError(Exception):
+    """Raised when a prescription cannot be dispensed from stock."""
+
+
+class DispensingService:
+    """
+    Single entry point for dispensing, shared by dispensing_api and dispense_medicine_api.
+
+    Stock is allocated first-expiry-first-out across a medicine's unexpired batches.
+    Batches are locked with select_for_update and decremented with conditional F()
+    updates, so concurrent dispenses can never take a batch below zero (on SQLite, which
+    has no row locks, the conditional update alone rejects the loser). All lines of a
+    call, their MedicineDispensing rows and the prescriptions' dispensed flags commit or
+    roll back together. After commit the pharmacy stream gets a 'dispensed' event, plus
+    a 'stock' event for every batch that crossed a stock level.
+    """
+
+    @staticmethod
+    def medicine_ids_for(prescription):
+        """Medicines whose name matches the prescription's free-text medication_name."""
+        return list(
+            Medicine.objects.filter(name__iexact=prescription.medication_name.strip()).values_list('id', flat=True)
+        )
+
+    @staticmethod
+    def available(medicine_ids, today=None):
+        """Units of the given medicines in unexpired batches."""
+        today = today or timezone.localdate()
+        return Inventory.objects.filter(
+            medicine_id__in=medicine_ids, expiry_date__gte=today
+        ).aggregate(total=Sum('quantity_in_stock'))['total'] or 0
+
+    @classmethod
+    def _allocate(cls, medicine_ids, quantity, today):
+        """Take ``quantity`` units FEFO; returns [(batch, units), ...]. Must run inside a transaction."""
+        batches = list(
+            Inventory.objects.select_for_update().filter(
+                medicine_id__in=medicine_ids, quantity_in_stock__gt=0, expiry_date__gte=today
+            ).order_by('expiry_date', 'id')
+        )
+        available = sum(batch.quantity_in_stock for batch in batches)
+        if available < quantity:
+            raise DispensingError(f'Insufficient stock: {available} available, {quantity} requested.')
+
+        allocations = []
+        remaining = quantity
+        for batch in batches:
+            units = min(remaining, batch.quantity_in_stock)
+            updated = Inventory.objects.filter(pk=batch.pk, quantity_in_stock__gte=units).update(
+                quantity_in_stock=F('quantity_in_stock') - units,
+                updated_at=timezone.now(),
+            )
+            if not updated:
+                raise DispensingError('Stock changed while dispensing; please try again.')
+            previous_level = stock_level(batch.quantity_in_stock, batch.minimum_stock_level)
+            batch.quantity_in_stock -= units
+            if stock_level(batch.quantity_in_stock, batch.minimum_stock_level) != previous_level:
+                publish_stock_change(batch, previous_level)
+            allocations.append((batch, units))
+            remaining -= units
+            if not remaining:
+                break
+        return allocations
+
+    @classmethod
+    def dispense(cls, lines, pharmacist, dispensed_by=None, notes=''):
+        """
+        Dispense prescription lines in one transaction.
+
+        ``lines`` is a list of (prescription, quantity, medicine_ids); medicine_ids may be
+        None to match the prescription's medication_name. Each prescription is marked
+        dispensed, and one MedicineDispensing row is written per batch drawn from.
+        Returns the MedicineDispensing rows.
+        """
+        if not lines:
+            raise DispensingError('Nothing to dispense.')
+
+        resolved = []
+        for prescription, quantity, medicine_ids in lines:
+            if quantity is None or quantity <= 0:
+                raise DispensingError('Quantity must be greater than zero.')
+            medicine_ids = medicine_ids or cls.medicine_ids_for(prescription)
+            if not medicine_ids:
+                raise DispensingError(f'No medicine in stock matches "{prescription.medication_name}".')
+            resolved.append((prescription, quantity, sorted(medicine_ids)))
+        # Lock prescriptions, then batches, in a stable order so concurrent calls can't deadlock
+        resolved.sort(key=lambda line: (line[2], line[0].pk))
+
+        today = timezone.localdate()
+        now = timezone.now()
+        records = []
+        with transaction.atomic():
+            for prescription in sorted({line[0].pk for line in resolved}):
+                claimed = Prescription.objects.filter(pk=prescription, is_dispensed=False).update(
+                    is_dispensed=True, dispensed_at=now, dispensed_by=dispensed_by, updated_at=now,
+                )
+                if not claimed:
+                    raise DispensingError(f'Prescription {prescription} has already been dispensed.')
+
+            for prescription, quantity, medicine_ids in resolved:
+                for batch, units in cls._allocate(medicine_ids, quantity, today):
+                    records.append(MedicineDispensing.objects.create(
+                        prescription=prescription,
+                        inventory_item=batch,
+                        pharmacist=pharmacist,
+                        quantity_dispensed=units,
+                        notes=notes,
+                    ))
+            publish('dispensed', {
+                'prescription_ids': sorted({prescription.pk for prescription, _, _ in resolved}),
+                'record_ids': sorted({prescription.medical_record_id for prescription, _, _ in resolved}),
+                'items': [
+                    {'id': record.inventory_item_id, 'quantity_in_stock': record.inventory_item.quantity_in_stock}
+                    for record in records
+                ],
+                'dispensed': len(records),
+            })
+        for prescription, _, _ in resolved:
+            prescription.is_dispensed = True
+            prescription.dispensed_at = now
+            prescription.dispensed_by = dispensed_by
+            prescription.updated_at = now
+        return records
+
+
+class PrescriptionQueue:
+    """
+    The pharmacy's prescription queue: one entry per medical record with prescriptions,
+    records with anything left to dispense first, newest first within each group.
+
+    Each group is walked with keyset pagination on MedicalRecord.created_at. The pending
+    group is driven from the undispensed prescriptions (rx_pending_idx) and their
+    records looked up by key, so it costs as much as the pending queue is long, however
+    much dispensed history has built up. The prescription lines of the page's records
+    are then read in one query.
+
+    ``since`` polling is at-least-once: callers pass back ``watermark()``, which trails
+    the clock by WATERMARK_LAG so a prescription saved just before a poll but committed
+    after it is still picked up by the next one, at the cost of repeating some entries.
+    """
+
+    SEGMENTS = ('pending', 'dispensed')
+    # Longer than a dispensing transaction can stay open: its updated_at is taken
+    # before it waits up to the database lock timeout (see DATABASES OPTIONS)
+    WATERMARK_LAG = timedelta(seconds=30)
+
+    @classmethod
+    def watermark(cls):
+        """The ``since`` to pass on the next poll."""
+        return timezone.now() - cls.WATERMARK_LAG
+
+    @classmethod
+    def page(cls, limit, cursor=None, since=None):
+        """
+        Returns (entries, next_cursor). ``since`` restricts the queue to records whose
+        prescriptions were added or changed after that datetime.
+        """
+        segment, _, inner = (cursor or '').partition('.')
+        if segment not in cls.SEGMENTS:
+            segment, inner = cls.SEGMENTS[0], ''
+
+        records = MedicalRecord.objects.select_related('patient__user', 'doctor__user')
+        if since is not None:
+            records = records.filter(
+                pk__in=Prescription.objects.filter(updated_at__gt=since).values('medical_record')
+            )
+        pending = Prescription.objects.filter(is_dispensed=False).values('medical_record')
+        has_any = Exists(Prescription.objects.filter(medical_record=OuterRef('pk')))
+        querysets = {
+            'pending': records.filter(pk__in=pending),
+            'dispensed': records.filter(has_any).exclude(pk__in=pending),
+        }
+
+        entries = []
+        next_cursor = None
+        for name in cls.SEGMENTS[cls.SEGMENTS.index(segment):]:
+            page = CursorPaginator(querysets[name], limit - len(entries), ['-created_at']).get_page(
+                inner if name == segment else None
+            )
+            entries += [(record, name) for record in page]
+            if page.has_next():
+                next_cursor = f'{name}.{page.next_cursor}'
+                break
+            if len(entries) >= limit:
+                following = cls.SEGMENTS.index(name) + 1
+                if following < len(cls.SEGMENTS):
+                    next_cursor = f'{cls.SEGMENTS[following]}.'
+                break
+
+        medicines = defaultdict(list)
+        lines = Prescription.objects.filter(
+            medical_record__in=[record.pk for record, _ in entries]
+        ).order_by('id').values_list('medical_record_id', 'medication_name')
+        for record_id, medication_name in lines:
+            medicines[record_id].append(medication_name)
+
+        return [
+            {'record': record, 'status': status, 'medicines': medicines[record.pk]}
+            for record, status in entries
+        ], next_cursor
+
+
+class Formulary:
+    """
+    Medicine names and generic names in a per-process prefix trie, behind the
+    medication autocomplete of the prescription forms.
+
+    Every word of a name starts a key ('sodium chloride' is also keyed 'chloride'), and
+    keys are cut at KEY_LENGTH characters to bound the trie's size. The trie is built
+    with one query and rebuilt when the version in the shared cache (see CACHES)
+    changes: medicine saves and deletes bump it once they commit (see pharmacy.signals),
+    and it expires after CACHE_TIMEOUT seconds, so a missed bump leaves a trie stale
+    for an hour at most. A lookup costs one cache read and a walk down the trie,
+    however large the formulary.
+    """
+
+    VERSION_KEY = 'pharmacy:formulary:version'
+    CACHE_TIMEOUT = 3600
+    KEY_LENGTH = 24
+    MAX_SUGGESTIONS = 10
+    # Trie nodes are dicts of character -> child; this key holds the (key, medicine)
+    # pairs ending at a node
+    END = None
+
+    _lock = threading.Lock()
+    _state = (None, None)
+
+    @classmethod
+    def version(cls):
+        version = cache.get(cls.VERSION_KEY)
+        if version is None:
+            cache.add(cls.VERSION_KEY, uuid.uuid4().hex, cls.CACHE_TIMEOUT)
+            version = cache.get(cls.VERSION_KEY)
+        return version
+
+    @classmethod
+    def invalidate(cls):
+        """Make every process rebuild its trie on its next lookup."""
+        cache.set(cls.VERSION_KEY, uuid.uuid4().hex, cls.CACHE_TIMEOUT)
+
+    @staticmethod
+    def normalize(text):
+        return ' '.join(words(text))
+
+    @classmethod
+    def build(cls):
+        root = {}
+        medicines = Medicine.objects.order_by('name', 'id').values_list(
+            'id', 'name', 'generic_name', 'unit_of_measurement'
+        )
+        for pk, name, generic_name, unit in medicines.iterator():
+            medicine = {'id': pk, 'name': name, 'generic_name': generic_name, 'unit_of_measurement': unit}
+            keys = set()
+            for text in (name, generic_name):
+                parts = words(text)
+                keys.update(' '.join(parts[i:]) for i in range(len(parts)))
+            for key in keys:
+                node = root
+                for char in key[:cls.KEY_LENGTH]:
+                    node = node.setdefault(char, {})
+                node.setdefault(cls.END, []).append((key, medicine))
+        return root
+
+    @classmethod
+    def trie(cls):
+        version = cls.version()
+        built_for, root = cls._state
+        if built_for != version:
+            with cls._lock:
+                built_for, root = cls._state
+                if built_for != version:
+                    root = cls.build()
+                    cls._state = (version, root)
+        return root
+
+    @classmethod
+    def suggest(cls, query, limit=MAX_SUGGESTIONS):
+        """Medicines with a name or generic name word starting with ``query``, in key order."""
+        query = cls.normalize(query)
+        node = cls._node(query) if query else None
+        if node is None:
+            return []
+
+        suggestions, seen = [], set()
+        stack = [node]
+        while stack and len(suggestions) < limit:
+            node = stack.pop()
+            for key, medicine in node.get(cls.END, ()):
+                # Keys longer than KEY_LENGTH share a node; check the rest of the query
+                if medicine['id'] not in seen and key.startswith(query):
+                    seen.add(medicine['id'])
+                    suggestions.append(medicine)
+                    if len(suggestions) >= limit:
+                        break
+            stack.extend(node[char] for char in sorted((char for char in node if char is not cls.END), reverse=True))
+        return suggestions
+
+    @classmethod
+    def _node(cls, key):
+        node = cls.trie()
+        for char in key[:cls.KEY_LENGTH]:
+            node = node.get(char)
+            if node is None:
+                return None
+        return node
+
+    @classmethod
+    def canonical_name(cls, name):
+        """The formulary spelling of a medicine called ``name`` (any case or spacing), else None."""
+        key = cls.normalize(name)
+        node = cls._node(key) if key else None
+        for node_key, medicine in (node or {}).get(cls.END, ()):
+            if node_key == key and cls.normalize(medicine['name']) == key:
+                return medicine['name']
+        return None
@@ -0,0 +1,51 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from medical_records.models import Prescription
+from .events import publish
+from .models import Medicine, Inventory
+from .services import Formulary, stock_level, publish_stock_change
+
+
+@receiver(post_save, sender=Medicine)
+def touch_medicine_inventory(sender, instance, created, **kwargs):
+    # Inventory responses embed medicine names; bumping updated_at retires their ETags
+    if not created:
+        Inventory.objects.filter(medicine=instance).update(updated_at=timezone.now())
+
+
+@receiver(post_save, sender=Medicine)
+@receiver(post_delete, sender=Medicine)
+def invalidate_formulary(sender, instance, **kwargs):
+    transaction.on_commit(Formulary.invalidate)
+
+
+@receiver(post_init, sender=Inventory)
+def remember_stock_level(sender, instance, **kwargs):
+    # Read through __dict__ so deferred fields don't trigger a query per instance
+    values = instance.__dict__
+    if 'quantity_in_stock' in values and 'minimum_stock_level' in values and instance.pk is not None:
+        instance._stock_level = stock_level(values['quantity_in_stock'], values['minimum_stock_level'])
+    else:
+        instance._stock_level = None
+
+
+@receiver(post_save, sender=Inventory)
+def publish_stock_level(sender, instance, created, **kwargs):
+    level = stock_level(instance.quantity_in_stock, instance.minimum_stock_level)
+    previous_level = None if created else instance._stock_level
+    if created or level != previous_level:
+        publish_stock_change(instance, previous_level)
+    instance._stock_level = level
+
+
+@receiver(post_save, sender=Prescription)
+def publish_new_prescription(sender, instance, created, **kwargs):
+    if created:
+        publish('prescription', {
+            'id': instance.pk,
+            'record_id': instance.medical_record_id,
+            'medication_name': instance.medication_name,
+        })
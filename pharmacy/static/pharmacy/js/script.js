@@ -102,20 +102,6 @@ async function loadDashboard() {
       lastVisit: p.created_at   ? p.created_at.split('T')[0] : '—',
     }));
 
-    inventory = (data.critical_inventory || []).map(i => ({
-      id:          i.id,
-      medicineName:i.medicine.name,
-      genericName: i.medicine.generic_name || '',
-      strength:    i.medicine.strength     || '',
-      batch:       i.batch_number,
-      qty:         i.quantity_in_stock,
-      price:       parseFloat(i.unit_price),
-      expiry:      i.expiry_date,
-      supplier:    i.supplier,
-      minStock:    i.minimum_stock_level,
-      received:    i.date_received || '—',
-    }));
-
     dispensingHistory = (data.recent_dispensing || []).map(r => ({
       patientName: r.prescription
         ? `${r.prescription.patient.first_name} ${r.prescription.patient.last_name}`
@@ -128,14 +114,53 @@ async function loadDashboard() {
     }));
 
     renderPatients(patients);
-    renderInventory(inventory);
     renderHistory();
-    populateMedicineSelect();
 
   } catch (e) {
     console.error(e);
     toast('Network error loading dashboard', 'danger');
   }
+  await loadInventory();
+}
+
+/* Pages through the inventory API. Its responses carry an ETag with
+   Cache-Control: no-cache, so the browser revalidates each page with
+   If-None-Match and unchanged stock comes back as a bodiless 304. */
+const INVENTORY_PAGE_SIZE = 200;
+
+async function loadInventory() {
+  try {
+    const items = [];
+    let cursor = '';
+    do {
+      const params = new URLSearchParams({ limit: INVENTORY_PAGE_SIZE });
+      if (cursor) params.set('cursor', cursor);
+      const res = await fetch(`/pharmacy/api/inventory/?${params}`);
+      if (!res.ok) { toast('Failed to load inventory', 'danger'); return; }
+      items.push(...await res.json());
+      cursor = res.headers.get('X-Next-Cursor');
+    } while (cursor);
+
+    inventory = items.map(i => ({
+      id:          i.id,
+      medicineName:i.medicine.name,
+      genericName: i.medicine.generic_name || '',
+      strength:    i.medicine.strength     || '',
+      batch:       i.batch_number,
+      qty:         i.quantity_in_stock,
+      price:       parseFloat(i.unit_price),
+      expiry:      i.expiry_date,
+      supplier:    i.supplier,
+      minStock:    i.minimum_stock_level,
+      received:    i.date_received || '—',
+    }));
+
+    renderInventory(inventory);
+    populateMedicineSelect();
+  } catch (e) {
+    console.error(e);
+    toast('Network error loading inventory', 'danger');
+  }
 }
 
 async function loadPrescriptions() {
@@ -508,5 +533,72 @@ async function submitEditStock() {
   } catch { toast('Network error', 'danger'); }
 }
 
-/* Auto-refresh every 5 min */
-setInterval(loadDashboard, 300_000);
+/* ══════════════════════════════════════
+   LIVE UPDATES  (server-sent events; deltas applied in place)
+══════════════════════════════════════ */
+function bumpText(id, delta) {
+  const el = document.getElementById(id);
+  if (el) el.textContent = Math.max(0, (parseInt(el.textContent, 10) || 0) + delta);
+}
+
+const isLowLevel = level => level === 'low' || level === 'critical';
+
+function applyStock(d) {
+  if (isLowLevel(d.level) !== isLowLevel(d.previous_level)) {
+    bumpText('lowStockItems', isLowLevel(d.level) ? 1 : -1);
+  }
+  const item = inventory.find(x => x.id === d.id);
+  if (item) {
+    item.qty      = d.quantity_in_stock;
+    item.minStock = d.minimum_stock_level;
+  } else if (d.level !== 'normal') {
+    inventory.push({
+      id:          d.id,
+      medicineName:d.medicine,
+      genericName: d.generic_name || '',
+      strength:    '',
+      batch:       d.batch_number,
+      qty:         d.quantity_in_stock,
+      price:       parseFloat(d.unit_price),
+      expiry:      d.expiry_date,
+      supplier:    d.supplier,
+      minStock:    d.minimum_stock_level,
+      received:    d.date_received || '—',
+    });
+  }
+}
+
+function connectLiveUpdates() {
+  if (!window.EventSource) {
+    /* No SSE support: fall back to refreshing every 5 min */
+    setInterval(loadDashboard, 300_000);
+    return;
+  }
+  const source = new EventSource('/pharmacy/api/events/');
+
+  source.addEventListener('prescription', () => {
+    bumpText('pendingPrescriptions', 1);
+    if (prescriptions.length) loadPrescriptions();
+  });
+
+  source.addEventListener('dispensed', e => {
+    const d = JSON.parse(e.data);
+    bumpText('pendingPrescriptions', -d.prescription_ids.length);
+    bumpText('todayDispensed', d.dispensed);
+    d.items.forEach(i => {
+      const item = inventory.find(x => x.id === i.id);
+      if (item) item.qty = i.quantity_in_stock;
+    });
+    renderInventory(inventory);
+    populateMedicineSelect();
+    if (prescriptions.length) loadPrescriptions();
+  });
+
+  source.addEventListener('stock', e => {
+    applyStock(JSON.parse(e.data));
+    renderInventory(inventory);
+    populateMedicineSelect();
+  });
+}
+
+document.addEventListener('DOMContentLoaded', connectLiveUpdates);
@@ -1,3 +1,322 @@
-from django.test import TestCase
+import asyncio
+import threading
+from datetime import date, timedelta
+from decimal import Decimal
 
-# Create your tests here.
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Sum
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from accounts.models import User
+from appointments.models import Doctor
+from medical_records.models import MedicalRecord, Prescription
+from patients.models import Patient
+from . import events
+from .models import Inventory, Medicine, MedicineDispensing, Pharmacist
+from .services import DispensingError, DispensingService, Formulary, PrescriptionQueue
+
+
+def make_batch(name='Paracetamol', quantity=100, batch_number=None, medicine=None, expires_in=365):
+    medicine = medicine or Medicine.objects.create(name=name, manufacturer='KEMSA', unit_of_measurement='tablets')
+    return Inventory.objects.create(
+        medicine=medicine, batch_number=batch_number or f'B-{name}', quantity_in_stock=quantity,
+        unit_price=Decimal('5.00'), expiry_date=date.today() + timedelta(days=expires_in),
+        supplier='KEMSA', date_received=date.today(),
+    )
+
+
+class InventoryApiETagTests(TestCase):
+    """The pharmacy SPA loads its inventory table page by page from the ETag'd API."""
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(User.objects.create_user(email='pharmacist@example.com', role='pharmacist'))
+        self.batches = [make_batch(f'Medicine {i}', quantity=10 + i) for i in range(5)]
+
+    def test_unchanged_pages_revalidate_as_not_modified(self):
+        url = reverse('pharmacy:inventory_api')
+        first = self.client.get(url, {'limit': 2})
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(len(first.json()), 2)
+        cursor = first['X-Next-Cursor']
+
+        again = self.client.get(url, {'limit': 2}, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again.content, b'')
+
+        second = self.client.get(url, {'limit': 2, 'cursor': cursor})
+        self.assertEqual(second.status_code, 200)
+        self.assertNotEqual(second['ETag'], first['ETag'])
+
+        self.batches[0].quantity_in_stock = 1
+        self.batches[0].save()
+        changed = self.client.get(url, {'limit': 2}, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(changed.status_code, 200)
+
+
+class DispensingOversellTests(TransactionTestCase):
+    """Concurrent dispenses never take stock below zero or dispense a prescription twice."""
+
+    THREADS = 20
+    UNITS = 3
+
+    def setUp(self):
+        cache.clear()
+        pharmacist_user = User.objects.create_user(email='pharmacist@example.com', role='pharmacist')
+        self.pharmacist = Pharmacist.objects.create(
+            pharmacist_id='PH001', user=pharmacist_user, license_number='PPB-001',
+        )
+        doctor = Doctor.objects.get(user=User.objects.create_user(email='doctor@example.com', role='doctor'))
+        patient = Patient.objects.get(user=User.objects.create_user(email='patient@example.com', role='patient'))
+        self.record = MedicalRecord.objects.create(
+            patient=patient, doctor=doctor, diagnosis='Malaria', symptoms='Fever', treatment_plan='ACT',
+        )
+        # 25 units over two batches: at most eight dispenses of three fit
+        first = make_batch('Artemether', quantity=15, batch_number='B-1', expires_in=30)
+        self.medicine = first.medicine
+        make_batch(quantity=10, batch_number='B-2', medicine=self.medicine)
+
+    def prescription(self):
+        return Prescription.objects.create(
+            medical_record=self.record, medication_name='Artemether', dosage='80mg',
+            frequency='Twice daily', duration='3 days',
+        )
+
+    def _dispense_concurrently(self, prescriptions):
+        barrier = threading.Barrier(len(prescriptions))
+        results = []
+
+        def dispense(prescription):
+            try:
+                barrier.wait()
+                DispensingService.dispense(
+                    [(prescription, self.UNITS, [self.medicine.pk])], self.pharmacist,
+                )
+                results.append('dispensed')
+            except DispensingError:
+                results.append('rejected')
+            except Exception as exc:
+                results.append(exc)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=dispense, args=(prescription,)) for prescription in prescriptions]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def stock(self):
+        return Inventory.objects.filter(medicine=self.medicine).aggregate(total=Sum('quantity_in_stock'))['total']
+
+    def test_concurrent_dispenses_stop_at_the_stock(self):
+        results = self._dispense_concurrently([self.prescription() for _ in range(self.THREADS)])
+
+        self.assertEqual(sorted(results), ['dispensed'] * 8 + ['rejected'] * 12, results)
+        self.assertEqual(self.stock(), 25 - 8 * self.UNITS)
+        self.assertFalse(Inventory.objects.filter(quantity_in_stock__lt=0).exists())
+        dispensed = MedicineDispensing.objects.aggregate(total=Sum('quantity_dispensed'))['total']
+        self.assertEqual(dispensed, 8 * self.UNITS)
+        self.assertEqual(Prescription.objects.filter(is_dispensed=True).count(), 8)
+
+    def test_a_prescription_is_dispensed_once(self):
+        prescription = self.prescription()
+        results = self._dispense_concurrently([
+            Prescription.objects.get(pk=prescription.pk) for _ in range(10)
+        ])
+
+        self.assertEqual(sorted(results), ['dispensed'] + ['rejected'] * 9, results)
+        self.assertEqual(self.stock(), 25 - self.UNITS)
+        self.assertEqual(MedicineDispensing.objects.count(), 1)
+
+
+class PrescriptionQueueTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        doctor = Doctor.objects.get(user=User.objects.create_user(email='doctor@example.com', role='doctor'))
+        patient = Patient.objects.get(user=User.objects.create_user(email='patient@example.com', role='patient'))
+        self.records = []
+        for i in range(6):
+            record = MedicalRecord.objects.create(
+                patient=patient, doctor=doctor, diagnosis=f'Visit {i}', symptoms='Fever', treatment_plan='Rest',
+            )
+            Prescription.objects.create(
+                medical_record=record, medication_name=f'Medicine {i}', dosage='1', frequency='Daily',
+                duration='5 days', is_dispensed=i % 2 == 0,
+            )
+            self.records.append(record)
+
+    def test_pending_records_first_newest_first(self):
+        entries, cursor = PrescriptionQueue.page(2)
+        seen = [(entry['record'].pk, entry['status']) for entry in entries]
+        while cursor:
+            entries, cursor = PrescriptionQueue.page(2, cursor)
+            seen += [(entry['record'].pk, entry['status']) for entry in entries]
+        expected = [(record.pk, 'pending') for record in reversed(self.records[1::2])]
+        expected += [(record.pk, 'dispensed') for record in reversed(self.records[0::2])]
+        self.assertEqual(seen, expected)
+
+    def test_pending_page_is_driven_by_pending_prescriptions(self):
+        _, cursor = PrescriptionQueue.page(1)
+        with CaptureQueriesContext(connection) as queries:
+            PrescriptionQueue.page(1, cursor)
+        page_sql = next(q['sql'] for q in queries if q['sql'].startswith('SELECT "medical_records_medicalrecord"'))
+        with connection.cursor() as db:
+            db.execute('EXPLAIN QUERY PLAN ' + page_sql)
+            plan = ' | '.join(row[-1] for row in db.fetchall())
+        self.assertIn('rx_pending_idx', plan)
+        self.assertNotIn('SCAN medical_records_medicalrecord', plan)
+
+    def test_watermark_trails_the_clock(self):
+        self.assertLessEqual(PrescriptionQueue.watermark(), timezone.now() - PrescriptionQueue.WATERMARK_LAG)
+        since = PrescriptionQueue.watermark()
+        entries, _ = PrescriptionQueue.page(10, since=since)
+        self.assertEqual(len(entries), 6)
+
+
+class PharmacyEventsTests(TestCase):
+    """The in-process broker behind the pharmacy dashboard's server-sent events."""
+
+    def setUp(self):
+        cache.clear()
+        previous, events._broker = events._broker, events.InProcessBroker()
+        self.addCleanup(setattr, events, '_broker', previous)
+        self.broker = events.get_broker()
+
+    def drain(self, subscription):
+        records = []
+        while (record := subscription.get(0)) is not None:
+            records.append(record)
+        return records
+
+    def test_published_on_commit_only(self):
+        subscription = self.broker.subscribe()
+        doctor = Doctor.objects.get(user=User.objects.create_user(email='doctor@example.com', role='doctor'))
+        patient = Patient.objects.get(user=User.objects.create_user(email='patient@example.com', role='patient'))
+        record = MedicalRecord.objects.create(
+            patient=patient, doctor=doctor, diagnosis='Malaria', symptoms='Fever', treatment_plan='ACT',
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            Prescription.objects.create(
+                medical_record=record, medication_name='Artemether', dosage='80mg',
+                frequency='Twice daily', duration='3 days',
+            )
+            self.assertEqual(self.drain(subscription), [])
+        (_, event, data), = self.drain(subscription)
+        self.assertEqual((event, data['medication_name']), ('prescription', 'Artemether'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    events.publish('stock', {'id': 1})
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+        self.assertEqual(self.drain(subscription), [])
+
+    def test_resume_from_last_event_id(self):
+        for i in range(1, 4):
+            self.broker.publish('stock', {'id': i})
+        self.assertEqual([record[0] for record in self.drain(self.broker.subscribe(1))], [2, 3])
+        # An id from before a restart (ahead of this broker) replays nothing
+        self.assertEqual(self.drain(self.broker.subscribe(99)), [])
+
+        listeners = len(self.broker._subscribers)
+        stream = events.stream_sync(2)
+        self.assertEqual(next(stream), 'retry: 1000\n\n')
+        self.assertEqual(next(stream), 'id: 3\nevent: stock\ndata: {"id": 3}\n\n')
+        stream.close()
+        self.assertEqual(len(self.broker._subscribers), listeners)
+
+    def test_async_stream_wakes_on_publish(self):
+        async def read():
+            stream = events.stream(3)
+            try:
+                await stream.__anext__()
+                # Published from another thread while the stream waits
+                threading.Timer(0.05, self.broker.publish, ('dispensed', {'id': 4})).start()
+                return await asyncio.wait_for(stream.__anext__(), 5)
+            finally:
+                await stream.aclose()
+
+        for i in range(1, 4):
+            self.broker.publish('stock', {'id': i})
+        self.assertEqual(asyncio.run(read()), 'id: 4\nevent: dispensed\ndata: {"id": 4}\n\n')
+        self.assertEqual(self.broker._subscribers, set())
+
+    def test_slow_listener_loses_its_oldest_events(self):
+        subscription = self.broker.subscribe()
+        for i in range(1, 1006):
+            self.broker.publish('stock', {'id': i})
+        ids = [record[0] for record in self.drain(subscription)]
+        self.assertEqual((len(ids), ids[0], ids[-1]), (1000, 6, 1005))
+
+
+class FormularyTests(TestCase):
+    """The medication autocomplete's trie: word prefixes, limits and rebuilds on commit."""
+
+    def setUp(self):
+        cache.clear()
+        for name, generic_name in [
+            ('Sodium Chloride', 'Saline'),
+            ('Paracetamol', 'Acetaminophen'),
+            ('Amoxicillin', ''),
+            ('Amlodipine', ''),
+            ('Amoxicillin Clavulanate Potassium', 'Co-amoxiclav'),
+        ]:
+            Medicine.objects.create(
+                name=name, generic_name=generic_name, manufacturer='KEMSA', unit_of_measurement='tablets',
+            )
+
+    def names(self, query, limit=Formulary.MAX_SUGGESTIONS):
+        return [medicine['name'] for medicine in Formulary.suggest(query, limit)]
+
+    def test_any_word_of_either_name_is_a_prefix(self):
+        self.assertEqual(self.names('AM'), ['Amlodipine', 'Amoxicillin', 'Amoxicillin Clavulanate Potassium'])
+        self.assertEqual(self.names('chlor'), ['Sodium Chloride'])
+        self.assertEqual(self.names('acetamin'), ['Paracetamol'])
+        self.assertEqual(self.names('amoxiclav'), ['Amoxicillin Clavulanate Potassium'])
+        self.assertEqual(self.names('am', limit=2), ['Amlodipine', 'Amoxicillin'])
+        for query in ('', '  ', 'zinc'):
+            with self.subTest(query=query):
+                self.assertEqual(self.names(query), [])
+
+    def test_queries_longer_than_the_key_are_checked_in_full(self):
+        query = 'amoxicillin clavulanate potassium'
+        self.assertGreater(len(query), Formulary.KEY_LENGTH)
+        self.assertEqual(self.names(query), ['Amoxicillin Clavulanate Potassium'])
+        self.assertEqual(self.names('amoxicillin clavulanate sodium'), [])
+        self.assertEqual(Formulary.canonical_name(' amoxicillin  CLAVULANATE potassium'), query.title())
+        self.assertIsNone(Formulary.canonical_name('amoxicillin clavulanate'))
+
+    def test_lookups_reuse_the_trie(self):
+        self.names('am')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.names('para'), ['Paracetamol'])
+
+    def test_trie_is_rebuilt_once_a_medicine_commits(self):
+        self.assertEqual(self.names('ibu'), [])
+        with self.captureOnCommitCallbacks(execute=True):
+            Medicine.objects.create(name='Ibuprofen', manufacturer='KEMSA', unit_of_measurement='tablets')
+            self.assertEqual(self.names('ibu'), [])
+        self.assertEqual(self.names('ibu'), ['Ibuprofen'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Medicine.objects.filter(name='Ibuprofen').delete()
+        self.assertEqual(self.names('ibu'), [])
+
+    def test_suggestions_api(self):
+        url = reverse('medical_records:medication_suggestions_api')
+        self.client.force_login(User.objects.create_user(email='doctor@example.com', role='doctor'))
+        response = self.client.get(url, {'q': 'am', 'limit': 1})
+        self.assertEqual(response.status_code, 200)
+        (medicine,) = response.json()['medications']
+        self.assertEqual((medicine['name'], medicine['unit_of_measurement']), ('Amlodipine', 'tablets'))
+        self.client.force_login(User.objects.create_user(email='patient@example.com', role='patient'))
+        self.assertEqual(self.client.get(url, {'q': 'am'}).status_code, 403)
@@ -2,19 +2,26 @@ from datetime import date, timedelta, datetime
 from decimal import Decimal
 import json
 from django.shortcuts import render, get_object_or_404
-from django.http import JsonResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
 from django.utils import timezone
-from collections import defaultdict
+from django.utils.dateparse import parse_datetime
 from django.views import View
 from django.db.models import Q, F
 from django.core.paginator import Paginator
 from django.contrib.auth.decorators import login_required
 from django.utils.decorators import method_decorator
-from django.views.decorators.http import require_http_methods
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import require_http_methods, etag
 
 from .models import Pharmacist, Medicine, Inventory, MedicineDispensing
+from . import events
+from .services import stock_status, inventory_etag, DispensingService, PrescriptionQueue
 from .forms import PharmacistForm, MedicineForm, InventoryForm, DispensingForm, PatientSearchForm
 from medical_records.models import Patient, Prescription
+from patients.services import PatientSearchIndex
+from dashboard.exports import Column, streaming_export
+from dashboard.pagination import paginate_json, page_limit
 
 
 @login_required
@@ -39,6 +46,26 @@ def pharmacy_dashboard(request):
     return render(request, 'pharmacy_dash.html', context)
 
 
+@login_required
+async def pharmacy_events(request):
+    """
+    Server-sent events for the pharmacy dashboard: 'prescription' (new line written),
+    'dispensed' and 'stock' (a batch added or crossing a stock level). Replaces polling
+    pharmacy_dashboard_data; reconnecting clients resume from Last-Event-ID.
+    """
+    last_event_id = request.headers.get('Last-Event-ID', '')
+    last_event_id = int(last_event_id) if last_event_id.isdigit() else None
+    if isinstance(request, ASGIRequest):
+        content = events.stream(last_event_id)
+    else:
+        content = events.stream_sync(last_event_id)
+    response = StreamingHttpResponse(content, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Stop nginx from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
 @login_required
 def pharmacy_dashboard_data(request):
     if request.method != 'GET':
@@ -46,10 +73,6 @@ def pharmacy_dashboard_data(request):
 
     today = timezone.now().date()
     
-    critical_inventory = Inventory.objects.filter(
-            Q(quantity_in_stock__lte=F('minimum_stock_level')) |
-            Q(expiry_date__lte=date.today() + timedelta(days=90))
-        ).select_related('medicine').order_by('quantity_in_stock')[:10]
     recent_dispensing = MedicineDispensing.objects.select_related(
             'prescription__medical_record__patient', 'inventory_item__medicine', 'pharmacist'
         ).order_by('-dispensed_at')[:10]
@@ -75,24 +98,6 @@ def pharmacy_dashboard_data(request):
             for p in Patient.objects.order_by('-created_at')[:5]
             
         ],
-        'critical_inventory': [
-            {
-                'id': item.id,
-                'medicine': {
-                    'id': item.medicine.id,
-                    'name': item.medicine.name,
-                    'strength': getattr(item.medicine, 'strength', ''),
-                },
-                'batch_number': item.batch_number,
-                'quantity_in_stock': item.quantity_in_stock,
-                'unit_price': str(item.unit_price),
-                'expiry_date': item.expiry_date.isoformat(),
-                'supplier': item.supplier,
-                'minimum_stock_level': item.minimum_stock_level,
-                'date_received': item.date_received.isoformat() if item.date_received else None,
-            }
-            for item in critical_inventory
-        ],
         'recent_dispensing': [
             {
                 'id': record.id,
@@ -130,17 +135,12 @@ def pharmacy_dashboard_data(request):
 def patients_api(request):
     if request.method == 'GET':
         search_query = request.GET.get('search', '')
-        patients = Patient.objects.all()
+        patients = Patient.objects.select_related('user')
 
         if search_query:
-            patients = patients.filter(
-                Q(first_name__icontains=search_query) |
-                Q(last_name__icontains=search_query) |
-                Q(phone_number__icontains=search_query) |
-                Q(patient_id__icontains=search_query)
-            )
+            patients = patients.filter(pk__in=PatientSearchIndex.matching(search_query))
 
-        patients = patients.order_by('-created_at')
+        patients = paginate_json(request, patients, ['-created_at'])
 
         data = [{
             'patient_id': p.patient_id,
@@ -153,7 +153,11 @@ def patients_api(request):
             'created_at': p.created_at.isoformat() if p.created_at else None,
         } for p in patients]
 
-        return JsonResponse(data, safe=False)
+        response = JsonResponse(data, safe=False)
+        # The body stays a bare list for existing clients; the next page's cursor rides in a header
+        if patients.next_cursor:
+            response['X-Next-Cursor'] = patients.next_cursor
+        return response
 
     # POST
     try:
@@ -188,33 +192,43 @@ def patients_api(request):
 
 @login_required
 @require_http_methods(["GET", "POST"])
+@cache_control(private=True, no_cache=True)
+@etag(inventory_etag)
 def inventory_api(request):
     if request.method == 'GET':
         search_query = request.GET.get('search', '')
-        inventory = Inventory.objects.select_related('medicine').all()
+        inventory = Inventory.objects.all()
         if search_query:
             inventory = inventory.filter(
                 Q(medicine__name__icontains=search_query) |
                 Q(batch_number__icontains=search_query) |
                 Q(supplier__icontains=search_query)
             )
-        inventory = inventory.order_by('quantity_in_stock')
+        inventory = paginate_json(request, inventory.values(
+            'id', 'medicine_id', 'medicine__name', 'medicine__generic_name', 'batch_number',
+            'quantity_in_stock', 'unit_price', 'expiry_date', 'supplier', 'minimum_stock_level',
+            'date_received', status=stock_status(),
+        ), ['quantity_in_stock'])
         data = [{
-            'id': item.id,
+            'id': item['id'],
             'medicine': {
-                'id': item.medicine.id,
-                'name': item.medicine.name,
-                'generic_name': item.medicine.generic_name,
+                'id': item['medicine_id'],
+                'name': item['medicine__name'],
+                'generic_name': item['medicine__generic_name'],
             },
-            'batch_number': item.batch_number,
-            'quantity_in_stock': item.quantity_in_stock,
-            'unit_price': str(item.unit_price),
-            'expiry_date': item.expiry_date.isoformat() if item.expiry_date else None,
-            'supplier': item.supplier,
-            'minimum_stock_level': item.minimum_stock_level,
-            'date_received': item.date_received.isoformat() if item.date_received else None,
+            'batch_number': item['batch_number'],
+            'quantity_in_stock': item['quantity_in_stock'],
+            'unit_price': str(item['unit_price']),
+            'expiry_date': item['expiry_date'].isoformat() if item['expiry_date'] else None,
+            'supplier': item['supplier'],
+            'minimum_stock_level': item['minimum_stock_level'],
+            'date_received': item['date_received'].isoformat() if item['date_received'] else None,
+            'status': item['status'],
         } for item in inventory]
-        return JsonResponse(data, safe=False)
+        response = JsonResponse(data, safe=False)
+        if inventory.next_cursor:
+            response['X-Next-Cursor'] = inventory.next_cursor
+        return response
     
     # Handle POST request
     try:
@@ -290,87 +304,137 @@ def update_stock_api(request, item_id):
 @login_required
 @require_http_methods(["POST"])
 def dispensing_api(request):
+    """
+    Dispense one prescription line ({prescription_id, inventory_item_id, quantity_dispensed})
+    or several at once ({lines: [{prescription_id, quantity, inventory_item_id?}, ...]}).
+    The inventory item picks the medicine; stock is drawn from its batches FEFO.
+    """
     try:
         data = json.loads(request.body)
-        # print(f"Received dispensing data: {data}")
-        inventory_item = Inventory.objects.get(id=data['inventory_item_id'])
-
-        if inventory_item.quantity_in_stock < data['quantity_dispensed']:
-            return JsonResponse({'error': 'Insufficient stock available'}, status=400)
+        if 'lines' in data:
+            lines = data['lines']
+        else:
+            lines = [{
+                'prescription_id': data.get('prescription_id'),
+                'inventory_item_id': data.get('inventory_item_id'),
+                'quantity': data.get('quantity_dispensed'),
+            }]
+        # Form fields arrive as strings
+        for line in lines:
+            line['prescription_id'] = int(line['prescription_id']) if line.get('prescription_id') else None
+            line['inventory_item_id'] = int(line['inventory_item_id']) if line.get('inventory_item_id') else None
+
+        prescriptions = Prescription.objects.in_bulk([line['prescription_id'] for line in lines if line['prescription_id']])
+        items = dict(Inventory.objects.filter(
+            id__in=[line['inventory_item_id'] for line in lines if line['inventory_item_id']]
+        ).values_list('id', 'medicine_id'))
+        requested = []
+        for line in lines:
+            prescription = prescriptions.get(line['prescription_id'])
+            if prescription is None:
+                return JsonResponse({'error': 'A valid prescription is required to dispense'}, status=400)
+            item_id = line['inventory_item_id']
+            if item_id and item_id not in items:
+                return JsonResponse({'error': 'Inventory item not found'}, status=404)
+            requested.append((prescription, int(line['quantity']), [items[item_id]] if item_id else None))
 
-        prescription = None
-        if data.get('prescription_id'):
-            prescription = Prescription.objects.get(id=1)
-            pass
         pharmacist = Pharmacist.objects.get(user=request.user)
-        dispensing = MedicineDispensing.objects.create(
-            prescription=prescription,
-            inventory_item=inventory_item,
-            quantity_dispensed=data['quantity_dispensed'],
-            pharmacist=pharmacist,
-            notes=data.get('notes', ''),
-            dispensed_at=timezone.now()
+        dispensings = DispensingService.dispense(
+            requested, pharmacist, dispensed_by=request.user, notes=data.get('notes', '')
         )
 
-        inventory_item.quantity_in_stock -= data['quantity_dispensed']
-        inventory_item.save()
-
         return JsonResponse({
-            'id': dispensing.id,
+            'id': dispensings[0].id,
             'message': 'Medicine dispensed successfully',
-            'remaining_stock': inventory_item.quantity_in_stock
+            'remaining_stock': DispensingService.available([dispensings[-1].inventory_item.medicine_id]),
+            'dispensings': [{
+                'id': dispensing.id,
+                'prescription_id': dispensing.prescription_id,
+                'inventory_item_id': dispensing.inventory_item_id,
+                'batch_number': dispensing.inventory_item.batch_number,
+                'quantity': dispensing.quantity_dispensed,
+            } for dispensing in dispensings],
         })
 
-    except Inventory.DoesNotExist:
-        return JsonResponse({'error': 'Inventory item not found'}, status=404)
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=400)
 
 
 
+@login_required
 def prescription_list_api(request):
-    """API endpoint for prescription list grouped by medical record"""
-    
-    prescriptions = Prescription.objects.select_related(
-        'medical_record__patient__user',
-        'medical_record__doctor__user',
-        'dispensed_by'
-    ).all()
-    # Group prescriptions by medical record
-    grouped_prescriptions = defaultdict(list)
-    for prescription in prescriptions:
-        grouped_prescriptions[prescription.medical_record.record_id].append(prescription)
-    prescriptions_data = []
-    for record_id, prescription_list in grouped_prescriptions.items():
-        # Use the first prescription to get patient/doctor info
-        first_prescription = prescription_list[0]
-        
-        # Collect all medicines for this medical record
-        medicines = [p.medication_name for p in prescription_list]
-        
-        # Determine overall status
-        all_dispensed = all(p.is_dispensed for p in prescription_list)
-        status = "dispensed" if all_dispensed else "pending"
-        prescriptions_data.append({
-            'id': record_id,
-            'patient_id': first_prescription.medical_record.patient.patient_id,
-            'patient_name': first_prescription.medical_record.patient.user.get_full_name(),
-            'doctor': first_prescription.medical_record.doctor.user.get_full_name(),
-            'date': first_prescription.medical_record.created_at.strftime('%Y-%m-%d'),
-            'medicines': medicines,
-            'status': status,
-            'prescription_count': len(prescription_list)
-        })
+    """
+    API endpoint for the prescription queue grouped by medical record, pending first.
+    Paged with ?cursor=/&limit=; pass a previous response's changed_until as ?since=
+    to fetch only records whose prescriptions changed after it (some may repeat).
+    """
+    since = request.GET.get('since')
+    if since:
+        since = parse_datetime(since)
+        if since is None:
+            return JsonResponse({'error': 'Invalid since timestamp'}, status=400)
+        if timezone.is_naive(since):
+            since = timezone.make_aware(since)
+    # Taken before reading and trailing the clock, so changes committed during or just
+    # after this request show up in the next poll
+    changed_until = PrescriptionQueue.watermark()
+
+    entries, next_cursor = PrescriptionQueue.page(
+        page_limit(request), request.GET.get('cursor'), since or None
+    )
+    prescriptions_data = [{
+        'id': entry['record'].record_id,
+        'patient_id': entry['record'].patient.patient_id,
+        'patient_name': entry['record'].patient.user.get_full_name(),
+        'doctor': entry['record'].doctor.user.get_full_name(),
+        'date': entry['record'].created_at.strftime('%Y-%m-%d'),
+        'medicines': entry['medicines'],
+        'status': entry['status'],
+        'prescription_count': len(entry['medicines']),
+    } for entry in entries]
     return JsonResponse({
-        'prescriptions': prescriptions_data
+        'prescriptions': prescriptions_data,
+        'next_cursor': next_cursor,
+        'changed_until': changed_until.isoformat(),
     })
 
 @login_required
+def inventory_export(request):
+    """Stream inventory as CSV, NDJSON or XLSX (?format=), honouring ?search="""
+    if not request.user.has_module_permission('pharmacy'):
+        return JsonResponse({'error': 'Permission denied'}, status=403)
+
+    search_query = request.GET.get('search', '')
+    inventory = Inventory.objects.order_by('medicine__name', 'expiry_date')
+    if search_query:
+        inventory = inventory.filter(
+            Q(medicine__name__icontains=search_query) |
+            Q(medicine__generic_name__icontains=search_query) |
+            Q(batch_number__icontains=search_query) |
+            Q(supplier__icontains=search_query)
+        )
+
+    columns = [
+        Column('Medicine', 'medicine__name'),
+        Column('Generic Name', 'medicine__generic_name'),
+        Column('Batch Number', 'batch_number'),
+        Column('Quantity In Stock', 'quantity_in_stock'),
+        Column('Minimum Stock Level', 'minimum_stock_level'),
+        Column('Unit Price', 'unit_price'),
+        Column('Expiry Date', 'expiry_date'),
+        Column('Supplier', 'supplier'),
+        Column('Date Received', 'date_received'),
+    ]
+    return streaming_export(inventory, columns, 'inventory_export', request.GET.get('format', 'csv'))
+
+@login_required
+@cache_control(private=True, no_cache=True)
+@etag(inventory_etag)
 def inventory_list_api(request):
-    """API endpoint for inventory list with search"""
+    """API endpoint for inventory list with search, one cursor page at a time"""
     search_query = request.GET.get('search', '')
     
-    inventory = Inventory.objects.select_related('medicine').all()
+    inventory = Inventory.objects.all()
     
     if search_query:
         inventory = inventory.filter(
@@ -380,36 +444,27 @@ def inventory_list_api(request):
             Q(supplier__icontains=search_query)
         )
     
-    inventory = inventory.order_by('medicine__name')
+    inventory = paginate_json(request, inventory.values(
+        'id', 'medicine__name', 'medicine__generic_name', 'batch_number', 'quantity_in_stock',
+        'unit_price', 'expiry_date', 'supplier', 'minimum_stock_level', status=stock_status(),
+    ), ['medicine__name'])
     
-    inventory_data = []
-    for item in inventory:
-        # Determine status
-        status = 'normal'
-        if item.quantity_in_stock <= 5:
-            status = 'critical'
-        elif item.quantity_in_stock <= item.minimum_stock_level:
-            status = 'low'
-        
-        # Check expiry
-        months_to_expiry = (item.expiry_date - date.today()).days / 30
-        if months_to_expiry < 3:
-            status = 'expiring'
-        
-        inventory_data.append({
-            'id': item.id,
-            'medicine_name': f"{item.medicine.name} ({item.medicine.generic_name})",
-            'batch_number': item.batch_number,
-            'quantity': item.quantity_in_stock,
-            'unit_price': float(item.unit_price),
-            'expiry_date': item.expiry_date.strftime('%Y-%m-%d'),
-            'supplier': item.supplier,
-            'min_stock_level': item.minimum_stock_level,
-            'status': status,
-        })
+    inventory_data = [{
+        'id': item['id'],
+        'medicine_name': f"{item['medicine__name']} ({item['medicine__generic_name']})",
+        'batch_number': item['batch_number'],
+        'quantity': item['quantity_in_stock'],
+        'unit_price': float(item['unit_price']),
+        'expiry_date': item['expiry_date'].strftime('%Y-%m-%d'),
+        'supplier': item['supplier'],
+        'min_stock_level': item['minimum_stock_level'],
+        'status': item['status'],
+    } for item in inventory]
     
     return JsonResponse({
-        'inventory': inventory_data
+        'inventory': inventory_data,
+        'next_cursor': inventory.next_cursor,
+        'previous_cursor': inventory.previous_cursor,
     })
 
 
@@ -524,10 +579,10 @@ def dispense_medicine_api(request):
         # Get prescription
         prescription = get_object_or_404(
             Prescription, 
-            prescription_id=data.get('prescription_id')
+            id=data.get('prescription_id')
         )
         
-        # Get inventory item
+        # Get inventory item (selects the medicine; batches are drawn FEFO)
         inventory_item = get_object_or_404(
             Inventory, 
             id=data.get('inventory_item_id')
@@ -535,13 +590,6 @@ def dispense_medicine_api(request):
         
         quantity_to_dispense = int(data.get('quantity'))
         
-        # Check stock
-        if inventory_item.quantity_in_stock < quantity_to_dispense:
-            return JsonResponse({
-                'success': False,
-                'message': 'Insufficient stock available'
-            }, status=400)
-        
         # Get or create pharmacist record for current user
         pharmacist, created = Pharmacist.objects.get_or_create(
             user=request.user,
@@ -551,23 +599,14 @@ def dispense_medicine_api(request):
             }
         )
         
-        # Create dispensing record
-        dispensing = MedicineDispensing.objects.create(
-            prescription=prescription,
-            inventory_item=inventory_item,
-            pharmacist=pharmacist,
-            quantity_dispensed=quantity_to_dispense,
+        # Allocate stock, record the dispensing and mark the prescription dispensed
+        DispensingService.dispense(
+            [(prescription, quantity_to_dispense, [inventory_item.medicine_id])],
+            pharmacist,
+            dispensed_by=request.user,
             notes=data.get('notes', ''),
         )
         
-        # Update inventory
-        inventory_item.quantity_in_stock -= quantity_to_dispense
-        inventory_item.save()
-        
-        # Update prescription status
-        prescription.status = 'dispensed'
-        prescription.save()
-        
         return JsonResponse({
             'success': True,
             'message': 'Medicine dispensed successfully',
@@ -581,20 +620,25 @@ def dispense_medicine_api(request):
 
 
 @login_required
+@cache_control(private=True, no_cache=True)
+@etag(inventory_etag)
 def get_medicines_for_select_api(request):
     """API endpoint to get medicines for select dropdown"""
-    inventory_items = Inventory.objects.filter(
-        quantity_in_stock__gt=0
-    ).select_related('medicine').order_by('medicine__name')
+    inventory_items = paginate_json(
+        request,
+        Inventory.objects.filter(quantity_in_stock__gt=0).values('id', 'medicine__name', 'quantity_in_stock'),
+        ['medicine__name'],
+        default_limit=200,
+    )
     
-    medicines_data = []
-    for item in inventory_items:
-        medicines_data.append({
-            'id': item.id,
-            'name': f"{item.medicine.name} (Stock: {item.quantity_in_stock})",
-            'stock': item.quantity_in_stock,
-        })
+    medicines_data = [{
+        'id': item['id'],
+        'name': f"{item['medicine__name']} (Stock: {item['quantity_in_stock']})",
+        'stock': item['quantity_in_stock'],
+    } for item in inventory_items]
     
     return JsonResponse({
-        'medicines': medicines_data
+        'medicines': medicines_data,
+        'next_cursor': inventory_items.next_cursor,
+        'previous_cursor': inventory_items.previous_cursor,
     })